@@ -0,0 +1,71 @@
+import argparse
+import gc
+import json
+import tracemalloc
+from dataclasses import dataclass
+from typing import Callable, Dict, List
+
+from allocation.domain import model
+
+
+@dataclass(unsafe_hash=True)
+class UnslottedOrderLine:
+    order_ref: str
+    sku: str
+    qty: int
+
+
+def _unslotted_set(sku: str, order_refs: List[str]):
+    return {UnslottedOrderLine(order_ref, sku, 1) for order_ref in order_refs}
+
+
+def _batch(compact: bool) -> Callable[[str, List[str]], model.Batch]:
+    def build(sku: str, order_refs: List[str]) -> model.Batch:
+        batch = model.Batch("batch", sku, len(order_refs), None, compact_allocations=compact)
+        for order_ref in order_refs:
+            batch.allocate(model.OrderLine(order_ref, sku, 1))
+        batch.clear_changes()
+        return batch
+    return build
+
+
+STORES = {
+    "unslotted_dataclass_set": _unslotted_set,
+    "slotted_set": _batch(compact=False),
+    "compact": _batch(compact=True),
+}
+
+
+def bytes_per_allocation(build, allocations: int) -> float:
+    sku = "MEMORY-SKU"
+    order_refs = [f"order-{i}" for i in range(allocations)]
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        store = build(sku, order_refs)
+        gc.collect()
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del store
+    return (after - before) / allocations
+
+
+def main(allocations: int) -> Dict[str, float]:
+    results = {name: bytes_per_allocation(build, allocations) for name, build in STORES.items()}
+    for name, value in results.items():
+        print(f"{name:26} {value:8.1f} bytes/allocation")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure memory used per allocation by each allocation store")
+    parser.add_argument("--allocations", type=int, default=100_000)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    arguments = parser.parse_args()
+
+    measured = main(arguments.allocations)
+    if arguments.output:
+        with open(arguments.output, "w") as file:
+            json.dump({"allocations": arguments.allocations, "bytes_per_allocation": measured}, file, indent=2)
@@ -0,0 +1,219 @@
+import argparse
+import asyncio
+import inspect
+import json
+import platform
+import time
+import tracemalloc
+import uuid
+from dataclasses import asdict, dataclass
+from typing import Any, Awaitable, Callable, Iterable, List, Tuple, Union
+
+from allocation.domain import model
+from allocation.service_layer import messagebus, unit_of_work
+
+from benchmarks import workload as workloads
+
+Setup = Callable[[], Union[Tuple[Any, Iterable], Awaitable[Tuple[Any, Iterable]]]]
+Step = Callable[[Any, Any], Any]
+
+
+@dataclass
+class Result:
+    name: str
+    operations: int
+    seconds: float
+    ops_per_sec: float
+    p50_us: float
+    p95_us: float
+    p99_us: float
+    peak_memory_bytes: int
+
+
+async def _maybe_await(value):
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+def _percentile(ordered: List[float], q: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def measure(name: str, setup: Setup, step: Step) -> Result:
+    state, items = await _maybe_await(setup())
+    latencies = []
+    started = time.perf_counter()
+    for item in items:
+        op_started = time.perf_counter()
+        await _maybe_await(step(state, item))
+        latencies.append(time.perf_counter() - op_started)
+    seconds = time.perf_counter() - started
+
+    tracemalloc.start()
+    try:
+        state, items = await _maybe_await(setup())
+        for item in items:
+            await _maybe_await(step(state, item))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+    return Result(
+        name=name,
+        operations=len(latencies),
+        seconds=seconds,
+        ops_per_sec=len(latencies) / seconds if seconds else 0.0,
+        p50_us=_percentile(latencies, 0.50) * 1e6,
+        p95_us=_percentile(latencies, 0.95) * 1e6,
+        p99_us=_percentile(latencies, 0.99) * 1e6,
+        peak_memory_bytes=peak,
+    )
+
+
+def _allocate(products, line):
+    try:
+        products[line.sku].allocate(line)
+    except model.OutOfStock:
+        pass
+
+
+def domain_benchmarks(workload: workloads.Workload) -> List[Tuple[str, Setup, Step]]:
+    def allocate_setup():
+        return {p.sku: p for p in workload.products()}, workload.order_lines()
+
+    def change_quantity_setup():
+        products = {p.sku: p for p in workload.products()}
+        for line in workload.order_lines():
+            _allocate(products, line)
+        changes = [(b.sku, b.ref, b.qty // 2) for b in workload.batches]
+        return products, changes
+
+    def change_quantity(products, change):
+        sku, ref, qty = change
+        products[sku].change_batch_quantity(ref, qty)
+
+    return [
+        ("product_allocate", allocate_setup, _allocate),
+        ("product_change_batch_quantity", change_quantity_setup, change_quantity),
+    ]
+
+
+def messagebus_benchmarks(workload: workloads.Workload) -> List[Tuple[str, Setup, Step]]:
+    async def setup():
+        uow = unit_of_work.InMemoryUnitOfWork()
+        for event in workload.batches:
+            await messagebus.handle(event, uow)
+        return uow, workload.lines
+
+    async def handle(uow, event):
+        try:
+            await messagebus.handle(event, uow)
+        except model.OutOfStock:
+            pass
+
+    return [("messagebus_handle_in_memory", setup, handle)]
+
+
+def postgres_benchmarks(workload: workloads.Workload, pool) -> List[Tuple[str, Setup, Step]]:
+    from allocation.entrypoints import batch_import
+
+    async def load_setup():
+        await _cleanup(pool, workload)
+        await batch_import.import_batches(pool, workload.batches)
+        return pool, workload.skus
+
+    async def load(pool, sku):
+        async with unit_of_work.PostgresUnitOfWork(pool) as uow:
+            await uow.products.get(sku)
+
+    async def load_lazy(pool, sku):
+        async with unit_of_work.PostgresUnitOfWork(pool, lazy=True) as uow:
+            await uow.products.get(sku)
+
+    async def handle(pool, event):
+        try:
+            await messagebus.handle(event, unit_of_work.PostgresUnitOfWork(pool))
+        except model.OutOfStock:
+            pass
+
+    async def handle_setup():
+        await load_setup()
+        return pool, workload.lines
+
+    return [
+        ("postgres_load_product", load_setup, load),
+        ("postgres_load_product_lazy", load_setup, load_lazy),
+        ("postgres_allocate_and_save", handle_setup, handle),
+    ]
+
+
+async def _cleanup(pool, workload: workloads.Workload) -> None:
+    skus = workload.skus
+    async with pool.acquire() as connection:
+        async with connection.transaction():
+            await connection.execute("DELETE FROM order_lines WHERE sku = any($1::varchar[])", skus)
+            await connection.execute("DELETE FROM batches WHERE sku = any($1::varchar[])", skus)
+            await connection.execute("DELETE FROM products WHERE sku = any($1::varchar[])", skus)
+            await connection.execute("DELETE FROM allocations_view WHERE sku = any($1::varchar[])", skus)
+            await connection.execute("DELETE FROM sku_availability WHERE sku = any($1::varchar[])", skus)
+            await connection.execute("DELETE FROM outbox WHERE payload->>'sku' = any($1::varchar[])", skus)
+
+
+async def main(arguments) -> List[Result]:
+    workload = workloads.generate(
+        arguments.skus, arguments.batches, arguments.lines, seed=arguments.seed,
+        prefix=f"BENCH{uuid.uuid4().hex[:6]}")
+
+    benchmarks = domain_benchmarks(workload) + messagebus_benchmarks(workload)
+
+    pool = None
+    if arguments.postgres:
+        from allocation.adapters import database
+        pool = await database.create_pool()
+        benchmarks += postgres_benchmarks(workload, pool)
+
+    results = []
+    try:
+        for name, setup, step in benchmarks:
+            if arguments.only and name not in arguments.only:
+                continue
+            result = await measure(name, setup, step)
+            results.append(result)
+            print(f"{result.name:34} {result.operations:>8} ops {result.ops_per_sec:>12.1f} ops/s "
+                  f"p50={result.p50_us:.1f}us p95={result.p95_us:.1f}us p99={result.p99_us:.1f}us "
+                  f"peak={result.peak_memory_bytes / 1024 / 1024:.1f}MiB")
+    finally:
+        if pool is not None:
+            await _cleanup(pool, workload)
+            await pool.close()
+
+    if arguments.output:
+        with open(arguments.output, "w") as file:
+            json.dump({
+                "python": platform.python_version(),
+                "workload": {"skus": arguments.skus, "batches": arguments.batches,
+                             "lines": arguments.lines, "seed": arguments.seed},
+                "results": [asdict(result) for result in results],
+            }, file, indent=2)
+
+    return results
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the allocation domain model and message bus")
+    parser.add_argument("--skus", type=int, default=100)
+    parser.add_argument("--batches", type=int, default=20, help="batches per SKU")
+    parser.add_argument("--lines", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--postgres", action="store_true", help="also benchmark the Postgres repository")
+    parser.add_argument("--only", nargs="*", help="run only the named benchmarks")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_arguments()))
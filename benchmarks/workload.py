@@ -0,0 +1,51 @@
+import datetime
+import random
+from dataclasses import dataclass
+from typing import List
+
+from allocation.domain import events, model
+
+
+@dataclass
+class Workload:
+    batches: List[events.BatchCreated]
+    lines: List[events.AllocationRequired]
+
+    @property
+    def skus(self) -> List[str]:
+        return sorted({batch.sku for batch in self.batches})
+
+    def products(self) -> List[model.Product]:
+        by_sku = {}
+        for event in self.batches:
+            batch = model.Batch(event.ref, event.sku, event.qty, event.eta)
+            by_sku.setdefault(event.sku, []).append(batch)
+        return [model.Product(sku, batches) for sku, batches in by_sku.items()]
+
+    def order_lines(self) -> List[model.OrderLine]:
+        return [model.OrderLine(line.order_ref, line.sku, line.qty) for line in self.lines]
+
+
+def generate(
+        skus: int,
+        batches_per_sku: int,
+        lines: int,
+        seed: int = 42,
+        prefix: str = "BENCH",
+        in_stock_share: float = 0.2,
+) -> Workload:
+    rng = random.Random(seed)
+    today = datetime.date(2030, 1, 1)
+    sku_names = [f"{prefix}-SKU-{i}" for i in range(skus)]
+
+    batches = []
+    for sku in sku_names:
+        for b in range(batches_per_sku):
+            eta = None if rng.random() < in_stock_share else today + datetime.timedelta(days=rng.randint(0, 90))
+            batches.append(events.BatchCreated(f"{sku}-batch-{b}", sku, rng.randint(50, 500), eta))
+
+    order_lines = [
+        events.AllocationRequired(f"{prefix}-order-{i}", rng.choice(sku_names), rng.randint(1, 10))
+        for i in range(lines)
+    ]
+    return Workload(batches, order_lines)
@@ -0,0 +1,59 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+
+class LRUCache:
+
+    def __init__(self, maxsize: int = 10_000, ttl: Optional[float] = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._expires: Dict[Hashable, float] = {}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data and not self._expired(key)
+
+    def _expired(self, key: Hashable) -> bool:
+        if self.ttl is None or self._expires[key] > time.monotonic():
+            return False
+        self.invalidate(key)
+        return True
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        if key not in self:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return self._data[key]
+
+    def pop(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        if key not in self:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._expires.pop(key, None)
+        return self._data.pop(key)
+
+    def put(self, key: Hashable, value: Any) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if self.ttl is not None:
+            self._expires[key] = time.monotonic() + self.ttl
+        while len(self._data) > self.maxsize:
+            evicted, _ = self._data.popitem(last=False)
+            self._expires.pop(evicted, None)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+        self._expires.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._expires.clear()
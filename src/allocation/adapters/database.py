@@ -0,0 +1,92 @@
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import asyncpg
+
+from allocation import config, metrics
+
+# Named statements checked against the schema when each pooled connection opens.
+STATEMENTS: Dict[str, str] = {}
+
+
+def statement(name: str, query: str) -> str:
+    if STATEMENTS.setdefault(name, query) != query:
+        raise ValueError(f"Statement {name} is already registered with another query")
+    return query
+
+
+async def check_statements(connection: asyncpg.Connection) -> None:
+    # Startup schema check: a registered statement that no longer matches the
+    # schema fails the pool rather than a request. The statements are not
+    # cached for later queries; fetch/execute still parse each on first use.
+    # Newer asyncpg ends a prepare with Flush rather than Sync, leaving the
+    # parse-time table locks held by an open implicit transaction; the
+    # explicit one releases them.
+    async with connection.transaction():
+        for query in STATEMENTS.values():
+            await connection.prepare(query)
+
+
+# id(pool) -> callers waiting for a connection of that pool.
+_waiting: Dict[int, int] = {}
+
+
+@dataclass(frozen=True)
+class PoolStats:
+    size: int
+    idle: int
+    max_size: int
+    waiting: int
+
+    @property
+    def in_use(self) -> int:
+        return self.size - self.idle
+
+    @property
+    def saturation(self) -> float:
+        return self.in_use / self.max_size if self.max_size else 0.0
+
+
+def stats(pool: asyncpg.Pool) -> PoolStats:
+    return PoolStats(
+        size=pool.get_size(),
+        idle=pool.get_idle_size(),
+        max_size=pool.get_max_size(),
+        waiting=_waiting.get(id(pool), 0),
+    )
+
+
+async def acquire(pool: asyncpg.Pool, timeout: Optional[float] = None) -> asyncpg.Connection:
+    # pool.acquire() timed as pool_acquire, with the pool_waiting and
+    # pool_in_use gauges updated around it.
+    instrumentation = metrics.get()
+    key = id(pool)
+    _waiting[key] = _waiting.get(key, 0) + 1
+    instrumentation.set_gauge("pool_waiting", _waiting[key])
+    try:
+        with instrumentation.timer("pool_acquire"):
+            connection = await pool.acquire(timeout=timeout)
+    finally:
+        waiting = _waiting.pop(key) - 1
+        if waiting:
+            _waiting[key] = waiting
+        instrumentation.set_gauge("pool_waiting", waiting)
+    instrumentation.set_gauge("pool_in_use", pool.get_size() - pool.get_idle_size())
+    return connection
+
+
+async def create_pool(dsn: Optional[str] = None, **overrides) -> asyncpg.Pool:
+    settings = {**config.get_pool_settings(), **overrides}
+    # min_size connections are opened, and their statements prepared, before
+    # the pool is returned.
+    return await asyncpg.create_pool(
+        dsn or config.get_postgres_uri(),
+        min_size=settings["min_size"],
+        max_size=settings["max_size"],
+        max_queries=settings["max_queries"],
+        max_inactive_connection_lifetime=settings["max_inactive_connection_lifetime"],
+        init=check_statements,
+        statement_cache_size=settings["statement_cache_size"],
+        command_timeout=settings["command_timeout"],
+        server_settings={"application_name": settings["application_name"]},
+    )
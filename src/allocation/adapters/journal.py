@@ -0,0 +1,137 @@
+import asyncio
+import glob
+import json
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+class Journal:
+    # Append-only log of committed changes with group commit: entries appended
+    # within one flush interval are written and fsync-ed together. The log is
+    # split into numbered segments; a snapshot records the segment replay starts
+    # from, so older segments can be deleted once the snapshot is durable.
+    # Callbacks given with entries run once they are durable, before the next
+    # snapshot can be taken.
+
+    def __init__(self, directory: str, flush_interval: float = 0.002, snapshot_every: int = 10_000) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.snapshot_every = snapshot_every
+        self.entries_since_snapshot = 0
+
+        self._snapshot_path = os.path.join(directory, "snapshot.json")
+        segments = self._segments()
+        self._segment = segments[-1] if segments else 0
+        self._file = open(self._segment_path(self._segment), "ab")
+        self._pending: List[bytes] = []
+        self._on_durable: List[Callable[[], None]] = []
+        self._waiter: Optional[asyncio.Future] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self._snapshotting = False
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"journal.{segment:08d}.log")
+
+    def _segments(self) -> List[int]:
+        paths = glob.glob(os.path.join(self.directory, "journal.*.log"))
+        return sorted(int(os.path.basename(path).split(".")[1]) for path in paths)
+
+    def recover(self) -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]]]:
+        state, first_segment = None, 0
+        if os.path.exists(self._snapshot_path):
+            with open(self._snapshot_path) as file:
+                snapshot = json.load(file)
+            state, first_segment = snapshot["state"], snapshot["segment"]
+
+        entries = []
+        for segment in self._segments():
+            if segment >= first_segment:
+                entries.extend(self._read_segment(segment))
+        self.entries_since_snapshot = len(entries)
+        return state, entries
+
+    def _read_segment(self, segment: int) -> List[Dict[str, Any]]:
+        path = self._segment_path(segment)
+        entries = []
+        valid_size = 0
+        with open(path, "rb") as file:
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break
+                valid_size += len(line)
+        if segment == self._segment and valid_size != os.path.getsize(path):
+            self._file.truncate(valid_size)
+        return entries
+
+    @property
+    def should_snapshot(self) -> bool:
+        return not self._snapshotting and self.entries_since_snapshot >= self.snapshot_every
+
+    async def append(self, entries: List[Dict[str, Any]], on_durable: Optional[Callable[[], None]] = None) -> None:
+        self._pending.extend(json.dumps(entry).encode() + b"\n" for entry in entries)
+        if on_durable is not None:
+            self._on_durable.append(on_durable)
+        self.entries_since_snapshot += len(entries)
+        if self._waiter is None:
+            self._waiter = asyncio.get_running_loop().create_future()
+            self._flush_task = asyncio.create_task(self._flush_later())
+        await asyncio.shield(self._waiter)
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        async with self._lock:
+            waiter, self._waiter = self._waiter, None
+            lines, self._pending = self._pending, []
+            callbacks, self._on_durable = self._on_durable, []
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self._write, self._file, lines)
+            except Exception as e:
+                waiter.set_exception(e)
+            else:
+                for callback in callbacks:
+                    callback()
+                waiter.set_result(None)
+
+    @staticmethod
+    def _write(file, lines: List[bytes]) -> None:
+        file.write(b"".join(lines))
+        file.flush()
+        os.fsync(file.fileno())
+
+    async def snapshot(self, serialize: Callable[[], Dict[str, Any]]) -> None:
+        # The state includes every durable entry. Entries still pending land in
+        # the new segment and are applied on top of it by recovery.
+        self._snapshotting = True
+        try:
+            async with self._lock:
+                state = serialize()
+                previous_file = self._file
+                self._segment += 1
+                self._file = open(self._segment_path(self._segment), "ab")
+                self.entries_since_snapshot = len(self._pending)
+            previous_file.close()
+            await asyncio.get_running_loop().run_in_executor(None, self._write_snapshot, state, self._segment)
+        finally:
+            self._snapshotting = False
+
+    def _write_snapshot(self, state: Dict[str, Any], segment: int) -> None:
+        temporary_path = self._snapshot_path + ".tmp"
+        with open(temporary_path, "w") as file:
+            json.dump({"segment": segment, "state": state}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self._snapshot_path)
+        for old_segment in self._segments():
+            if old_segment < segment:
+                os.remove(self._segment_path(old_segment))
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            await self._flush_task
+        self._file.close()
@@ -0,0 +1,260 @@
+import asyncio
+import datetime
+import sys
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from allocation.adapters import journal as journal_
+from allocation.adapters import read_model, repository
+from allocation.domain import events, model
+
+ProductRecord = Dict[str, Any]
+
+
+def _dump_eta(eta: Optional[datetime.date]) -> Optional[str]:
+    return eta.isoformat() if eta is not None else None
+
+
+def _load_eta(eta: Optional[str]) -> Optional[datetime.date]:
+    if eta is None:
+        return None
+    if "T" in eta:
+        return datetime.datetime.fromisoformat(eta)
+    return datetime.date.fromisoformat(eta)
+
+
+class InMemoryReadModel(read_model.AbstractReadModel):
+    # The Postgres read model's tables as dicts: (order_ref, sku) -> (qty,
+    # batch_ref) and sku -> (purchased, allocated), with the product version
+    # of the last change to each line kept apart, deallocated lines included.
+
+    def __init__(self) -> None:
+        self.allocations: Dict[Tuple[str, str], Tuple[int, str]] = {}
+        self.availability: Dict[str, Tuple[int, int]] = {}
+        self._versions: Dict[Tuple[str, str], int] = {}
+
+    async def apply(self, event: events.StockChanged) -> None:
+        for line in event.deallocated:
+            key = (line.order_ref, line.sku)
+            if self._versions.get(key, -1) < event.version:
+                self.allocations.pop(key, None)
+                self._versions[key] = event.version
+        for line in event.allocated:
+            key = (line.order_ref, line.sku)
+            if self._versions.get(key, -1) <= event.version:
+                self.allocations[key] = (line.qty, line.batch_ref)
+                self._versions[key] = event.version
+        allocated = read_model.allocated_change(event)
+        if event.purchased or allocated:
+            purchased_before, allocated_before = self.availability.get(event.sku, (0, 0))
+            self.availability[event.sku] = (purchased_before + event.purchased, allocated_before + allocated)
+
+    def rebuild(self, records: Dict[str, ProductRecord]) -> None:
+        self.allocations = {}
+        self.availability = {}
+        self._versions = {}
+        for sku, record in records.items():
+            purchased = allocated = 0
+            for batch in record["batches"].values():
+                purchased += batch["qty"]
+                for order_ref, line_sku, qty in batch["allocations"]:
+                    self.allocations[(order_ref, line_sku)] = (qty, batch["ref"])
+                    self._versions[(order_ref, line_sku)] = record["version"]
+                    allocated += qty
+            self.availability[sku] = (purchased, allocated)
+
+
+class ProductStore:
+    # Committed state is kept as plain records indexed by SKU and batch ref.
+    # Product aggregates are checked out to one unit of work at a time and
+    # checked back in once committed, so the hot path does not rehydrate them.
+
+    def __init__(self, journal: Optional[journal_.Journal] = None) -> None:
+        self.records: Dict[str, ProductRecord] = {}
+        self.batch_index: Dict[str, str] = {}
+        self._live: Dict[str, model.Product] = {}
+        self._journal = journal
+        self._snapshot_task: Optional[asyncio.Task] = None
+        self._committing: Set[str] = set()
+        self.read_model = InMemoryReadModel()
+
+    @classmethod
+    def recover(cls, journal: journal_.Journal) -> "ProductStore":
+        store = cls(journal)
+        snapshot, entries = journal.recover()
+        if snapshot is not None:
+            for sku, record in snapshot["products"].items():
+                for batch in record["batches"].values():
+                    batch["allocations"] = {tuple(line) for line in batch["allocations"]}
+                    store.batch_index[batch["ref"]] = sku
+                store.records[sku] = record
+        for entry in entries:
+            record = store.records.get(entry["sku"])
+            if record is None and entry["created"] or record is not None and record["version"] == entry["expected"]:
+                store.apply(entry)
+        store.read_model.rebuild(store.records)
+        return store
+
+    def find_sku(self, batch_ref: str) -> Optional[str]:
+        return self.batch_index.get(batch_ref)
+
+    def checkout(self, sku: str) -> Optional[model.Product]:
+        product = self._live.pop(sku, None)
+        if product is not None:
+            return product
+        record = self.records.get(sku)
+        if record is not None:
+            return self._hydrate(sku, record)
+
+    def checkin(self, product: model.Product) -> None:
+        record = self.records.get(product.sku)
+        if record is not None and record["version"] == product.persisted_version_number:
+            self._live[product.sku] = product
+
+    @staticmethod
+    def _hydrate(sku: str, record: ProductRecord) -> model.Product:
+        sku = sys.intern(sku)
+        batches = []
+        for batch_record in record["batches"].values():
+            allocations = batch_record["allocations"]
+            compact = len(allocations) > model.COMPACT_ALLOCATIONS_THRESHOLD
+            batch = model.Batch(batch_record["ref"], sku, batch_record["qty"], _load_eta(batch_record["eta"]), compact)
+            for order_ref, line_sku, qty in allocations:
+                batch.allocate(model.OrderLine(order_ref, sku if line_sku == sku else line_sku, qty))
+            batches.append(batch)
+        product = model.Product(sku, batches, record["version"])
+        product.clear_changes()
+        return product
+
+    @staticmethod
+    def changes(product: model.Product, created: bool = False) -> Dict[str, Any]:
+        # A created product has nothing stored yet, so all its batches and
+        # allocations are written, including those it was constructed with.
+        new_batches = set(product.batches if created else product.new_batches)
+        return {
+            "sku": product.sku,
+            "created": created,
+            "expected": product.persisted_version_number,
+            "version": max(product.version_number, product.persisted_version_number + 1),
+            "new_batches": [[b.ref, b.purchased_quantity, _dump_eta(b.eta)] for b in product.batches if b in new_batches],
+            "modified": [
+                [b.ref, b.purchased_quantity, _dump_eta(b.eta)]
+                for b in product.batches if b.is_modified and b not in new_batches
+            ],
+            "removed": [] if created else [
+                [b.ref, line.order_ref, line.sku, line.qty]
+                for b in product.batches for line in b.removed_allocations
+            ],
+            "added": [
+                [b.ref, line.order_ref, line.sku, line.qty]
+                for b in product.batches for line in (b.allocations if created else b.added_allocations)
+            ],
+        }
+
+    def apply(self, entry: Dict[str, Any]) -> None:
+        sku = entry["sku"]
+        if entry["created"]:
+            self.records[sku] = {"version": 0, "batches": {}}
+        record = self.records[sku]
+        batches = record["batches"]
+        for ref, qty, eta in entry["new_batches"]:
+            batches[ref] = {"ref": ref, "qty": qty, "eta": eta, "allocations": set()}
+            self.batch_index[ref] = sku
+        for ref, qty, eta in entry["modified"]:
+            batches[ref]["qty"] = qty
+            batches[ref]["eta"] = eta
+        for ref, order_ref, line_sku, qty in entry["removed"]:
+            batches[ref]["allocations"].discard((order_ref, line_sku, qty))
+        for ref, order_ref, line_sku, qty in entry["added"]:
+            batches[ref]["allocations"].add((order_ref, line_sku, qty))
+        record["version"] = entry["version"]
+
+    async def commit(self, products: Iterable[model.Product], added: Iterable[model.Product] = ()) -> None:
+        # Changes become visible only once they are durable. Until then their
+        # SKUs are reserved, so a concurrent commit of the same product fails
+        # its version check rather than passing it against the old record.
+        added = set(added)
+        changed = []
+        for product in products:
+            created = product in added
+            if product.sku in self._committing:
+                raise repository.ConcurrencyConflict(f"Product {product.sku} is being changed by another transaction")
+            if created:
+                if product.sku in self.records:
+                    raise repository.ConcurrencyConflict(f"Product {product.sku} already exists")
+            elif not product.has_changes:
+                continue
+            elif self.records[product.sku]["version"] != product.persisted_version_number:
+                raise repository.ConcurrencyConflict(f"Product {product.sku} was changed by another transaction")
+            changed.append((product, self.changes(product, created)))
+        if not changed:
+            return
+
+        def apply() -> None:
+            for product, entry in changed:
+                self.apply(entry)
+                product.version_number = entry["version"]
+                product.clear_changes()
+
+        if self._journal is None:
+            apply()
+            return
+
+        skus = {product.sku for product, _ in changed}
+        self._committing.update(skus)
+        try:
+            await self._journal.append([entry for _, entry in changed], apply)
+        finally:
+            self._committing.difference_update(skus)
+        if self._journal.should_snapshot:
+            self._snapshot_task = asyncio.create_task(self._journal.snapshot(self.serialize))
+
+    def serialize(self) -> Dict[str, Any]:
+        return {
+            "products": {
+                sku: {
+                    "version": record["version"],
+                    "batches": {
+                        ref: {**batch, "allocations": sorted(batch["allocations"])}
+                        for ref, batch in record["batches"].items()
+                    },
+                }
+                for sku, record in self.records.items()
+            }
+        }
+
+    async def close(self) -> None:
+        if self._snapshot_task is not None:
+            await self._snapshot_task
+        if self._journal is not None:
+            await self._journal.close()
+
+
+class InMemoryProductRepository(repository.AbstractProductRepository):
+
+    def __init__(self, store: ProductStore) -> None:
+        super().__init__()
+        self._store = store
+        self.added: List[model.Product] = []
+
+    async def _get(self, sku: str) -> Optional[model.Product]:
+        return self._store.checkout(sku)
+
+    async def _get_by_batch_ref(self, batch_ref: str) -> Optional[model.Product]:
+        sku = self._store.find_sku(batch_ref)
+        if sku is not None:
+            return self._store.checkout(sku)
+
+    async def _add(self, product: model.Product) -> None:
+        self.added.append(product)
+
+    async def _load_allocations(self, batches: List[model.Batch]) -> None:
+        # Checked out products hold every allocation already; this serves
+        # lazy batches built by the caller.
+        for batch in batches:
+            sku = self._store.find_sku(batch.ref)
+            allocations = self._store.records[sku]["batches"][batch.ref]["allocations"] if sku is not None else ()
+            batch.load_allocations(model.OrderLine(order_ref, line_sku, qty) for order_ref, line_sku, qty in allocations)
+
+    async def save_changes(self) -> None:
+        await self._store.commit(self.seen, self.added)
+        self.added = []
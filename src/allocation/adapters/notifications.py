@@ -0,0 +1,162 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from allocation import metrics
+from allocation.adapters import email
+
+STOCK_ADDRESS = "stock@made.com"
+
+Send = Callable[..., Awaitable[None]]
+
+
+def out_of_stock_message(skus: List[str]) -> str:
+    if len(skus) == 1:
+        return f'Артикула {skus[0]} нет в наличии'
+    return f'Артикулов {", ".join(skus)} нет в наличии'
+
+
+class Notifier:
+    # Default: every notification is sent inline by the caller.
+
+    def __init__(self, send: Send = email.send) -> None:
+        self._send = send
+
+    async def out_of_stock(self, sku: str) -> None:
+        await self._send(STOCK_ADDRESS, out_of_stock_message([sku]))
+
+
+class NotificationDispatcher(Notifier):
+    # Queues notifications and sends them from a background task as digests of
+    # up to `batch_size` SKUs. A SKU already queued, or sent less than `window`
+    # seconds ago, is merged into that notification; when the queue is full the
+    # notification is dropped rather than blocking the caller.
+
+    def __init__(
+            self,
+            send: Send = email.send,
+            window: float = 60.0,
+            batch_size: int = 100,
+            flush_interval: float = 1.0,
+            max_queue: int = 10_000,
+            clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        super().__init__(send)
+        self.window = window
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._clock = clock
+        self._queue: asyncio.Queue = asyncio.Queue(max_queue)
+        self._queued: Set[str] = set()
+        self._sent_at: Dict[str, float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self) -> "NotificationDispatcher":
+        self.start()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.stop()
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    async def out_of_stock(self, sku: str) -> None:
+        self.notify(sku)
+
+    def notify(self, sku: str) -> bool:
+        instrumentation = metrics.get()
+        sent_at = self._sent_at.get(sku)
+        if sku in self._queued or sent_at is not None and self._clock() - sent_at < self.window:
+            instrumentation.increment("notifications_merged")
+            return False
+        try:
+            self._queue.put_nowait(sku)
+        except asyncio.QueueFull:
+            instrumentation.increment("notifications_dropped")
+            return False
+        self._queued.add(sku)
+        instrumentation.set_gauge("notification_queue_depth", self._queue.qsize())
+        return True
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            # The run loop sends the digest it is collecting when it takes the
+            # sentinel off the queue, so stopping never loses SKUs in flight.
+            if not self._task.done():
+                await self._queue.put(None)
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        while not self._queue.empty():
+            await self.flush()
+
+    async def flush(self) -> int:
+        skus = []
+        while len(skus) < self.batch_size and not self._queue.empty():
+            skus.append(self._queue.get_nowait())
+        if skus:
+            await self._send_digest(skus)
+        return len(skus)
+
+    async def _send_digest(self, skus: List[str]) -> None:
+        instrumentation = metrics.get()
+        self._queued.difference_update(skus)
+        instrumentation.set_gauge("notification_queue_depth", self._queue.qsize())
+        now = self._clock()
+        self._forget_expired(now)
+        for sku in skus:
+            self._sent_at.pop(sku, None)
+            self._sent_at[sku] = now
+        with instrumentation.timer("notification_flush"):
+            await self._send(STOCK_ADDRESS, out_of_stock_message(skus))
+        instrumentation.increment("notifications_sent", len(skus))
+
+    def _forget_expired(self, now: float) -> None:
+        # Send times are kept in insertion order, so expired SKUs are at the front.
+        while self._sent_at:
+            sku, sent_at = next(iter(self._sent_at.items()))
+            if now - sent_at < self.window:
+                break
+            del self._sent_at[sku]
+
+    async def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            sku = await self._queue.get()
+            if sku is None:
+                break
+            skus = [sku]
+            deadline = asyncio.get_running_loop().time() + self.flush_interval
+            while len(skus) < self.batch_size:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    sku = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if sku is None:
+                    stopping = True
+                    break
+                skus.append(sku)
+            try:
+                await self._send_digest(skus)
+            except Exception:
+                pass
+
+
+_notifier: Notifier = Notifier()
+
+
+def get() -> Notifier:
+    return _notifier
+
+
+def configure(notifier: Notifier) -> None:
+    global _notifier
+    _notifier = notifier
@@ -0,0 +1,148 @@
+import asyncio
+import dataclasses
+import datetime
+import json
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import asyncpg
+
+from allocation import metrics
+from allocation.domain import events
+
+
+@dataclasses.dataclass
+class Message:
+    id: int
+    event_type: str
+    payload: Dict[str, Any]
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def serialize(event: events.Event) -> Tuple[str, str]:
+    return type(event).__name__, json.dumps(dataclasses.asdict(event), default=_default)
+
+
+async def add(connection: asyncpg.Connection, new_events: Iterable[events.Event]) -> None:
+    rows = [serialize(event) for event in new_events]
+    if rows:
+        with metrics.get().timer("outbox_add"):
+            await connection.executemany("INSERT INTO outbox (event_type, payload) VALUES ($1, $2::jsonb)", rows)
+
+
+class AbstractTransport(ABC):
+
+    @abstractmethod
+    async def publish(self, messages: List[Message]) -> None:
+        raise NotImplementedError
+
+
+class InMemoryTransport(AbstractTransport):
+
+    def __init__(self) -> None:
+        self.published: List[Message] = []
+
+    async def publish(self, messages: List[Message]) -> None:
+        self.published.extend(messages)
+
+
+class ConsoleTransport(AbstractTransport):
+
+    async def publish(self, messages: List[Message]) -> None:
+        for message in messages:
+            print("PUBLISHING EVENT:", message.event_type, json.dumps(message.payload))
+
+
+TRANSPORTS = {
+    "console": ConsoleTransport,
+}
+
+
+def transport(name: str) -> AbstractTransport:
+    if name not in TRANSPORTS:
+        raise ValueError(f"Unknown outbox transport {name}")
+    return TRANSPORTS[name]()
+
+
+class Publisher:
+    # Claims pending outbox rows with FOR UPDATE SKIP LOCKED, so several
+    # publishers can share the table, and marks them published in the same
+    # transaction once the transport accepted them. A transport failure rolls
+    # the claim back and the rows are retried on the next poll.
+
+    def __init__(
+            self,
+            pool: asyncpg.Pool,
+            transport: AbstractTransport,
+            batch_size: int = 100,
+            poll_interval: float = 0.5,
+    ) -> None:
+        self._pool = pool
+        self._transport = transport
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self) -> "Publisher":
+        self.start()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.stop()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def publish_pending(self) -> int:
+        claim = """
+            SELECT id, event_type, payload
+              FROM outbox
+             WHERE published_at IS NULL
+             ORDER BY id
+             LIMIT $1
+               FOR UPDATE SKIP LOCKED
+        """
+
+        instrumentation = metrics.get()
+        async with self._pool.acquire() as connection:
+            async with connection.transaction():
+                rows = await connection.fetch(claim, self.batch_size)
+                if not rows:
+                    return 0
+                messages = [Message(row["id"], row["event_type"], json.loads(row["payload"])) for row in rows]
+                with instrumentation.timer("outbox_publish"):
+                    await self._transport.publish(messages)
+                await connection.execute(
+                    "UPDATE outbox SET published_at = now() WHERE id = any($1::bigint[])",
+                    [message.id for message in messages])
+        instrumentation.increment("outbox_published", len(messages))
+        return len(messages)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                published = await self.publish_pending()
+            except Exception:
+                published = 0
+            if published < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
@@ -0,0 +1,123 @@
+from abc import ABC, abstractmethod
+from typing import Tuple
+
+import asyncpg
+
+from allocation import metrics
+from allocation.adapters import database
+from allocation.domain import events
+
+ALLOCATIONS = database.statement("allocations_view", """
+    SELECT sku, batch_ref
+      FROM allocations_view
+     WHERE order_ref = $1 AND batch_ref IS NOT NULL
+     ORDER BY sku
+""")
+
+AVAILABILITY = database.statement("sku_availability", """
+    SELECT purchased, allocated, purchased - allocated AS available
+      FROM sku_availability
+     WHERE sku = $1
+""")
+
+# A deallocated line keeps its row, with no batch, as the version it was
+# deallocated at; an older allocation applied after it is then ignored.
+DEALLOCATE_ALLOCATIONS = database.statement("deallocate_allocations_view", """
+    INSERT INTO allocations_view (order_ref, sku, qty, batch_ref, version)
+    VALUES ($1, $2, $3, NULL, $4)
+        ON CONFLICT (order_ref, sku) DO UPDATE
+       SET qty = excluded.qty, batch_ref = NULL, version = excluded.version
+     WHERE allocations_view.version < excluded.version
+""")
+
+UPSERT_ALLOCATIONS = database.statement("upsert_allocations_view", """
+    INSERT INTO allocations_view (order_ref, sku, qty, batch_ref, version)
+    VALUES ($1, $2, $3, $4, $5)
+        ON CONFLICT (order_ref, sku) DO UPDATE
+       SET qty = excluded.qty, batch_ref = excluded.batch_ref, version = excluded.version
+     WHERE allocations_view.version <= excluded.version
+""")
+
+ADJUST_AVAILABILITY = database.statement("adjust_sku_availability", """
+    INSERT INTO sku_availability (sku, purchased, allocated)
+    VALUES ($1, $2, $3)
+        ON CONFLICT (sku) DO UPDATE
+       SET purchased = sku_availability.purchased + excluded.purchased,
+           allocated = sku_availability.allocated + excluded.allocated
+""")
+
+REBUILD = [
+    "LOCK TABLE batches, order_lines, allocations IN SHARE MODE",
+    "TRUNCATE allocations_view, sku_availability",
+    """
+    INSERT INTO allocations_view (order_ref, sku, qty, batch_ref, version)
+    SELECT ol.order_ref, ol.sku, ol.qty, b.batch_ref, p.version_number
+      FROM allocations a
+      JOIN order_lines ol ON ol.id = a.order_line_id
+      JOIN batches b ON b.id = a.batch_id
+      JOIN products p ON p.sku = b.sku
+        ON CONFLICT DO NOTHING
+    """,
+    """
+    INSERT INTO sku_availability (sku, purchased, allocated)
+    SELECT b.sku, sum(b.qty), coalesce(sum(al.qty), 0)
+      FROM batches b
+      LEFT JOIN (
+            SELECT a.batch_id, sum(ol.qty) AS qty
+              FROM allocations a
+              JOIN order_lines ol ON ol.id = a.order_line_id
+             GROUP BY a.batch_id
+           ) al ON al.batch_id = b.id
+     GROUP BY b.sku
+    """,
+]
+
+
+def allocated_change(event: events.StockChanged) -> int:
+    return sum(line.qty for line in event.allocated) - sum(line.qty for line in event.deallocated)
+
+
+class AbstractReadModel(ABC):
+
+    @abstractmethod
+    async def apply(self, event: events.StockChanged) -> None:
+        raise NotImplementedError
+
+
+class PostgresReadModel(AbstractReadModel):
+    # Flat tables answering the query side with one primary key lookup:
+    # allocations_view by (order_ref, sku) and sku_availability by sku.
+    # allocations_view rows only move forward in product version, so events
+    # of one product may be applied in any order; availability is kept as
+    # sums of deltas, which commute.
+
+    def __init__(self, connection: asyncpg.Connection) -> None:
+        self._connection = connection
+
+    async def apply(self, event: events.StockChanged) -> None:
+        with metrics.get().timer("read_model_apply"):
+            if event.deallocated:
+                await self._connection.executemany(
+                    DEALLOCATE_ALLOCATIONS,
+                    [(line.order_ref, line.sku, line.qty, event.version) for line in event.deallocated])
+            if event.allocated:
+                await self._connection.executemany(
+                    UPSERT_ALLOCATIONS,
+                    [(line.order_ref, line.sku, line.qty, line.batch_ref, event.version) for line in event.allocated])
+            allocated = allocated_change(event)
+            if event.purchased or allocated:
+                await self._connection.execute(ADJUST_AVAILABILITY, event.sku, event.purchased, allocated)
+
+
+async def rebuild(connection: asyncpg.Connection) -> Tuple[int, int]:
+    # Regenerates both tables from the write tables in one snapshot. Writers
+    # wait for it; events of transactions that committed before it started
+    # and are applied after it are counted twice by sku_availability, so run
+    # it with the writers stopped.
+    with metrics.get().timer("read_model_rebuild"):
+        async with connection.transaction(isolation="repeatable_read"):
+            for statement in REBUILD:
+                await connection.execute(statement)
+            allocations = await connection.fetchval("SELECT count(*) FROM allocations_view")
+            skus = await connection.fetchval("SELECT count(*) FROM sku_availability")
+    return allocations, skus
@@ -1,10 +1,225 @@
+import asyncio
+import sys
 from abc import ABC, abstractmethod
-from typing import Optional, Set, List
+from typing import Dict, Iterable, Optional, Set, List, Tuple
 
 import asyncpg
 
+from allocation import metrics
+from allocation.adapters import cache, database
 from allocation.domain import model
 
+batch_sku_cache = cache.LRUCache(maxsize=100_000)
+# (order_ref, sku) -> (qty, batch_ref) of lines known to be allocated.
+allocations_cache = cache.LRUCache(maxsize=100_000)
+
+
+class ConcurrencyConflict(Exception):
+    pass
+
+
+def cached_batch_refs(lines: List[model.OrderLine]) -> List[Optional[str]]:
+    results: List[Optional[str]] = []
+    for line in lines:
+        cached = allocations_cache.get((line.order_ref, line.sku))
+        results.append(cached[1] if cached is not None and cached[0] == line.qty else None)
+    metrics.get().increment("allocation_idempotency", len(lines) - results.count(None), result="cache")
+    return results
+
+
+def _product_query(condition: str, lazy: bool) -> str:
+    if lazy:
+        allocations = "coalesce(sum(ol.qty), 0) AS allocated_quantity"
+    else:
+        allocations = "array_agg(row(ol.order_ref, ol.sku, ol.qty)) AS allocations"
+    return f"""
+        SELECT b.id AS id,
+               b.batch_ref AS batch_ref,
+               b.sku AS sku,
+               b.qty AS qty,
+               b.eta AS eta,
+               p.version_number AS version_number,
+               {allocations}
+        FROM products p
+        JOIN batches b ON b.sku = p.sku
+        LEFT JOIN allocations a ON b.id = a.batch_id
+        LEFT JOIN order_lines ol ON ol.id = a.order_line_id
+        WHERE {condition}
+        GROUP BY b.id, p.version_number
+    """
+
+
+GET = database.statement("get", _product_query("p.sku = $1", lazy=False))
+GET_LAZY = database.statement("get_lazy", _product_query("p.sku = $1", lazy=True))
+GET_BY_BATCH_REF = database.statement(
+    "get_by_batch_ref", _product_query("p.sku = (SELECT sku FROM batches WHERE batch_ref = $1)", lazy=False))
+GET_BY_BATCH_REF_LAZY = database.statement(
+    "get_by_batch_ref_lazy", _product_query("p.sku = (SELECT sku FROM batches WHERE batch_ref = $1)", lazy=True))
+LOAD_PRODUCTS = database.statement("load_products", _product_query("p.sku = any($1::varchar[])", lazy=False))
+LOAD_PRODUCTS_LAZY = database.statement("load_products_lazy", _product_query("p.sku = any($1::varchar[])", lazy=True))
+
+LOAD_ALLOCATIONS = database.statement("load_allocations", """
+    SELECT b.batch_ref AS batch_ref,
+           ol.order_ref AS order_ref,
+           ol.sku AS sku,
+           ol.qty AS qty
+    FROM batches b
+    JOIN allocations a ON a.batch_id = b.id
+    JOIN order_lines ol ON ol.id = a.order_line_id
+    WHERE b.batch_ref = any($1::varchar[])
+""")
+
+FIND_ALLOCATIONS = database.statement("find_allocations", """
+    SELECT r.order_ref AS order_ref,
+           r.sku AS sku,
+           r.qty AS qty,
+           b.batch_ref AS batch_ref
+    FROM unnest($1::varchar[], $2::varchar[], $3::integer[]) AS r (order_ref, sku, qty)
+    JOIN order_lines ol ON ol.order_ref = r.order_ref AND ol.sku = r.sku AND ol.qty = r.qty
+    JOIN allocations a ON a.order_line_id = ol.id
+    JOIN batches b ON b.id = a.batch_id
+""")
+
+BATCH_SKU = database.statement("batch_sku", "SELECT sku FROM batches WHERE batch_ref = $1")
+
+INSERT_PRODUCT = database.statement("insert_product", "INSERT INTO products (sku, version_number) VALUES ($1, $2)")
+
+INSERT_PRODUCT_BATCHES = database.statement("insert_product_batches", """
+    WITH ib AS (
+        INSERT INTO batches (batch_ref, sku, qty, eta) 
+        VALUES ($1, $2, $3, $4)
+        RETURNING id
+    ), iol AS (
+        INSERT INTO order_lines (order_ref, sku, qty) 
+        (
+            SELECT r.order_ref, r.sku, r.qty
+            FROM unnest($5::order_lines[]) as r 
+        )
+        RETURNING id, sku
+    )
+    INSERT INTO allocations (order_line_id, batch_id, sku)
+    (
+        SELECT iol.id, (SELECT * FROM ib), iol.sku
+        FROM iol
+    )
+""")
+
+UPDATE_VERSION = database.statement("update_version", """
+    UPDATE products
+       SET version_number = $3
+     WHERE sku = $1 AND version_number = $2
+     RETURNING version_number
+""")
+
+INSERT_BATCHES = database.statement("insert_batches", """
+    INSERT INTO batches (batch_ref, sku, qty, eta)
+    VALUES ($1, $2, $3, $4)
+""")
+
+UPDATE_BATCHES = database.statement("update_batches", """
+    UPDATE batches
+       SET qty = $2, eta = $3
+     WHERE batch_ref = $1
+""")
+
+DELETE_ALLOCATIONS = database.statement("delete_allocations", """
+    DELETE FROM order_lines ol
+     USING allocations a, batches b
+     WHERE a.order_line_id = ol.id
+       AND a.batch_id = b.id
+       AND b.batch_ref = $1
+       AND ol.order_ref = $2
+       AND ol.sku = $3
+       AND ol.qty = $4
+""")
+
+INSERT_ALLOCATIONS = database.statement("insert_allocations", """
+    WITH iol AS (
+        INSERT INTO order_lines (order_ref, sku, qty)
+        VALUES ($2, $3, $4)
+        RETURNING id, sku
+    )
+    INSERT INTO allocations (order_line_id, batch_id, sku)
+    SELECT iol.id, b.id, iol.sku
+    FROM iol, batches b
+    WHERE b.batch_ref = $1
+""")
+
+
+class ProductLoader:
+    # Product lookups issued by concurrent units of work within `window`
+    # seconds of the first are fetched with one `sku = any(...)` query and
+    # the rows fanned back out; every caller hydrates its own Product. The
+    # query runs on a connection of `pool`, outside every caller's
+    # transaction. Callers hold their own connection while they wait, so give
+    # the loader a pool of its own rather than the units of work's pool.
+
+    def __init__(self, pool: asyncpg.Pool, window: float = 0.001, max_batch: int = 500) -> None:
+        self._pool = pool
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: Dict[bool, Tuple[Dict[str, asyncio.Future], asyncio.TimerHandle]] = {}
+        self._running: Set[asyncio.Task] = set()
+
+    async def load(self, sku: str, lazy: bool = False) -> List[asyncpg.Record]:
+        loop = asyncio.get_running_loop()
+        pending = self._pending.get(lazy)
+        if pending is None:
+            pending = self._pending[lazy] = ({}, loop.call_later(self.window, self._flush, lazy))
+        futures = pending[0]
+        future = futures.get(sku)
+        if future is None:
+            future = futures[sku] = loop.create_future()
+            if len(futures) >= self.max_batch:
+                self._flush(lazy)
+        # Shielded: callers asking for the same SKU share one future.
+        return await asyncio.shield(future)
+
+    def _flush(self, lazy: bool) -> None:
+        futures, timer = self._pending.pop(lazy)
+        timer.cancel()
+        task = asyncio.create_task(self._fetch(futures, lazy))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _fetch(self, futures: Dict[str, asyncio.Future], lazy: bool) -> None:
+        metrics.get().increment("product_loader_batches")
+        metrics.get().increment("product_loader_skus", len(futures))
+        try:
+            async with self._pool.acquire() as connection:
+                with metrics.get().timer("repository_query", query="load_products_lazy" if lazy else "load_products"):
+                    rows = await connection.fetch(LOAD_PRODUCTS_LAZY if lazy else LOAD_PRODUCTS, list(futures))
+        except Exception as e:
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        rows_by_sku: Dict[str, List[asyncpg.Record]] = {sku: [] for sku in futures}
+        for row in rows:
+            rows_by_sku[row["sku"]].append(row)
+        for sku, future in futures.items():
+            if not future.done():
+                future.set_result(rows_by_sku[sku])
+
+
+class BatchSkus:
+    # Finds the SKU of a batch before any unit of work exists, for routing:
+    # batch_sku_cache first, then one indexed lookup on a pooled connection.
+
+    def __init__(self, pool: asyncpg.Pool) -> None:
+        self._pool = pool
+
+    async def __call__(self, batch_ref: str) -> Optional[str]:
+        sku = batch_sku_cache.get(batch_ref)
+        if sku is None:
+            async with self._pool.acquire() as connection:
+                with metrics.get().timer("repository_query", query="batch_sku"):
+                    sku = await connection.fetchval(BATCH_SKU, batch_ref)
+            if sku is not None:
+                batch_sku_cache.put(batch_ref, sku)
+        return sku
+
 
 class AbstractProductRepository(ABC):
     def __init__(self):
@@ -26,6 +241,15 @@ class AbstractProductRepository(ABC):
             self.seen.add(product)
         return product
 
+    async def load_allocations(self, product: model.Product, batch_refs: Optional[Iterable[str]] = None) -> None:
+        refs = set(batch_refs) if batch_refs is not None else None
+        batches = [b for b in product.batches if not b.is_loaded and (refs is None or b.ref in refs)]
+        if batches:
+            await self._load_allocations(batches)
+
+    async def allocated_batch_refs(self, lines: List[model.OrderLine]) -> List[Optional[str]]:
+        return [None] * len(lines)
+
     @abstractmethod
     async def _get_by_batch_ref(self, batch_ref: str) -> model.Product:
         ...
@@ -38,78 +262,146 @@ class AbstractProductRepository(ABC):
     async def _add(self, product: model.Product) -> None:
         ...
 
+    @abstractmethod
+    async def _load_allocations(self, batches: List[model.Batch]) -> None:
+        ...
 
-class PostgresProductRepository(AbstractProductRepository):
 
-    def __init__(self, connection: asyncpg.Connection) -> None:
+class PostgresProductRepository(AbstractProductRepository):
+    # With `lazy` set, batches are hydrated with their allocated quantity
+    # summed in SQL instead of one row per allocation; the allocations
+    # themselves are fetched by `load_allocations` when a caller needs them.
+
+    def __init__(
+            self,
+            connection: asyncpg.Connection,
+            products_cache: Optional[cache.LRUCache] = None,
+            lazy: bool = False,
+            loader: Optional[ProductLoader] = None,
+    ) -> None:
         super().__init__()
         self._connection = connection
+        self._products_cache = products_cache
+        self._lazy = lazy
+        self._loader = loader
+        self._allocated: List[Tuple[Tuple[str, str], int, str]] = []
+        self._deallocated: List[Tuple[str, str]] = []
+        # Products known to match the database: read or version-checked in
+        # this transaction. Only these may go back to the products cache.
+        self.confirmed: Set[model.Product] = set()
+
+    async def _run(self, name: str, method, query: str, *args):
+        with metrics.get().timer("repository_query", query=name):
+            return await method(query, *args)
 
     async def _get(self, sku: str) -> Optional[model.Product]:
-        query = """
-            WITH find_product AS (
-                SELECT sku
-                FROM products
-                WHERE sku = $1 
-            )
-            SELECT b.id AS id,
-                   b.batch_ref AS batch_ref, 
-                   b.sku AS sku, 
-                   b.qty AS qty, 
-                   b.eta AS eta, 
-                   array_agg(row(ol.order_ref, ol.sku, ol.qty)) AS allocations
-            FROM batches b
-            LEFT JOIN allocations a ON b.id = a.batch_id
-            LEFT JOIN order_lines ol ON ol.id = a.order_line_id
-            WHERE b.sku = (SELECT sku FROM find_product)
-            GROUP BY b.id                    
-        """
-
-        product_batches_rows = await self._connection.fetch(query, sku)
+        if self._products_cache is not None:
+            product = self._products_cache.pop(sku)
+            if product is not None:
+                if not self._lazy:
+                    await self.load_allocations(product)
+                return product
+
+        if self._loader is not None:
+            return self._confirm(self._hydrate(await self._loader.load(sku, self._lazy)))
+
+        if self._lazy:
+            product_batches_rows = await self._run("get_lazy", self._connection.fetch, GET_LAZY, sku)
+        else:
+            product_batches_rows = await self._run("get", self._connection.fetch, GET, sku)
+        return self._confirm(self._hydrate(product_batches_rows))
+
+    def _confirm(self, product: Optional[model.Product]) -> Optional[model.Product]:
+        if product is not None:
+            self.confirmed.add(product)
+        return product
 
+    async def _get_by_batch_ref(self, batch_ref: str) -> Optional[model.Product]:
+        sku = batch_sku_cache.get(batch_ref)
+        if sku is not None:
+            product = await self._get(sku)
+            if product is not None and any(b.ref == batch_ref for b in product.batches):
+                return product
+            batch_sku_cache.invalidate(batch_ref)
+
+        if self._lazy:
+            product_batches_rows = await self._run(
+                "get_by_batch_ref_lazy", self._connection.fetch, GET_BY_BATCH_REF_LAZY, batch_ref)
+        else:
+            product_batches_rows = await self._run("get_by_batch_ref", self._connection.fetch, GET_BY_BATCH_REF, batch_ref)
+        return self._confirm(self._hydrate(product_batches_rows))
+
+    async def _load_allocations(self, batches: List[model.Batch]) -> None:
+        rows = await self._run("load_allocations", self._connection.fetch, LOAD_ALLOCATIONS, [b.ref for b in batches])
+        lines: Dict[str, List[model.OrderLine]] = {b.ref: [] for b in batches}
+        for row in rows:
+            sku = sys.intern(row["sku"])
+            lines[row["batch_ref"]].append(model.OrderLine(row["order_ref"], sku, row["qty"]))
+        for batch in batches:
+            batch.load_allocations(lines[batch.ref])
+
+    async def allocated_batch_refs(self, lines: List[model.OrderLine]) -> List[Optional[str]]:
+        # Duplicate allocation requests are answered from the in-process
+        # cache or one indexed lookup, without loading the product.
+        results = cached_batch_refs(lines)
+        missed = [position for position, batch_ref in enumerate(results) if batch_ref is None]
+        if not missed:
+            return results
+
+        rows = await self._run(
+            "find_allocations", self._connection.fetch, FIND_ALLOCATIONS,
+            [lines[p].order_ref for p in missed], [lines[p].sku for p in missed], [lines[p].qty for p in missed])
+        found = {(row["order_ref"], row["sku"], row["qty"]): row["batch_ref"] for row in rows}
+        for position in missed:
+            line = lines[position]
+            batch_ref = found.get((line.order_ref, line.sku, line.qty))
+            if batch_ref is not None:
+                allocations_cache.put((line.order_ref, line.sku), (line.qty, batch_ref))
+                results[position] = batch_ref
+        metrics.get().increment("allocation_idempotency", len(found), result="database")
+        metrics.get().increment("allocation_idempotency", len(missed) - len(found), result="miss")
+        return results
+
+    def remember_allocations(self) -> None:
+        # Called once the transaction that saved the changes has committed.
+        for key in self._deallocated:
+            allocations_cache.invalidate(key)
+        for key, qty, batch_ref in self._allocated:
+            allocations_cache.put(key, (qty, batch_ref))
+        self._allocated = []
+        self._deallocated = []
+
+    @staticmethod
+    def _hydrate(product_batches_rows) -> Optional[model.Product]:
         if len(product_batches_rows) != 0:
             batches = []
 
             for batch_row in product_batches_rows:
-                batch = model.Batch(batch_row["batch_ref"], batch_row["sku"], batch_row["qty"], batch_row["eta"])
+                sku = sys.intern(batch_row["sku"])
+                allocations = batch_row.get("allocations")
+                if allocations is None:
+                    batch = model.Batch(
+                        batch_row["batch_ref"], sku, batch_row["qty"], batch_row["eta"],
+                        allocated_quantity=batch_row["allocated_quantity"])
+                    allocations = []
+                else:
+                    compact = len(allocations) > model.COMPACT_ALLOCATIONS_THRESHOLD
+                    batch = model.Batch(batch_row["batch_ref"], sku, batch_row["qty"], batch_row["eta"], compact)
                 batches.append(batch)
+                batch_sku_cache.put(batch.ref, batch.sku)
 
-                for order_line_row in batch_row["allocations"]:
-                    order_line = model.OrderLine(*order_line_row)
-                    if batch.can_allocate(order_line):
-                        batch.allocations.add(order_line)
+                for order_ref, line_sku, qty in allocations:
+                    order_line = model.OrderLine(order_ref, sku if line_sku == sku else line_sku, qty)
+                    batch.allocate(order_line)
 
-            product = model.Product(sku, batches)
+            product = model.Product(batches[0].sku, batches, product_batches_rows[0]["version_number"])
+            product.clear_changes()
 
             return product
 
-    async def _get_by_batch_ref(self, batch_ref: str) -> model.Product:
-        query = """SELECT sku FROM batches WHERE batch_ref = $1 LIMIT 1"""
-        product_sku = await self._connection.fetchval(query, batch_ref)
-        return await self._get(product_sku)
-
     async def _add(self, product: model.Product) -> None:
-        await self._connection.execute("INSERT INTO products VALUES ($1)", product.sku)
-
-        query = """
-            WITH ib AS (
-                INSERT INTO batches (batch_ref, sku, qty, eta) 
-                VALUES ($1, $2, $3, $4)
-                RETURNING id
-            ), iol AS (
-                INSERT INTO order_lines (order_ref, sku, qty) 
-                (
-                    SELECT r.order_ref, r.sku, r.qty
-                    FROM unnest($5::order_lines[]) as r 
-                )
-                RETURNING id
-            )
-            INSERT INTO allocations (order_line_id, batch_id)
-            (
-                SELECT iol.id, (SELECT * FROM ib)
-                FROM iol
-            )
-        """
+        await self._run(
+            "insert_product", self._connection.execute, INSERT_PRODUCT, product.sku, product.version_number)
 
         allocations_groups = []
 
@@ -121,49 +413,68 @@ class PostgresProductRepository(AbstractProductRepository):
             allocation_group = [batch.ref, batch.sku, batch.purchased_quantity, batch.eta, allocations_rows]
             allocations_groups.append(allocation_group)
 
-        await self._connection.executemany(query, allocations_groups)
+        await self._run("insert_product_batches", self._connection.executemany, INSERT_PRODUCT_BATCHES, allocations_groups)
+        for batch in product.batches:
+            batch_sku_cache.put(batch.ref, batch.sku)
+        product.clear_changes()
+        self.confirmed.add(product)
 
     async def save_changes(self) -> None:
-        while len(self.seen) != 0:
-            product = self.seen.pop()
-
-            delete_order_lines = """
-                        DELETE FROM order_lines
-                        WHERE order_ref <> any($1::varchar[])
-                    """
-
-            update_batch = """
-                        WITH ub AS (
-                            UPDATE batches
-                               SET batch_ref = $2, qty = $3, eta = $4
-                             WHERE sku = $1
-                             RETURNING id
-                        ), iol AS (
-                            INSERT INTO order_lines (sku, qty, order_ref) 
-                            (
-                                SELECT r.sku, r.qty, r.order_ref
-                                FROM unnest($5::order_lines[]) as r 
-                            )
-                            ON CONFLICT DO NOTHING 
-                            RETURNING id
-                        )
-                        INSERT INTO allocations (order_line_id, batch_id)
-                        SELECT iol.id, (SELECT * FROM ub)
-                        FROM iol
-                    """
-
-            batches_rows = []
-            actual_order_lines = []
+        for product in self.seen:
+            if not product.has_changes:
+                continue
 
-            for batch in product.batches:
-                batch_row = [product.sku, batch.ref, batch.purchased_quantity, batch.eta]
-                lines_rows = []
+            product.version_number = max(product.version_number, product.persisted_version_number + 1)
+            updated = await self._run(
+                "update_version", self._connection.fetchval, UPDATE_VERSION, product.sku, product.persisted_version_number, product.version_number)
+            if updated is None:
+                raise ConcurrencyConflict(f"Product {product.sku} was changed by another transaction")
+            self.confirmed.add(product)
 
-                for line in batch.allocations:
-                    lines_rows.append((None, line.sku, line.qty, line.order_ref))
-                    actual_order_lines.append(line.order_ref)
+            new_batches = set(product.new_batches)
 
-                batches_rows.append([*batch_row, lines_rows])
+            batches_rows = [(b.ref, b.sku, b.purchased_quantity, b.eta) for b in product.new_batches]
+            modified_rows = []
+            removed_rows = []
+            added_rows = []
 
-            await self._connection.execute(delete_order_lines, actual_order_lines)
-            await self._connection.executemany(update_batch, batches_rows)
+            for batch in product.batches:
+                if batch.is_modified and batch not in new_batches:
+                    modified_rows.append((batch.ref, batch.purchased_quantity, batch.eta))
+                for line in batch.removed_allocations:
+                    removed_rows.append((batch.ref, line.order_ref, line.sku, line.qty))
+                for line in batch.added_allocations:
+                    added_rows.append((batch.ref, line.order_ref, line.sku, line.qty))
+
+            if batches_rows:
+                await self._run("insert_batches", self._connection.executemany, INSERT_BATCHES, batches_rows)
+                for batch in product.new_batches:
+                    batch_sku_cache.put(batch.ref, batch.sku)
+            if modified_rows:
+                await self._run("update_batches", self._connection.executemany, UPDATE_BATCHES, modified_rows)
+            if removed_rows:
+                await self._run("delete_allocations", self._connection.executemany, DELETE_ALLOCATIONS, removed_rows)
+                self._deallocated.extend((order_ref, sku) for _, order_ref, sku, _ in removed_rows)
+            if added_rows:
+                await self._run("insert_allocations", self._connection.executemany, INSERT_ALLOCATIONS, added_rows)
+                self._allocated.extend(((order_ref, sku), qty, ref) for ref, order_ref, sku, qty in added_rows)
+
+            product.clear_changes()
+
+
+class ReadOnlyProductRepository:
+    # Query-side access to products, possibly on a replica: lookups only,
+    # with no add or save_changes and no shared product cache to fill with
+    # snapshots that may lag the primary.
+
+    def __init__(self, connection: asyncpg.Connection, lazy: bool = False) -> None:
+        self._products = PostgresProductRepository(connection, lazy=lazy)
+
+    async def get(self, sku: str) -> Optional[model.Product]:
+        return await self._products.get(sku)
+
+    async def get_by_batch_ref(self, batch_ref: str) -> Optional[model.Product]:
+        return await self._products.get_by_batch_ref(batch_ref)
+
+    async def load_allocations(self, product: model.Product, batch_refs: Optional[Iterable[str]] = None) -> None:
+        await self._products.load_allocations(product, batch_refs)
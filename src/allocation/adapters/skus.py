@@ -0,0 +1,139 @@
+import asyncio
+import hashlib
+import math
+from typing import Iterable, Optional, Set
+
+import asyncpg
+
+from allocation import metrics
+
+
+class BloomFilter:
+    # Fixed-size membership filter: no false negatives, false positives at
+    # about `error_rate` once `capacity` items were added.
+
+    def __init__(self, capacity: int, error_rate: float = 0.001) -> None:
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str) -> Iterable[int]:
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:], "big") | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, item: str) -> None:
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class SkuFilter:
+    # Default: nothing is known, so every SKU may exist and is looked up.
+
+    def might_exist(self, sku: str) -> bool:
+        return True
+
+    def add(self, sku: str) -> None:
+        pass
+
+
+class KnownSkus(SkuFilter):
+    # Process-local set of the SKUs in the products table, or a Bloom filter
+    # when `bloom_capacity` is given. Until the first load every SKU may exist.
+    # The background refresh rebuilds the structure, dropping retired SKUs and
+    # picking up products created by other processes; SKUs added while it
+    # runs are carried over.
+
+    def __init__(
+            self,
+            pool: asyncpg.Pool,
+            refresh_interval: float = 60.0,
+            bloom_capacity: Optional[int] = None,
+            prefetch: int = 10_000,
+    ) -> None:
+        self._pool = pool
+        self.refresh_interval = refresh_interval
+        self.bloom_capacity = bloom_capacity
+        self.prefetch = prefetch
+        self._skus = None
+        self._added_during_refresh: Optional[Set[str]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self) -> "KnownSkus":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.stop()
+
+    @property
+    def loaded(self) -> bool:
+        return self._skus is not None
+
+    def _empty(self):
+        return BloomFilter(self.bloom_capacity) if self.bloom_capacity else set()
+
+    def might_exist(self, sku: str) -> bool:
+        if self._skus is None or sku in self._skus:
+            return True
+        metrics.get().increment("unknown_sku_rejections")
+        return False
+
+    def add(self, sku: str) -> None:
+        if self._skus is not None:
+            self._skus.add(sku)
+        if self._added_during_refresh is not None:
+            self._added_during_refresh.add(sku)
+
+    async def refresh(self) -> int:
+        skus = self._empty()
+        count = 0
+        self._added_during_refresh = set()
+        try:
+            with metrics.get().timer("known_skus_refresh"):
+                async with self._pool.acquire() as connection:
+                    async with connection.transaction(readonly=True):
+                        async for record in connection.cursor("SELECT sku FROM products", prefetch=self.prefetch):
+                            skus.add(record["sku"])
+                            count += 1
+            for sku in self._added_during_refresh:
+                skus.add(sku)
+            self._skus = skus
+        finally:
+            self._added_during_refresh = None
+        metrics.get().set_gauge("known_skus", count)
+        return count
+
+    async def start(self) -> None:
+        await self.refresh()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception:
+                pass
+
+
+_filter: SkuFilter = SkuFilter()
+
+
+def get() -> SkuFilter:
+    return _filter
+
+
+def configure(sku_filter: SkuFilter) -> None:
+    global _filter
+    _filter = sku_filter
@@ -7,3 +7,53 @@ def get_postgres_uri():
     password = os.environ.get("DB_PASSWORD", "abc123")
     user, db_name = "allocation", "allocation"
     return f"postgres://{user}:{password}@{host}:{port}/{db_name}"
+
+
+def get_replica_uri():
+    host = os.environ.get("DB_REPLICA_HOST")
+    if not host:
+        return None
+    port = int(os.environ.get("DB_REPLICA_PORT", 5432))
+    password = os.environ.get("DB_PASSWORD", "abc123")
+    user, db_name = "allocation", "allocation"
+    return f"postgres://{user}:{password}@{host}:{port}/{db_name}"
+
+
+def get_eviction_order():
+    return os.environ.get("EVICTION_ORDER", "largest-first")
+
+
+def get_known_skus_bloom_capacity():
+    capacity = os.environ.get("KNOWN_SKUS_BLOOM_CAPACITY")
+    return int(capacity) if capacity else None
+
+
+def get_product_cache_settings():
+    # The products cache is off unless PRODUCT_CACHE_SIZE is set.
+    size = os.environ.get("PRODUCT_CACHE_SIZE")
+    if not size:
+        return None
+    ttl = os.environ.get("PRODUCT_CACHE_TTL", "60")
+    return {"maxsize": int(size), "ttl": float(ttl) if ttl else None}
+
+
+def get_outbox_transport():
+    # Outbox rows stay unpublished until a transport is named.
+    return os.environ.get("OUTBOX_TRANSPORT") or None
+
+
+def get_lazy_loading():
+    return os.environ.get("LAZY_LOADING", "false").lower() in ("1", "true", "yes")
+
+
+def get_pool_settings():
+    command_timeout = os.environ.get("DB_COMMAND_TIMEOUT")
+    return {
+        "min_size": int(os.environ.get("DB_POOL_MIN_SIZE", 10)),
+        "max_size": int(os.environ.get("DB_POOL_MAX_SIZE", 10)),
+        "max_queries": int(os.environ.get("DB_POOL_MAX_QUERIES", 50_000)),
+        "max_inactive_connection_lifetime": float(os.environ.get("DB_POOL_MAX_INACTIVE_LIFETIME", 300.0)),
+        "statement_cache_size": int(os.environ.get("DB_STATEMENT_CACHE_SIZE", 256)),
+        "command_timeout": float(command_timeout) if command_timeout else None,
+        "application_name": os.environ.get("DB_APPLICATION_NAME", "allocation"),
+    }
@@ -1,18 +1,18 @@
 from dataclasses import dataclass
 from datetime import date
-from typing import Optional
+from typing import Optional, List
 
 
 class Event:
-    pass
+    __slots__ = ()
 
 
-@dataclass
+@dataclass(slots=True)
 class OutOfStock(Event):
     sku: str
 
 
-@dataclass
+@dataclass(slots=True)
 class BatchCreated(Event):
     ref: str
     sku: str
@@ -20,14 +20,45 @@ class BatchCreated(Event):
     eta: Optional[date] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class BatchQuantityChanged(Event):
     ref: str
     qty: int
+    sku: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class AllocationRequired(Event):
     order_ref: str
     sku: str
     qty: int
+
+
+@dataclass(slots=True)
+class AllocationsRequired(Event):
+    lines: List[AllocationRequired]
+
+
+@dataclass(slots=True)
+class Allocated(Event):
+    order_ref: str
+    sku: str
+    qty: int
+    batch_ref: str
+
+
+@dataclass(slots=True)
+class Deallocated(Event):
+    order_ref: str
+    sku: str
+    qty: int
+    batch_ref: str
+
+
+@dataclass(slots=True)
+class StockChanged(Event):
+    sku: str
+    version: int
+    purchased: int
+    allocated: List[Allocated]
+    deallocated: List[Deallocated]
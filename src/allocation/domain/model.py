@@ -1,6 +1,9 @@
+import bisect
 import datetime
+import itertools
+from collections.abc import MutableSet
 from dataclasses import dataclass
-from typing import Optional, Set, List
+from typing import Any, Callable, Dict, Iterator, Optional, Set, List, Tuple, Iterable
 
 from allocation.domain import events
 
@@ -13,21 +16,117 @@ class NotAllocated(Exception):
     pass
 
 
-@dataclass(unsafe_hash=True)
+class AllocationsNotLoaded(Exception):
+    pass
+
+
+COMPACT_ALLOCATIONS_THRESHOLD = 1000
+
+
+def _eta_key(eta: Optional[datetime.date]) -> Optional[datetime.datetime]:
+    # Batches read from Postgres carry datetimes, new ones may carry dates.
+    if eta is None or isinstance(eta, datetime.datetime):
+        return eta
+    return datetime.datetime.combine(eta, datetime.time.min)
+
+
+@dataclass(unsafe_hash=True, slots=True)
 class OrderLine:
     order_ref: str
     sku: str
     qty: int
 
 
+def largest_first(line: OrderLine) -> Any:
+    return -line.qty, line.order_ref
+
+
+def smallest_first(line: OrderLine) -> Any:
+    return line.qty, line.order_ref
+
+
+EVICTION_ORDERS: Dict[str, Callable[[OrderLine], Any]] = {
+    "largest-first": largest_first,
+    "smallest-first": smallest_first,
+}
+
+
+class CompactAllocations(MutableSet):
+    # Set of order lines of a single SKU stored as order_ref -> qty, without an
+    # OrderLine object per allocation. Lines repeating an order ref with another
+    # qty are rare and kept in an ordinary set.
+    __slots__ = ("sku", "_quantities", "_overflow")
+
+    def __init__(self, sku: str, lines: Iterable[OrderLine] = ()) -> None:
+        self.sku = sku
+        self._quantities: Dict[str, int] = {}
+        self._overflow: Set[OrderLine] = set()
+        for line in lines:
+            self.add(line)
+
+    def __contains__(self, line) -> bool:
+        if not isinstance(line, OrderLine) or line.sku != self.sku:
+            return False
+        return self._quantities.get(line.order_ref) == line.qty or line in self._overflow
+
+    def __iter__(self) -> Iterator[OrderLine]:
+        for order_ref, qty in self._quantities.items():
+            yield OrderLine(order_ref, self.sku, qty)
+        yield from self._overflow
+
+    def __len__(self) -> int:
+        return len(self._quantities) + len(self._overflow)
+
+    def add(self, line: OrderLine) -> None:
+        if line.sku != self.sku:
+            raise ValueError(f"Order line for sku {line.sku} in allocations of sku {self.sku}")
+        qty = self._quantities.setdefault(line.order_ref, line.qty)
+        if qty != line.qty:
+            self._overflow.add(line)
+
+    def discard(self, line: OrderLine) -> None:
+        if line.sku == self.sku and self._quantities.get(line.order_ref) == line.qty:
+            del self._quantities[line.order_ref]
+        else:
+            self._overflow.discard(line)
+
+    def pop(self) -> OrderLine:
+        if self._overflow:
+            return self._overflow.pop()
+        order_ref, qty = self._quantities.popitem()
+        return OrderLine(order_ref, self.sku, qty)
+
+
 class Batch:
-    def __init__(self, batch_ref: str, sku: str, qty: int, eta: Optional[datetime.date]) -> None:
+    __slots__ = (
+        "ref", "sku", "eta", "_purchased_quantity", "_allocated_quantity", "_allocations",
+        "_added_allocations", "_removed_allocations", "_modified", "_loaded",
+    )
+
+    def __init__(
+            self,
+            batch_ref: str,
+            sku: str,
+            qty: int,
+            eta: Optional[datetime.date],
+            compact_allocations: bool = False,
+            allocated_quantity: Optional[int] = None,
+    ) -> None:
         self.ref = batch_ref
         self.sku = sku
         self.eta = eta
 
+        # A batch built from a known allocated quantity is lazy: until its
+        # persisted allocations are loaded, `_allocations` only holds lines
+        # allocated since, and duplicates of persisted lines go unnoticed.
         self._purchased_quantity = qty
-        self._allocations: Set[OrderLine] = set()
+        self._allocated_quantity = allocated_quantity or 0
+        self._allocations: MutableSet = CompactAllocations(sku) if compact_allocations else set()
+        self._loaded = allocated_quantity is None
+
+        self._added_allocations: Set[OrderLine] = set()
+        self._removed_allocations: Set[OrderLine] = set()
+        self._modified = False
 
     def __repr__(self) -> str:
         return f'<Batch {self.ref}>'
@@ -45,19 +144,35 @@ class Batch:
             return False
         if other.eta is None:
             return True
-        return self.eta > other.eta
+        return _eta_key(self.eta) > _eta_key(other.eta)
 
     def allocate(self, line: OrderLine) -> None:
-        if self.can_allocate(line):
+        if self.can_allocate(line) and line not in self._allocations:
             self._allocations.add(line)
+            self._allocated_quantity += line.qty
+            self._track_added(line)
 
     def deallocate(self, line: OrderLine) -> None:
-        if line in self._allocations:
+        if line in self.allocations:
             self._allocations.remove(line)
+            self._allocated_quantity -= line.qty
+            self._track_removed(line)
+
+    def _track_added(self, line: OrderLine) -> None:
+        if line in self._removed_allocations:
+            self._removed_allocations.remove(line)
+        else:
+            self._added_allocations.add(line)
+
+    def _track_removed(self, line: OrderLine) -> None:
+        if line in self._added_allocations:
+            self._added_allocations.remove(line)
+        else:
+            self._removed_allocations.add(line)
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> int:
@@ -67,42 +182,180 @@ class Batch:
         return self.sku == line.sku and self.available_quantity >= line.qty
 
     @property
-    def allocations(self) -> Set[OrderLine]:
+    def allocations(self) -> MutableSet:
+        if not self._loaded:
+            raise AllocationsNotLoaded(f"Allocations of batch {self.ref} are not loaded")
         return self._allocations
 
+    @property
+    def is_loaded(self) -> bool:
+        return self._loaded
+
+    def load_allocations(self, lines: Iterable[OrderLine]) -> None:
+        if self._loaded:
+            return
+        lines = list(lines)
+        allocations = CompactAllocations(self.sku) if len(lines) > COMPACT_ALLOCATIONS_THRESHOLD else set()
+        for line in itertools.chain(lines, self._allocations):
+            allocations.add(line)
+        self._allocations = allocations
+        self._loaded = True
+
     @property
     def purchased_quantity(self) -> int:
         return self._purchased_quantity
 
-    def deallocate_one(self) -> OrderLine:
-        return self._allocations.pop()
+    def change_purchased_quantity(self, qty: int) -> None:
+        if qty != self._purchased_quantity:
+            self._purchased_quantity = qty
+            self._modified = True
+
+    def evict(self, order: Callable[[OrderLine], Any] = largest_first) -> List[OrderLine]:
+        shortfall = -self.available_quantity
+        evicted = []
+        for line in sorted(self.allocations, key=order):
+            if shortfall <= 0:
+                break
+            evicted.append(line)
+            shortfall -= line.qty
+        for line in evicted:
+            self.deallocate(line)
+        return evicted
+
+    @property
+    def added_allocations(self) -> Set[OrderLine]:
+        return self._added_allocations
+
+    @property
+    def removed_allocations(self) -> Set[OrderLine]:
+        return self._removed_allocations
+
+    @property
+    def is_modified(self) -> bool:
+        return self._modified
+
+    def clear_changes(self) -> None:
+        self._added_allocations = set()
+        self._removed_allocations = set()
+        self._modified = False
 
 
 class Product:
+    __slots__ = (
+        "sku", "batches", "version_number", "persisted_version_number", "events", "new_batches",
+        "_sequence", "_keys", "_available", "_purchased_change",
+    )
 
-    def __init__(self, sku: str, batches: List[Batch]) -> None:
+    def __init__(self, sku: str, batches: List[Batch], version_number: int = 0) -> None:
         self.sku = sku
         self.batches = batches
+        self.version_number = version_number
+        self.persisted_version_number = version_number
         self.events: List[events.Event] = []
+        self.new_batches: List[Batch] = []
+        self._purchased_change = 0
+
+        # Batches with free capacity, kept in allocation preference order:
+        # warehouse stock first, then by ETA, then by insertion order.
+        self._sequence = itertools.count()
+        self._keys = {}
+        self._available: List[Tuple[tuple, Batch]] = []
+        for batch in batches:
+            self._index(batch)
+
+    def _index(self, batch: Batch) -> None:
+        eta = _eta_key(batch.eta)
+        self._keys[batch.ref] = (eta is not None, eta, next(self._sequence))
+        self._sync(batch)
+
+    def _sync(self, batch: Batch) -> None:
+        key = self._keys[batch.ref]
+        position = bisect.bisect_left(self._available, (key,))
+        indexed = position < len(self._available) and self._available[position][0] == key
+        if batch.available_quantity > 0 and not indexed:
+            self._available.insert(position, (key, batch))
+        elif batch.available_quantity <= 0 and indexed:
+            del self._available[position]
+
+    def add_batch(self, batch: Batch) -> None:
+        self.batches.append(batch)
+        self.new_batches.append(batch)
+        self._purchased_change += batch.purchased_quantity
+        self._index(batch)
+        self.version_number += 1
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(self.new_batches) or any(
+            batch.is_modified or batch.added_allocations or batch.removed_allocations
+            for batch in self.batches
+        )
+
+    def clear_changes(self) -> None:
+        self.persisted_version_number = self.version_number
+        self.new_batches = []
+        self._purchased_change = 0
+        for batch in self.batches:
+            batch.clear_changes()
+
+    def stock_changed(self) -> Optional[events.StockChanged]:
+        # Everything pending since the last commit as one event, rather than
+        # one per order line, so a burst of allocations costs the read model
+        # a single update.
+        deallocated = [
+            events.Deallocated(line.order_ref, line.sku, line.qty, batch.ref)
+            for batch in self.batches for line in batch.removed_allocations
+        ]
+        allocated = [
+            events.Allocated(line.order_ref, line.sku, line.qty, batch.ref)
+            for batch in self.batches for line in batch.added_allocations
+        ]
+        if allocated or deallocated or self._purchased_change:
+            return events.StockChanged(self.sku, self.version_number, self._purchased_change, allocated, deallocated)
+        return None
+
+    def _allocate(self, line: OrderLine) -> Optional[str]:
+        batch = next((batch for _, batch in self._available if batch.can_allocate(line)), None)
+        if batch is None:
+            return None
+        batch.allocate(line)
+        self._sync(batch)
+        self.version_number += 1
+        return batch.ref
 
     def allocate(self, line: OrderLine) -> str:
-        try:
-            batch = next(batch for batch in sorted(self.batches) if batch.can_allocate(line))
-            batch.allocate(line)
-            return batch.ref
-        except StopIteration:
+        batch_ref = self._allocate(line)
+        if batch_ref is None:
             raise OutOfStock(f"Out of stock for sku {line.sku}")
+        return batch_ref
+
+    def allocate_many(self, lines: Iterable[OrderLine]) -> List[Optional[str]]:
+        return [self._allocate(line) for line in lines]
 
     def deallocate(self, line: OrderLine) -> None:
         try:
             batch = next(batch for batch in self.batches if line in batch.allocations)
             batch.deallocate(line)
+            self._sync(batch)
+            self.version_number += 1
         except StopIteration:
             self.events.append(events.OutOfStock(sku=line.sku))
 
-    def change_batch_quantity(self, ref: str, qty: int):
+    def requires_allocations(self, ref: str, qty: int) -> bool:
+        batch = next(b for b in self.batches if b.ref == ref)
+        return not batch.is_loaded and batch.allocated_quantity > qty
+
+    def change_batch_quantity(self, ref: str, qty: int, eviction_order: Callable[[OrderLine], Any] = largest_first):
+        if self.requires_allocations(ref, qty):
+            raise AllocationsNotLoaded(f"Allocations of batch {ref} are needed to reduce it to {qty}")
         batch = next(b for b in self.batches if b.ref == ref)
-        batch._purchased_quantity = qty
-        while batch.available_quantity < 0:
-            line = batch.deallocate_one()
-            self.events.append(events.AllocationRequired(line.order_ref, line.sku, line.qty))
+        self._purchased_change += qty - batch.purchased_quantity
+        batch.change_purchased_quantity(qty)
+        evicted = batch.evict(eviction_order) if batch.available_quantity < 0 else []
+        self._sync(batch)
+        self.version_number += 1
+        # Evicted lines go back through the usual allocation order, which may
+        # put a small line back into the slack left on the shrunk batch itself.
+        for line in sorted(evicted, key=largest_first):
+            if self._allocate(line) is None:
+                self.events.append(events.AllocationRequired(line.order_ref, line.sku, line.qty))
@@ -0,0 +1,265 @@
+import argparse
+import asyncio
+import json
+from http import HTTPStatus
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional, Tuple
+from urllib.parse import unquote
+
+import asyncpg
+
+from allocation import config, metrics, migrations
+from allocation.adapters import cache, database, notifications, outbox, repository, skus
+from allocation.domain import events
+from allocation.entrypoints import batch_import
+from allocation.service_layer import handlers, messagebus, unit_of_work, views
+
+MAX_BODY_SIZE = 1 << 20
+
+Response = Tuple[int, Any]
+Request = Tuple[str, str, str, Dict[str, str], bytes]
+
+
+class BadRequest(Exception):
+    pass
+
+
+def _field(body: Mapping[str, Any], name: str, kind: type) -> Any:
+    value = body.get(name)
+    if not isinstance(value, kind) or isinstance(value, bool):
+        raise BadRequest(f"Field {name} must be {kind.__name__}")
+    return value
+
+
+def _quantity(body: Mapping[str, Any], minimum: int) -> int:
+    qty = _field(body, "qty", int)
+    if qty < minimum:
+        raise BadRequest(f"Field qty must be at least {minimum}")
+    return qty
+
+
+async def read_request(reader: asyncio.StreamReader) -> Optional[Request]:
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, target, version = request_line.decode("latin-1").split()
+    except ValueError:
+        raise BadRequest("Malformed request line")
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    if "transfer-encoding" in headers:
+        raise BadRequest("Transfer-Encoding is not supported")
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise BadRequest("Malformed Content-Length")
+    if not 0 <= length <= MAX_BODY_SIZE:
+        raise BadRequest("Request body too large")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), target.split("?", 1)[0], version, headers, body
+
+
+def encode_response(status: int, payload: Any, keep_alive: bool) -> bytes:
+    body = json.dumps(payload).encode()
+    head = (
+        f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+        f"Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    )
+    return head.encode("latin-1") + body
+
+
+def _keep_alive(version: str, headers: Dict[str, str]) -> bool:
+    connection = headers.get("connection", "").lower()
+    if version == "HTTP/1.0":
+        return connection == "keep-alive"
+    return connection != "close"
+
+
+class Application:
+    # Minimal HTTP/1.1 server on asyncio streams: JSON bodies framed by
+    # Content-Length, with connections kept open between requests.
+
+    def __init__(
+            self,
+            pool: asyncpg.Pool,
+            products_cache: Optional[cache.LRUCache] = None,
+            batch_window: float = 0.002,
+            max_batch: int = 100,
+            lazy: bool = False,
+            replica_pool: Optional[asyncpg.Pool] = None,
+            loader: Optional[repository.ProductLoader] = None,
+    ) -> None:
+        self._pool = pool
+        self._replica_pool = replica_pool
+        self._products_cache = products_cache
+        self._lazy = lazy
+        self._loader = loader
+        self.batcher = messagebus.AllocationBatcher(self.uow, batch_window, max_batch)
+        self._routes: Dict[Tuple[str, str], Callable[[Dict[str, Any]], Awaitable[Response]]] = {
+            ("POST", "/allocate"): self.allocate,
+            ("POST", "/add_batch"): self.add_batch,
+            ("POST", "/change_quantity"): self.change_quantity,
+        }
+
+    def uow(self) -> unit_of_work.PostgresUnitOfWork:
+        return unit_of_work.PostgresUnitOfWork(self._pool, self._products_cache, self._lazy, self._loader)
+
+    def read_uow(self) -> unit_of_work.ReadOnlyUnitOfWork:
+        return unit_of_work.ReadOnlyUnitOfWork(self._pool, self._replica_pool, self._lazy)
+
+    async def allocate(self, body: Dict[str, Any]) -> Response:
+        event = events.AllocationRequired(_field(body, "order_ref", str), _field(body, "sku", str), _quantity(body, 1))
+        try:
+            batch_ref = await self.batcher.allocate(event)
+        except handlers.InvalidSku as e:
+            return 400, {"message": str(e)}
+        if batch_ref is None:
+            return 400, {"message": f"Out of stock for sku {event.sku}"}
+        return 201, {"batch_ref": batch_ref}
+
+    async def add_batch(self, body: Dict[str, Any]) -> Response:
+        try:
+            eta = batch_import.parse_eta(body.get("eta"))
+        except (TypeError, ValueError):
+            raise BadRequest("Field eta must be an ISO date")
+        event = events.BatchCreated(_field(body, "ref", str), _field(body, "sku", str), _quantity(body, 0), eta)
+        try:
+            await messagebus.handle(event, self.uow())
+        except asyncpg.UniqueViolationError:
+            return 409, {"message": f"Batch {event.ref} already exists"}
+        return 201, {"ref": event.ref}
+
+    async def change_quantity(self, body: Dict[str, Any]) -> Response:
+        event = events.BatchQuantityChanged(_field(body, "ref", str), _quantity(body, 0))
+        try:
+            await messagebus.handle(event, self.uow())
+        except handlers.InvalidBatchRef as e:
+            return 404, {"message": str(e)}
+        return 200, {"ref": event.ref, "qty": event.qty}
+
+    async def get_allocations(self, order_ref: str) -> Response:
+        result = await views.allocations(order_ref, self.read_uow())
+        if not result:
+            return 404, {"message": f"No allocations for order {order_ref}"}
+        return 200, result
+
+    async def get_availability(self, sku: str) -> Response:
+        result = await views.availability(sku, self.read_uow())
+        if result is None:
+            return 404, {"message": f"No stock for sku {sku}"}
+        return 200, result
+
+    async def dispatch(self, method: str, path: str, body: bytes) -> Response:
+        if method == "GET" and path.startswith("/allocations/"):
+            with metrics.get().timer("http_request", method=method, path="/allocations/{order_ref}"):
+                return await self.get_allocations(unquote(path[len("/allocations/"):]))
+        if method == "GET" and path.startswith("/availability/"):
+            with metrics.get().timer("http_request", method=method, path="/availability/{sku}"):
+                return await self.get_availability(unquote(path[len("/availability/"):]))
+
+        route = self._routes.get((method, path))
+        if route is None:
+            return 404, {"message": f"No route for {method} {path}"}
+        try:
+            payload = json.loads(body) if body else {}
+        except ValueError:
+            raise BadRequest("Request body is not valid JSON")
+        if not isinstance(payload, dict):
+            raise BadRequest("Request body must be a JSON object")
+        with metrics.get().timer("http_request", method=method, path=path):
+            return await route(payload)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except BadRequest as e:
+                    writer.write(encode_response(400, {"message": str(e)}, keep_alive=False))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+
+                method, path, version, headers, body = request
+                try:
+                    status, payload = await self.dispatch(method, path, body)
+                except BadRequest as e:
+                    status, payload = 400, {"message": str(e)}
+                except Exception:
+                    status, payload = 500, {"message": "Internal server error"}
+
+                keep_alive = _keep_alive(version, headers)
+                writer.write(encode_response(status, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8000) -> asyncio.AbstractServer:
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    async def close(self) -> None:
+        await self.batcher.drain()
+
+
+async def main(host: str, port: int, batch_window: float) -> None:
+    pool = await database.create_pool()
+    try:
+        await migrations.check_indexes(pool)
+    except migrations.MissingIndexes:
+        await pool.close()
+        raise
+    replica_uri = config.get_replica_uri()
+    # No connections are opened up front, so an unreachable replica does not
+    # stop the service; reads fall back to the primary until it answers.
+    replica_pool = await database.create_pool(replica_uri, min_size=0) if replica_uri else None
+    loader_pool = await database.create_pool(min_size=1, max_size=2)
+    dispatcher = notifications.NotificationDispatcher()
+    notifications.configure(dispatcher)
+    known_skus = skus.KnownSkus(pool, bloom_capacity=config.get_known_skus_bloom_capacity())
+    skus.configure(known_skus)
+    transport_name = config.get_outbox_transport()
+    publisher = outbox.Publisher(pool, outbox.transport(transport_name)) if transport_name else None
+    cache_settings = config.get_product_cache_settings()
+    products_cache = cache.LRUCache(**cache_settings) if cache_settings else None
+    app = Application(pool, products_cache, batch_window=batch_window, lazy=config.get_lazy_loading(),
+                      replica_pool=replica_pool, loader=repository.ProductLoader(loader_pool))
+    try:
+        async with dispatcher, known_skus:
+            if publisher is not None:
+                publisher.start()
+            server = await app.serve(host, port)
+            async with server:
+                await server.serve_forever()
+    finally:
+        if publisher is not None:
+            await publisher.stop()
+        await app.close()
+        if replica_pool is not None:
+            await replica_pool.close()
+        await loader_pool.close()
+        await pool.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the allocation HTTP API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--batch-window", type=float, default=0.002,
+                        help="seconds to wait for more allocations of the same SKU")
+    arguments = parser.parse_args()
+
+    asyncio.run(main(arguments.host, arguments.port, arguments.batch_window))
@@ -0,0 +1,195 @@
+import argparse
+import asyncio
+import csv
+import datetime
+import json
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterable, AsyncIterator, Iterable, List, Mapping, Optional, Tuple, Union
+
+import asyncpg
+
+from allocation.adapters import database
+from allocation.domain import events
+
+Record = Tuple[str, str, int, Optional[datetime.datetime]]
+
+
+class InvalidRecord(Exception):
+    pass
+
+
+@dataclass
+class ChunkStats:
+    number: int
+    received: int
+    inserted: int
+    rejected: int
+    seconds: float
+
+
+@dataclass
+class ImportStats:
+    chunks: List[ChunkStats] = field(default_factory=list)
+
+    @property
+    def inserted(self) -> int:
+        return sum(chunk.inserted for chunk in self.chunks)
+
+    @property
+    def rejected(self) -> int:
+        return sum(chunk.rejected for chunk in self.chunks)
+
+
+async def read_csv(path: str) -> AsyncIterator[Mapping[str, Any]]:
+    with open(path, newline="") as file:
+        for row in csv.DictReader(file):
+            yield row
+
+
+async def read_jsonl(path: str) -> AsyncIterator[Mapping[str, Any]]:
+    with open(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                yield {}
+
+
+def parse_eta(value: Union[None, str, datetime.date]) -> Optional[datetime.datetime]:
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime.combine(value, datetime.time())
+    return datetime.datetime.fromisoformat(value)
+
+
+def to_record(item: Union[events.BatchCreated, Mapping[str, Any]]) -> Record:
+    try:
+        if isinstance(item, events.BatchCreated):
+            ref, sku, qty, eta = item.ref, item.sku, item.qty, item.eta
+        else:
+            ref, sku, qty, eta = item["ref"], item["sku"], int(item["qty"]), item.get("eta")
+        record = (ref, sku, qty, parse_eta(eta))
+    except (KeyError, TypeError, ValueError) as e:
+        raise InvalidRecord(f"Invalid batch record {item!r}") from e
+
+    if not ref or not sku or qty < 0:
+        raise InvalidRecord(f"Invalid batch record {item!r}")
+    return record
+
+
+async def _iterate(items: Iterable) -> AsyncIterator:
+    for item in items:
+        yield item
+
+
+async def _chunks(items: AsyncIterable, size: int) -> AsyncIterator[Tuple[List[Record], int]]:
+    chunk: List[Record] = []
+    rejected = 0
+    async for item in items:
+        try:
+            chunk.append(to_record(item))
+        except InvalidRecord:
+            rejected += 1
+        if len(chunk) + rejected >= size:
+            yield chunk, rejected
+            chunk, rejected = [], 0
+    if chunk or rejected:
+        yield chunk, rejected
+
+
+async def import_batches(
+        pool: asyncpg.Pool,
+        items: Union[AsyncIterable, Iterable],
+        chunk_size: int = 10_000,
+) -> ImportStats:
+    create_staging = """
+        CREATE TEMPORARY TABLE IF NOT EXISTS batches_staging (
+            batch_ref   varchar,
+            sku         varchar,
+            qty         integer,
+            eta         timestamp
+        ) ON COMMIT DELETE ROWS
+    """
+
+    merge_products = """
+        INSERT INTO products (sku)
+        SELECT DISTINCT sku FROM batches_staging
+        ON CONFLICT (sku) DO UPDATE SET version_number = products.version_number + 1
+    """
+
+    # The read model's availability takes the purchased quantity of the
+    # batches actually inserted, in the same statement.
+    merge_batches = """
+        WITH ib AS (
+            INSERT INTO batches (batch_ref, sku, qty, eta)
+            SELECT DISTINCT ON (batch_ref) batch_ref, sku, qty, eta
+            FROM batches_staging
+            ORDER BY batch_ref
+            ON CONFLICT (batch_ref) DO NOTHING
+            RETURNING sku, qty
+        ), availability AS (
+            INSERT INTO sku_availability (sku, purchased, allocated)
+            SELECT sku, sum(qty), 0
+            FROM ib
+            GROUP BY sku
+            ON CONFLICT (sku) DO UPDATE SET purchased = sku_availability.purchased + excluded.purchased
+        )
+        SELECT count(*) FROM ib
+    """
+
+    if not hasattr(items, "__aiter__"):
+        items = _iterate(items)
+
+    stats = ImportStats()
+
+    async with pool.acquire() as connection:
+        await connection.execute(create_staging)
+
+        async for records, rejected in _chunks(items, chunk_size):
+            started = time.perf_counter()
+            inserted = 0
+
+            if records:
+                async with connection.transaction():
+                    await connection.copy_records_to_table(
+                        "batches_staging", records=records, columns=("batch_ref", "sku", "qty", "eta"))
+                    await connection.execute(merge_products)
+                    inserted = await connection.fetchval(merge_batches)
+
+            stats.chunks.append(ChunkStats(
+                number=len(stats.chunks) + 1,
+                received=len(records) + rejected,
+                inserted=inserted,
+                rejected=rejected + len(records) - inserted,
+                seconds=time.perf_counter() - started,
+            ))
+
+    return stats
+
+
+async def main(path: str, chunk_size: int) -> ImportStats:
+    reader = read_jsonl if path.endswith(".jsonl") else read_csv
+    pool = await database.create_pool()
+    try:
+        return await import_batches(pool, reader(path), chunk_size=chunk_size)
+    finally:
+        await pool.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import batches from a CSV or JSONL file")
+    parser.add_argument("path")
+    parser.add_argument("--chunk-size", type=int, default=10_000)
+    arguments = parser.parse_args()
+
+    result = asyncio.run(main(arguments.path, arguments.chunk_size))
+    for chunk in result.chunks:
+        print(f"chunk {chunk.number}: received={chunk.received} inserted={chunk.inserted} "
+              f"rejected={chunk.rejected} seconds={chunk.seconds:.3f}")
+    print(f"total: inserted={result.inserted} rejected={result.rejected}")
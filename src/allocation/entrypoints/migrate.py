@@ -0,0 +1,43 @@
+import argparse
+import asyncio
+from typing import Optional
+
+import asyncpg
+
+from allocation import config, migrations
+from allocation.adapters import read_model
+
+
+async def main(target: Optional[int], undo: bool, partitions: Optional[int], rebuild: bool = False) -> None:
+    connection = await asyncpg.connect(dsn=config.get_postgres_uri())
+    try:
+        if undo:
+            for version in await migrations.rollback(connection, target or 0):
+                print(f"undone {version}")
+            return
+        for version in await migrations.migrate(connection, target):
+            print(f"applied {version}")
+        if partitions:
+            await migrations.partition_by_sku(connection, partitions)
+            print(f"order_lines and allocations partitioned by sku into {partitions} partitions")
+        if rebuild:
+            allocations, skus = await read_model.rebuild(connection)
+            print(f"read model rebuilt: {allocations} allocations, {skus} skus")
+        missing = await migrations.missing_indexes(connection)
+        for table, columns in missing:
+            print(f"missing index: {table}({', '.join(columns)})")
+    finally:
+        await connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply or undo database migrations")
+    parser.add_argument("--target", type=int, help="migrate up or down to this version")
+    parser.add_argument("--undo", action="store_true", help="undo migrations above --target")
+    parser.add_argument("--partition-by-sku", type=int, metavar="PARTITIONS", dest="partitions",
+                        help="hash partition order_lines and allocations by sku")
+    parser.add_argument("--rebuild-read-model", action="store_true", dest="rebuild",
+                        help="regenerate allocations_view and sku_availability from the write tables")
+    arguments = parser.parse_args()
+
+    asyncio.run(main(arguments.target, arguments.undo, arguments.partitions, arguments.rebuild))
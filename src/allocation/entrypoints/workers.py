@@ -0,0 +1,347 @@
+import asyncio
+import bisect
+import hashlib
+import multiprocessing
+import pickle
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+import asyncpg
+
+from allocation import config, metrics
+from allocation.adapters import database, repository
+from allocation.domain import events
+from allocation.service_layer import messagebus
+
+
+class WorkerLost(Exception):
+    pass
+
+
+class HashRing:
+    # Consistent hashing: each node owns `replicas` points on the ring and a
+    # key belongs to the first point after its hash, so adding or removing a
+    # node only moves the keys of that node.
+
+    def __init__(self, nodes: Iterable[int] = (), replicas: int = 64) -> None:
+        self.replicas = replicas
+        self._points: List[Tuple[int, int]] = []
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+    @property
+    def nodes(self) -> List[int]:
+        return sorted({node for _, node in self._points})
+
+    def add(self, node: int) -> None:
+        for replica in range(self.replicas):
+            point = (self._hash(f"{node}:{replica}"), node)
+            position = bisect.bisect_left(self._points, point)
+            if position == len(self._points) or self._points[position] != point:
+                self._points.insert(position, point)
+
+    def remove(self, node: int) -> None:
+        self._points = [point for point in self._points if point[1] != node]
+
+    def node_for(self, key: Hashable) -> int:
+        if not self._points:
+            raise WorkerLost("No workers available")
+        position = bisect.bisect(self._points, (self._hash(str(key)), -1))
+        return self._points[position % len(self._points)][1]
+
+
+@dataclass
+class WorkerStats:
+    worker_id: int
+    pid: Optional[int] = None
+    handled: int = 0
+    failed: int = 0
+    restarts: int = 0
+    in_flight: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def events_per_second(self) -> float:
+        elapsed = time.monotonic() - self.started_at
+        return (self.handled + self.failed) / elapsed if elapsed > 0 else 0.0
+
+
+def _picklable(error: BaseException) -> BaseException:
+    try:
+        pickle.dumps(error)
+        return error
+    except Exception:
+        return RuntimeError(repr(error))
+
+
+def _run_worker(worker_id: int, inbox, results, dsn: str, concurrency: int) -> None:
+    asyncio.run(_serve(worker_id, inbox, results, dsn, concurrency))
+
+
+async def _serve(worker_id: int, inbox, results, dsn: str, concurrency: int) -> None:
+    from allocation import migrations
+    from allocation.adapters import cache
+    from allocation.service_layer import unit_of_work
+
+    def reply(request_id: int, future: asyncio.Future) -> None:
+        error = future.exception()
+        if error is None:
+            results.send((request_id, True, future.result()))
+        else:
+            results.send((request_id, False, _picklable(error)))
+
+    # SKUs are pinned to this process, so its product cache is never raced by
+    # another worker's writes except during a rebalance.
+    pool = await database.create_pool(dsn)
+    loader_pool = await database.create_pool(dsn, min_size=1, max_size=2)
+    cache_settings = config.get_product_cache_settings()
+    products_cache = cache.LRUCache(**cache_settings) if cache_settings else None
+    lazy = config.get_lazy_loading()
+    loader = repository.ProductLoader(loader_pool)
+    loop = asyncio.get_running_loop()
+    try:
+        await migrations.check_indexes(pool)
+        uow_factory = lambda: unit_of_work.PostgresUnitOfWork(pool, products_cache, lazy, loader)
+        batch_skus = repository.BatchSkus(pool)
+        async with messagebus.Scheduler(uow_factory, workers=concurrency, batch_skus=batch_skus) as scheduler:
+            results.send((None, True, multiprocessing.current_process().pid))
+            while True:
+                message = await loop.run_in_executor(None, inbox.get)
+                if message is None:
+                    break
+                request_id, event = message
+                future = await scheduler.submit(event)
+                future.add_done_callback(lambda f, request_id=request_id: reply(request_id, f))
+    finally:
+        await loader_pool.close()
+        await pool.close()
+        results.close()
+
+
+@dataclass
+class _Worker:
+    stats: WorkerStats
+    process: Any
+    inbox: Any
+    results: Any
+    requests: Dict[int, Tuple[Hashable, asyncio.Future]] = field(default_factory=dict)
+
+
+@dataclass
+class _InFlight:
+    worker_id: int
+    count: int = 0
+    drained: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+class WorkerPool:
+    # Runs the message bus in `workers` processes, each with its own asyncpg
+    # pool. Events are routed by consistent hash of their SKU, so one SKU is
+    # handled by one process at a time. When a worker dies its SKUs move to
+    # the other workers until its replacement is ready; events for a SKU that
+    # changed owner wait until the SKU's in-flight events are done, keeping
+    # per-SKU order without cross-process locks. Quantity changes are routed
+    # by the SKU of their batch, looked up through repository.BatchSkus on a
+    # one-connection pool unless `batch_skus` is given.
+
+    def __init__(
+            self,
+            workers: int = 4,
+            dsn: Optional[str] = None,
+            concurrency: int = 8,
+            replicas: int = 64,
+            health_interval: float = 0.5,
+            batch_skus: Optional[Callable[[str], Awaitable[Optional[str]]]] = None,
+    ) -> None:
+        self.workers_count = workers
+        self.dsn = dsn or config.get_postgres_uri()
+        self.concurrency = concurrency
+        self.health_interval = health_interval
+        self._context = multiprocessing.get_context("spawn")
+        self._ring = HashRing(replicas=replicas)
+        self._workers: Dict[int, _Worker] = {}
+        self._in_flight: Dict[Hashable, _InFlight] = {}
+        self._batch_skus = batch_skus
+        self._lookup_pool: Optional[asyncpg.Pool] = None
+        self._ready: Dict[int, asyncio.Future] = {}
+        self._next_request = 0
+        self._monitor_task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    async def __aenter__(self) -> "WorkerPool":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.shutdown()
+
+    @property
+    def stats(self) -> List[WorkerStats]:
+        return [self._workers[worker_id].stats for worker_id in sorted(self._workers)]
+
+    def worker_for(self, event: events.Event) -> int:
+        return self._ring.node_for(self.key(event))
+
+    def key(self, event: events.Event) -> Hashable:
+        return messagebus.shard_key(event)
+
+    async def start(self) -> None:
+        if self._batch_skus is None:
+            self._lookup_pool = await database.create_pool(self.dsn, min_size=0, max_size=1)
+            self._batch_skus = repository.BatchSkus(self._lookup_pool)
+        self._monitor_task = asyncio.create_task(self._monitor())
+        await asyncio.gather(*(self._spawn(worker_id) for worker_id in range(self.workers_count)))
+
+    async def _spawn(self, worker_id: int) -> None:
+        # Every worker gets its own inbox and reply pipe: a process killed
+        # while holding the lock of a shared queue would block all others.
+        inbox = self._context.Queue()
+        results, sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_run_worker, args=(worker_id, inbox, sender, self.dsn, self.concurrency),
+            name=f"allocation-worker-{worker_id}", daemon=True)
+        previous = self._workers.get(worker_id)
+        stats = previous.stats if previous is not None else WorkerStats(worker_id)
+        requests = previous.requests if previous is not None else {}
+        worker = self._workers[worker_id] = _Worker(stats, process, inbox, results, requests)
+        self._ready[worker_id] = asyncio.get_running_loop().create_future()
+        process.start()
+        sender.close()
+        asyncio.get_running_loop().add_reader(results.fileno(), self._receive, worker)
+        await self._ready[worker_id]
+
+    async def submit(self, event: events.Event) -> asyncio.Future:
+        if isinstance(event, events.BatchCreated):
+            repository.batch_sku_cache.put(event.ref, event.sku)
+        event = await messagebus.with_batch_sku(event, self._batch_skus)
+        if isinstance(event, events.AllocationsRequired):
+            parts = messagebus.split_by_sku(event)
+            if len(parts) > 1:
+                futures = [(positions, await self._submit(part)) for positions, part in parts]
+                return messagebus.merge_split_results(len(event.lines), futures)
+        return await self._submit(event)
+
+    async def _submit(self, event: events.Event) -> asyncio.Future:
+        key = self.key(event)
+        while True:
+            worker_id = self._ring.node_for(key)
+            in_flight = self._in_flight.get(key)
+            if in_flight is None or in_flight.worker_id == worker_id:
+                break
+            await in_flight.drained.wait()
+
+        if in_flight is None:
+            in_flight = self._in_flight[key] = _InFlight(worker_id)
+        in_flight.count += 1
+
+        worker = self._workers[worker_id]
+        request_id, self._next_request = self._next_request, self._next_request + 1
+        future = asyncio.get_running_loop().create_future()
+        worker.requests[request_id] = (key, future)
+        worker.stats.in_flight += 1
+        worker.inbox.put((request_id, event))
+        return future
+
+    async def handle(self, event: events.Event):
+        return await (await self.submit(event))
+
+    def _complete(self, worker: _Worker, request_id: int, ok: bool, value: Any) -> None:
+        key, future = worker.requests.pop(request_id)
+        worker.stats.in_flight -= 1
+        in_flight = self._in_flight[key]
+        in_flight.count -= 1
+        if in_flight.count == 0:
+            del self._in_flight[key]
+            in_flight.drained.set()
+
+        worker_label = str(worker.stats.worker_id)
+        if ok:
+            worker.stats.handled += 1
+            metrics.get().increment("worker_events", worker=worker_label)
+        else:
+            worker.stats.failed += 1
+            metrics.get().increment("worker_failures", worker=worker_label)
+        if not future.done():
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def _receive(self, worker: _Worker) -> None:
+        if worker.results.closed:
+            return
+        try:
+            while worker.results.poll():
+                request_id, ok, value = worker.results.recv()
+                if request_id is None:
+                    worker_id = worker.stats.worker_id
+                    worker.stats.pid = value
+                    self._ring.add(worker_id)
+                    self._ready[worker_id].set_result(None)
+                elif request_id in worker.requests:
+                    self._complete(worker, request_id, ok, value)
+        except (EOFError, OSError):
+            asyncio.get_running_loop().remove_reader(worker.results.fileno())
+            worker.results.close()
+
+    async def _monitor(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_interval)
+            for worker_id, worker in list(self._workers.items()):
+                if self._closing or worker.process.is_alive():
+                    continue
+                ready = self._ready[worker_id]
+                if not ready.done():
+                    ready.set_exception(WorkerLost(f"Worker {worker_id} exited during startup"))
+                    continue
+                try:
+                    await self._replace(worker_id)
+                except WorkerLost:
+                    pass
+
+    async def _replace(self, worker_id: int) -> None:
+        worker = self._workers[worker_id]
+        self._ring.remove(worker_id)
+        self._receive(worker)
+        for request_id in list(worker.requests):
+            self._complete(worker, request_id, False, WorkerLost(f"Worker {worker_id} exited"))
+        worker.stats.restarts += 1
+        metrics.get().increment("worker_restarts", worker=str(worker_id))
+        await self._spawn(worker_id)
+
+    async def restart(self, worker_id: int) -> None:
+        # Planned restart: stop routing to the worker, let it finish what it
+        # has, then start a replacement that takes its SKUs back.
+        worker = self._workers[worker_id]
+        self._ring.remove(worker_id)
+        worker.inbox.put(None)
+        await asyncio.get_running_loop().run_in_executor(None, worker.process.join)
+        self._receive(worker)
+        worker.stats.restarts += 1
+        await self._spawn(worker_id)
+
+    async def shutdown(self) -> None:
+        self._closing = True
+        for worker in self._workers.values():
+            worker.inbox.put(None)
+        loop = asyncio.get_running_loop()
+        for worker in self._workers.values():
+            await loop.run_in_executor(None, worker.process.join)
+            self._receive(worker)
+        if self._monitor_task is not None:
+            self._monitor_task.cancel()
+            await asyncio.gather(self._monitor_task, return_exceptions=True)
+        for worker in self._workers.values():
+            if not worker.results.closed:
+                loop.remove_reader(worker.results.fileno())
+                worker.results.close()
+            for request_id in list(worker.requests):
+                self._complete(worker, request_id, False, WorkerLost(f"Worker {worker.stats.worker_id} exited"))
+        if self._lookup_pool is not None:
+            await self._lookup_pool.close()
+            self._lookup_pool = None
@@ -0,0 +1,151 @@
+import contextlib
+import time
+from collections import deque
+from typing import ContextManager, Deque, Dict, Iterator, Tuple
+
+LabelsKey = Tuple[Tuple[str, str], ...]
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Instrumentation:
+    # No-op default: call sites stay instrumented at the cost of a method call.
+
+    def timer(self, name: str, **labels: str) -> ContextManager:
+        return _NOOP_TIMER
+
+    def increment(self, name: str, value: int = 1, **labels: str) -> None:
+        pass
+
+    def set_gauge(self, name: str, value: float, **labels: str) -> None:
+        pass
+
+
+_NOOP_TIMER = contextlib.nullcontext()
+
+
+class Series:
+
+    def __init__(self, reservoir_size: int) -> None:
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.samples: Deque[float] = deque(maxlen=reservoir_size)
+
+    def observe(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.samples.append(seconds)
+
+    def quantile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Registry(Instrumentation):
+
+    def __init__(self, namespace: str = "allocation", reservoir_size: int = 1024) -> None:
+        self.namespace = namespace
+        self.reservoir_size = reservoir_size
+        self.timings: Dict[str, Dict[LabelsKey, Series]] = {}
+        self.counters: Dict[str, Dict[LabelsKey, int]] = {}
+        self.gauges: Dict[str, Dict[LabelsKey, float]] = {}
+
+    def series(self, name: str, **labels: str) -> Series:
+        by_labels = self.timings.setdefault(name, {})
+        key = _key(labels)
+        series = by_labels.get(key)
+        if series is None:
+            series = by_labels[key] = Series(self.reservoir_size)
+        return series
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        series = self.series(name, **labels)
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            series.errors += 1
+            raise
+        finally:
+            series.observe(time.perf_counter() - started)
+
+    def increment(self, name: str, value: int = 1, **labels: str) -> None:
+        by_labels = self.counters.setdefault(name, {})
+        key = _key(labels)
+        by_labels[key] = by_labels.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels: str) -> None:
+        self.gauges.setdefault(name, {})[_key(labels)] = value
+
+    def count(self, name: str, **labels: str) -> int:
+        if name in self.counters:
+            return self.counters[name].get(_key(labels), 0)
+        series = self.timings.get(name, {}).get(_key(labels))
+        return series.count if series else 0
+
+    def errors(self, name: str, **labels: str) -> int:
+        series = self.timings.get(name, {}).get(_key(labels))
+        return series.errors if series else 0
+
+    def render(self) -> str:
+        lines = []
+        for name, by_labels in sorted(self.timings.items()):
+            metric = f"{self.namespace}_{name}_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            for key, series in sorted(by_labels.items()):
+                for q in QUANTILES:
+                    lines.append(f"{metric}{_format(key + (('quantile', str(q)),))} {series.quantile(q)}")
+                lines.append(f"{metric}_sum{_format(key)} {series.total}")
+                lines.append(f"{metric}_count{_format(key)} {series.count}")
+            lines.append(f"# TYPE {self.namespace}_{name}_errors_total counter")
+            for key, series in sorted(by_labels.items()):
+                lines.append(f"{self.namespace}_{name}_errors_total{_format(key)} {series.errors}")
+        for name, by_labels in sorted(self.counters.items()):
+            metric = f"{self.namespace}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for key, value in sorted(by_labels.items()):
+                lines.append(f"{metric}{_format(key)} {value}")
+        for name, by_labels in sorted(self.gauges.items()):
+            metric = f"{self.namespace}_{name}"
+            lines.append(f"# TYPE {metric} gauge")
+            for key, value in sorted(by_labels.items()):
+                lines.append(f"{metric}{_format(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _key(labels: Dict[str, str]) -> LabelsKey:
+    return tuple(sorted(labels.items()))
+
+
+def _format(key: LabelsKey) -> str:
+    if not key:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in key)
+    return "{" + ",".join(f'{label}="{value}"' for (label, _), value in zip(key, escaped)) + "}"
+
+
+_instrumentation: Instrumentation = Instrumentation()
+
+
+def get() -> Instrumentation:
+    return _instrumentation
+
+
+def configure(instrumentation: Instrumentation) -> None:
+    global _instrumentation
+    _instrumentation = instrumentation
+
+
+@contextlib.contextmanager
+def recording() -> Iterator[Registry]:
+    previous = get()
+    registry = Registry()
+    configure(registry)
+    try:
+        yield registry
+    finally:
+        configure(previous)
@@ -0,0 +1,3 @@
+ALTER TABLE products ADD COLUMN IF NOT EXISTS version_number integer NOT NULL DEFAULT 0;
+
+COMMENT ON COLUMN products.version_number IS 'Version of product aggregate, used for optimistic concurrency control';
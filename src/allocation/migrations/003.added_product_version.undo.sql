@@ -0,0 +1 @@
+ALTER TABLE products DROP COLUMN IF EXISTS version_number;
@@ -0,0 +1,18 @@
+CREATE TABLE IF NOT EXISTS outbox (
+    id              bigserial   NOT NULL,
+    event_type      varchar     NOT NULL,
+    payload         jsonb       NOT NULL,
+    created_at      timestamp   NOT NULL DEFAULT now(),
+    published_at    timestamp,
+    PRIMARY KEY ( id )
+);
+
+CREATE INDEX IF NOT EXISTS ix_outbox_unpublished ON outbox ( id ) WHERE published_at IS NULL;
+
+
+COMMENT ON TABLE outbox IS 'Domain events committed together with the changes that raised them, waiting to be published';
+COMMENT ON COLUMN outbox.id IS 'Outbox message identifier, increasing in commit order';
+COMMENT ON COLUMN outbox.event_type IS 'Name of the domain event class';
+COMMENT ON COLUMN outbox.payload IS 'Event fields';
+COMMENT ON COLUMN outbox.created_at IS 'Time the message was written';
+COMMENT ON COLUMN outbox.published_at IS 'Time the message was handed to the transport, null while pending';
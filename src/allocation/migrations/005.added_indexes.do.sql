@@ -0,0 +1,15 @@
+CREATE INDEX IF NOT EXISTS ix_batches_sku ON batches ( sku );
+CREATE INDEX IF NOT EXISTS ix_allocations_batch_id ON allocations ( batch_id );
+CREATE INDEX IF NOT EXISTS ix_allocations_order_line_id ON allocations ( order_line_id );
+CREATE INDEX IF NOT EXISTS ix_order_lines_order_ref_sku ON order_lines ( order_ref, sku );
+
+ALTER TABLE allocations ADD COLUMN IF NOT EXISTS sku varchar;
+
+UPDATE allocations a
+   SET sku = ol.sku
+  FROM order_lines ol
+ WHERE ol.id = a.order_line_id
+   AND a.sku IS NULL;
+
+
+COMMENT ON COLUMN allocations.sku IS 'Stock-keeping unit of the allocated order line, partition key when partitioned by SKU';
@@ -0,0 +1,6 @@
+ALTER TABLE allocations DROP COLUMN IF EXISTS sku;
+
+DROP INDEX IF EXISTS ix_order_lines_order_ref_sku;
+DROP INDEX IF EXISTS ix_allocations_order_line_id;
+DROP INDEX IF EXISTS ix_allocations_batch_id;
+DROP INDEX IF EXISTS ix_batches_sku;
@@ -0,0 +1,44 @@
+CREATE TABLE IF NOT EXISTS allocations_view (
+    order_ref   varchar NOT NULL,
+    sku         varchar NOT NULL,
+    qty         integer NOT NULL,
+    batch_ref   varchar NOT NULL,
+    PRIMARY KEY ( order_ref, sku )
+);
+
+CREATE TABLE IF NOT EXISTS sku_availability (
+    sku         varchar NOT NULL,
+    purchased   integer NOT NULL DEFAULT 0,
+    allocated   integer NOT NULL DEFAULT 0,
+    PRIMARY KEY ( sku )
+);
+
+INSERT INTO allocations_view (order_ref, sku, qty, batch_ref)
+SELECT ol.order_ref, ol.sku, ol.qty, b.batch_ref
+  FROM allocations a
+  JOIN order_lines ol ON ol.id = a.order_line_id
+  JOIN batches b ON b.id = a.batch_id
+    ON CONFLICT DO NOTHING;
+
+INSERT INTO sku_availability (sku, purchased, allocated)
+SELECT b.sku, sum(b.qty), coalesce(sum(al.qty), 0)
+  FROM batches b
+  LEFT JOIN (
+        SELECT a.batch_id, sum(ol.qty) AS qty
+          FROM allocations a
+          JOIN order_lines ol ON ol.id = a.order_line_id
+         GROUP BY a.batch_id
+       ) al ON al.batch_id = b.id
+ GROUP BY b.sku;
+
+
+COMMENT ON TABLE allocations_view IS 'Read model: batch each order line is allocated to, maintained from domain events';
+COMMENT ON COLUMN allocations_view.order_ref IS 'Order reference';
+COMMENT ON COLUMN allocations_view.sku IS 'Stock-keeping unit of the order line';
+COMMENT ON COLUMN allocations_view.qty IS 'Allocated quantity';
+COMMENT ON COLUMN allocations_view.batch_ref IS 'Reference of the batch the line is allocated to';
+
+COMMENT ON TABLE sku_availability IS 'Read model: purchased and allocated quantity per SKU, maintained from domain events';
+COMMENT ON COLUMN sku_availability.sku IS 'Stock-keeping unit, identifier of product';
+COMMENT ON COLUMN sku_availability.purchased IS 'Purchased quantity over all batches of the SKU';
+COMMENT ON COLUMN sku_availability.allocated IS 'Quantity allocated to order lines over all batches of the SKU';
@@ -0,0 +1,2 @@
+DROP TABLE IF EXISTS sku_availability;
+DROP TABLE IF EXISTS allocations_view;
@@ -0,0 +1,11 @@
+ALTER TABLE allocations_view ADD COLUMN IF NOT EXISTS version integer NOT NULL DEFAULT 0;
+ALTER TABLE allocations_view ALTER COLUMN batch_ref DROP NOT NULL;
+
+UPDATE allocations_view v
+   SET version = p.version_number
+  FROM products p
+ WHERE p.sku = v.sku;
+
+
+COMMENT ON COLUMN allocations_view.batch_ref IS 'Reference of the batch the line is allocated to, null once it is deallocated';
+COMMENT ON COLUMN allocations_view.version IS 'Product version of the last change applied to the row';
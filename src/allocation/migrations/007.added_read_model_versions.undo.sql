@@ -0,0 +1,4 @@
+DELETE FROM allocations_view WHERE batch_ref IS NULL;
+
+ALTER TABLE allocations_view ALTER COLUMN batch_ref SET NOT NULL;
+ALTER TABLE allocations_view DROP COLUMN IF EXISTS version;
@@ -0,0 +1,186 @@
+import glob
+import os
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
+
+import asyncpg
+
+DIRECTORY = os.path.dirname(__file__)
+
+# Leading index columns the repository and view queries rely on, per table.
+REQUIRED_INDEXES: Dict[str, List[Tuple[str, ...]]] = {
+    "products": [("sku",)],
+    "batches": [("id",), ("batch_ref",), ("sku",)],
+    "order_lines": [("id",), ("order_ref", "sku")],
+    "allocations": [("batch_id",), ("order_line_id",)],
+    "allocations_view": [("order_ref", "sku")],
+    "sku_availability": [("sku",)],
+}
+
+
+class MissingIndexes(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+
+    @property
+    def do_path(self) -> str:
+        return os.path.join(DIRECTORY, f"{self.name}.do.sql")
+
+    @property
+    def undo_path(self) -> str:
+        return os.path.join(DIRECTORY, f"{self.name}.undo.sql")
+
+    def read(self, path: str) -> str:
+        with open(path) as file:
+            return file.read()
+
+
+def discover() -> List[Migration]:
+    migrations = []
+    for path in glob.glob(os.path.join(DIRECTORY, "*.do.sql")):
+        name = os.path.basename(path)[:-len(".do.sql")]
+        migrations.append(Migration(int(re.match(r"\d+", name).group()), name))
+    return sorted(migrations, key=lambda migration: migration.version)
+
+
+async def applied_versions(connection: asyncpg.Connection) -> Set[int]:
+    # Kept in the schema 001 creates, since migrations change the search_path.
+    await connection.execute("""
+        CREATE SCHEMA IF NOT EXISTS allocation;
+        CREATE TABLE IF NOT EXISTS allocation.schema_migrations (
+            version     integer     NOT NULL,
+            name        varchar     NOT NULL,
+            applied_at  timestamp   NOT NULL DEFAULT now(),
+            PRIMARY KEY ( version )
+        )
+    """)
+    versions = {row["version"] for row in await connection.fetch("SELECT version FROM allocation.schema_migrations")}
+    # Databases migrated with postgrator before this module existed.
+    if not versions and await connection.fetchval("SELECT to_regclass('schemaversion')") is not None:
+        versions = {int(row["version"]) for row in await connection.fetch("SELECT version FROM schemaversion")}
+    return versions
+
+
+async def migrate(connection: asyncpg.Connection, target: Optional[int] = None) -> List[int]:
+    applied = await applied_versions(connection)
+    done = []
+    for migration in discover():
+        if migration.version in applied or target is not None and migration.version > target:
+            continue
+        async with connection.transaction():
+            await connection.execute(migration.read(migration.do_path))
+            await connection.execute(
+                "INSERT INTO allocation.schema_migrations (version, name) VALUES ($1, $2)", migration.version, migration.name)
+        done.append(migration.version)
+    return done
+
+
+async def rollback(connection: asyncpg.Connection, target: int) -> List[int]:
+    applied = await applied_versions(connection)
+    undone = []
+    for migration in reversed(discover()):
+        if migration.version not in applied or migration.version <= target:
+            continue
+        async with connection.transaction():
+            await connection.execute(migration.read(migration.undo_path))
+            await connection.execute("DELETE FROM allocation.schema_migrations WHERE version = $1", migration.version)
+        undone.append(migration.version)
+    return undone
+
+
+async def missing_indexes(connection: asyncpg.Connection) -> List[Tuple[str, Tuple[str, ...]]]:
+    query = """
+        SELECT t.relname AS table_name,
+               array_agg(a.attname ORDER BY k.position) AS columns
+          FROM pg_index i
+          JOIN pg_class t ON t.oid = i.indrelid
+          CROSS JOIN LATERAL unnest(i.indkey::int2[]) WITH ORDINALITY AS k(attnum, position)
+          JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum
+         WHERE t.relnamespace = to_regnamespace(current_schema())
+           AND t.relname = any($1::varchar[])
+         GROUP BY i.indexrelid, t.relname
+    """
+    rows = await connection.fetch(query, list(REQUIRED_INDEXES))
+    indexes: Dict[str, List[Tuple[str, ...]]] = {}
+    for row in rows:
+        indexes.setdefault(row["table_name"], []).append(tuple(row["columns"]))
+
+    missing = []
+    for table, required in REQUIRED_INDEXES.items():
+        for columns in required:
+            if not any(index[:len(columns)] == columns for index in indexes.get(table, [])):
+                missing.append((table, columns))
+    return missing
+
+
+async def check_indexes(pool: asyncpg.Pool) -> None:
+    async with pool.acquire() as connection:
+        missing = await missing_indexes(connection)
+    if missing:
+        described = ", ".join(f"{table}({', '.join(columns)})" for table, columns in missing)
+        raise MissingIndexes(f"Required indexes are missing: {described}; run the migrations")
+
+
+def _partition_statements(table: str, partitions: int) -> List[str]:
+    return [
+        f"CREATE TABLE {table}_p{remainder} PARTITION OF {table}_partitioned"
+        f" FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})"
+        for remainder in range(partitions)
+    ]
+
+
+async def partition_by_sku(connection: asyncpg.Connection, partitions: int = 16) -> None:
+    # Optional layout for large tenants: order_lines and allocations become
+    # hash partitioned by SKU, so one product's lines live in one partition.
+    # Primary keys and the allocations -> order_lines key include the SKU.
+    # Rewrites both tables under an exclusive lock.
+    if await connection.fetchval("SELECT relkind FROM pg_class WHERE oid = to_regclass('order_lines')") == "p":
+        return
+
+    statements = [
+        "LOCK TABLE order_lines, allocations IN ACCESS EXCLUSIVE MODE",
+        "UPDATE allocations a SET sku = ol.sku FROM order_lines ol WHERE ol.id = a.order_line_id AND a.sku IS NULL",
+        """
+        CREATE TABLE order_lines_partitioned (
+            id          integer NOT NULL DEFAULT nextval('order_lines_id_seq'),
+            sku         varchar NOT NULL,
+            qty         integer NOT NULL,
+            order_ref   varchar NOT NULL,
+            CHECK ( qty >= 0 ),
+            PRIMARY KEY ( id, sku )
+        ) PARTITION BY HASH ( sku )
+        """,
+        *_partition_statements("order_lines", partitions),
+        "INSERT INTO order_lines_partitioned SELECT id, sku, qty, order_ref FROM order_lines",
+        """
+        CREATE TABLE allocations_partitioned (
+            id              integer NOT NULL DEFAULT nextval('allocations_id_seq'),
+            order_line_id   integer NOT NULL,
+            batch_id        integer NOT NULL,
+            sku             varchar NOT NULL,
+            PRIMARY KEY ( id, sku ),
+            FOREIGN KEY ( order_line_id, sku ) REFERENCES order_lines_partitioned ( id, sku ) ON DELETE CASCADE,
+            FOREIGN KEY ( batch_id ) REFERENCES batches ( id )
+        ) PARTITION BY HASH ( sku )
+        """,
+        *_partition_statements("allocations", partitions),
+        "INSERT INTO allocations_partitioned SELECT id, order_line_id, batch_id, sku FROM allocations",
+        "ALTER SEQUENCE order_lines_id_seq OWNED BY order_lines_partitioned.id",
+        "ALTER SEQUENCE allocations_id_seq OWNED BY allocations_partitioned.id",
+        "DROP TABLE allocations",
+        "DROP TABLE order_lines",
+        "ALTER TABLE order_lines_partitioned RENAME TO order_lines",
+        "ALTER TABLE allocations_partitioned RENAME TO allocations",
+        "CREATE INDEX ix_order_lines_order_ref_sku ON order_lines ( order_ref, sku )",
+        "CREATE INDEX ix_allocations_batch_id ON allocations ( batch_id )",
+        "CREATE INDEX ix_allocations_order_line_id ON allocations ( order_line_id )",
+    ]
+    async with connection.transaction():
+        for statement in statements:
+            await connection.execute(statement)
@@ -1,7 +1,8 @@
 from datetime import date
-from typing import Optional
+from typing import Optional, List, Dict
 
-from allocation.adapters import email
+from allocation import config
+from allocation.adapters import notifications, skus
 from allocation.domain import model, events
 from allocation.service_layer import unit_of_work
 
@@ -10,19 +11,32 @@ class InvalidSku(Exception):
     pass
 
 
+class InvalidBatchRef(Exception):
+    pass
+
+
 async def add_batch(event: events.BatchCreated, uow: unit_of_work.AbstractUnitOfWork):
     async with uow:
         product = await uow.products.get(sku=event.sku)
         if product is None:
             product = model.Product(event.sku, batches=[])
             await uow.products.add(product)
-        product.batches.append(model.Batch(event.ref, event.sku, event.qty, event.eta))
+        product.add_batch(model.Batch(event.ref, event.sku, event.qty, event.eta))
         await uow.commit()
+    skus.get().add(event.sku)
 
 
 async def allocate(event: events.AllocationRequired, uow: unit_of_work.AbstractUnitOfWork) -> str:
     line = model.OrderLine(event.order_ref, event.sku, event.qty)
+    if not skus.get().might_exist(line.sku):
+        raise InvalidSku(f"Invalid sku {line.sku}")
+    [batch_ref] = uow.cached_batch_refs([line])
+    if batch_ref is not None:
+        return batch_ref
     async with uow:
+        [batch_ref] = await uow.products.allocated_batch_refs([line])
+        if batch_ref is not None:
+            return batch_ref
         product = await uow.products.get(event.sku)
         if product is None:
             raise InvalidSku(f"Invalid sku {line.sku}")
@@ -31,12 +45,58 @@ async def allocate(event: events.AllocationRequired, uow: unit_of_work.AbstractU
         return batch_ref
 
 
+async def allocate_many(event: events.AllocationsRequired, uow: unit_of_work.AbstractUnitOfWork) -> List[Optional[str]]:
+    positions_by_sku: Dict[str, List[int]] = {}
+    for position, line_event in enumerate(event.lines):
+        positions_by_sku.setdefault(line_event.sku, []).append(position)
+
+    for sku in positions_by_sku:
+        if not skus.get().might_exist(sku):
+            raise InvalidSku(f"Invalid sku {sku}")
+
+    results = uow.cached_batch_refs([model.OrderLine(e.order_ref, e.sku, e.qty) for e in event.lines])
+    if None not in results:
+        return results
+    async with uow:
+        for sku, positions in positions_by_sku.items():
+            positions = [p for p in positions if results[p] is None]
+            if not positions:
+                continue
+            lines = [model.OrderLine(event.lines[p].order_ref, sku, event.lines[p].qty) for p in positions]
+            known = await uow.products.allocated_batch_refs(lines)
+            for position, batch_ref in zip(positions, known):
+                results[position] = batch_ref
+            positions = [p for p, batch_ref in zip(positions, known) if batch_ref is None]
+            if not positions:
+                continue
+
+            product = await uow.products.get(sku)
+            if product is None:
+                raise InvalidSku(f"Invalid sku {sku}")
+            lines = [model.OrderLine(event.lines[p].order_ref, sku, event.lines[p].qty) for p in positions]
+            for position, batch_ref in zip(positions, product.allocate_many(lines)):
+                results[position] = batch_ref
+        await uow.commit()
+        return results
+
+
 async def change_batch_quantity(event: events.BatchQuantityChanged, uow: unit_of_work.AbstractUnitOfWork):
     async with uow:
         product = await uow.products.get_by_batch_ref(batch_ref=event.ref)
-        product.change_batch_quantity(ref=event.ref, qty=event.qty)
+        if product is None:
+            raise InvalidBatchRef(f"Invalid batch ref {event.ref}")
+        if product.requires_allocations(event.ref, event.qty):
+            await uow.products.load_allocations(product, [event.ref])
+        eviction_order = model.EVICTION_ORDERS[config.get_eviction_order()]
+        product.change_batch_quantity(ref=event.ref, qty=event.qty, eviction_order=eviction_order)
+        await uow.commit()
+
+
+async def update_read_model(event: events.StockChanged, uow: unit_of_work.AbstractUnitOfWork):
+    async with uow:
+        await uow.views.apply(event)
         await uow.commit()
 
 
 async def send_out_of_stock_notification(event: events.OutOfStock, uow: unit_of_work.AbstractUnitOfWork):
-    await email.send('stock@made.com', f'Артикула {event.sku} нет в наличии', )
+    await notifications.get().out_of_stock(event.sku)
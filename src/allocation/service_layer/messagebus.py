@@ -1,22 +1,282 @@
+import asyncio
+import dataclasses
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Hashable, List, Optional, Set, Tuple, Union
+
+from allocation import metrics
 from allocation.domain import events
 from allocation.service_layer import unit_of_work
 from allocation.service_layer import handlers
+from allocation.service_layer import retry
 
 
-async def handle(event: events.Event, uow: unit_of_work.AbstractUnitOfWork):
+async def handle(
+        event: events.Event,
+        uow: unit_of_work.AbstractUnitOfWork,
+        retry_policy: retry.RetryPolicy = retry.DEFAULT_POLICY,
+):
+    # Returns what the handlers of `event` returned; the events they raise,
+    # such as read model updates, are handled before returning.
+    instrumentation = metrics.get()
     results = []
-    queue = [event]
-    while queue:
-        event = queue.pop(0)
-        for handler in HANDLERS[type(event)]:
-            results.append(await handler(event, uow=uow))
-            queue.extend(uow.collect_new_events())
+    submitted = event
+    queue = deque([event])
+    with instrumentation.timer("messagebus_handle", event=type(event).__name__):
+        while queue:
+            event = queue.popleft()
+            event_type = type(event).__name__
+            for handler in HANDLERS[type(event)]:
+                with instrumentation.timer("handler", event=event_type, handler=handler.__name__):
+                    result = await retry_policy.run(lambda: handler(event, uow=uow))
+                if event is submitted:
+                    results.append(result)
+                queue.extend(uow.collect_new_events())
     return results
 
 
+def shard_key(event: events.Event) -> Hashable:
+    sku = getattr(event, "sku", None)
+    if sku is not None:
+        return sku
+    if isinstance(event, events.AllocationsRequired):
+        skus = {line.sku for line in event.lines}
+        if len(skus) == 1:
+            return skus.pop()
+    ref = getattr(event, "ref", None)
+    if ref is not None:
+        return ref
+    return type(event)
+
+
+async def with_batch_sku(event: events.Event, batch_skus: Callable[[str], Awaitable[Optional[str]]]) -> events.Event:
+    # Quantity changes name only their batch; they are routed by its SKU.
+    if isinstance(event, events.BatchQuantityChanged) and event.sku is None:
+        sku = await batch_skus(event.ref)
+        if sku is not None:
+            return dataclasses.replace(event, sku=sku)
+    return event
+
+
+def split_by_sku(event: events.AllocationsRequired) -> List[Tuple[List[int], events.AllocationsRequired]]:
+    positions_by_sku: Dict[str, List[int]] = {}
+    for position, line in enumerate(event.lines):
+        positions_by_sku.setdefault(line.sku, []).append(position)
+    return [
+        (positions, events.AllocationsRequired([event.lines[p] for p in positions]))
+        for positions in positions_by_sku.values()
+    ]
+
+
+def merge_split_results(size: int, parts: List[Tuple[List[int], asyncio.Future]]) -> asyncio.Future:
+    # Every part is its own transaction, so the split event is not atomic.
+    # Positions of a part that failed or was cancelled hold its exception in
+    # place of a batch ref; the merged future only fails, or is cancelled,
+    # when every part did, so no committed allocation is reported as failed.
+    merged = asyncio.get_running_loop().create_future()
+
+    def done(_: asyncio.Future) -> None:
+        if merged.done() or not all(future.done() for _, future in parts):
+            return
+        if all(future.cancelled() for _, future in parts):
+            merged.cancel()
+            return
+        errors = [asyncio.CancelledError() if future.cancelled() else future.exception() for _, future in parts]
+        if all(error is not None for error in errors):
+            merged.set_exception(next(error for error in errors if not isinstance(error, asyncio.CancelledError)))
+            return
+        results: List[Union[str, None, BaseException]] = [None] * size
+        for (positions, future), error in zip(parts, errors):
+            if error is not None:
+                for position in positions:
+                    results[position] = error
+                continue
+            [batch_refs] = future.result()
+            for position, batch_ref in zip(positions, batch_refs):
+                results[position] = batch_ref
+        merged.set_result([results])
+
+    for _, future in parts:
+        future.add_done_callback(done)
+    return merged
+
+
+class SchedulerClosed(Exception):
+    pass
+
+
+class Scheduler:
+    # Events sharing a shard key are handled one at a time in submission order,
+    # events with different keys run concurrently on up to `workers` units of work.
+    # Bulk allocations spanning SKUs are split into one event, and one
+    # transaction, per SKU (see merge_split_results), and quantity changes are
+    # keyed by the SKU `batch_skus` finds for their batch.
+
+    def __init__(
+            self,
+            uow_factory: Callable[[], unit_of_work.AbstractUnitOfWork],
+            workers: int = 8,
+            max_pending: int = 1000,
+            key: Callable[[events.Event], Hashable] = shard_key,
+            retry_policy: retry.RetryPolicy = retry.DEFAULT_POLICY,
+            batch_skus: Optional[Callable[[str], Awaitable[Optional[str]]]] = None,
+    ) -> None:
+        self._uow_factory = uow_factory
+        self._retry_policy = retry_policy
+        self._batch_skus = batch_skus
+        self._workers_count = workers
+        self._key = key
+        self._slots = asyncio.Semaphore(max_pending)
+        self._shards: Dict[Hashable, Deque[Tuple[events.Event, asyncio.Future]]] = {}
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._workers: List[asyncio.Task] = []
+        self._pending = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._closed = False
+
+    async def __aenter__(self) -> "Scheduler":
+        self.start()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.shutdown()
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def start(self) -> None:
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._work()) for _ in range(self._workers_count)]
+
+    async def submit(self, event: events.Event) -> asyncio.Future:
+        if self._closed:
+            raise SchedulerClosed("Scheduler is shut down")
+        if self._batch_skus is not None:
+            event = await with_batch_sku(event, self._batch_skus)
+        if isinstance(event, events.AllocationsRequired):
+            parts = split_by_sku(event)
+            if len(parts) > 1:
+                return merge_split_results(
+                    len(event.lines), [(positions, await self._submit(part)) for positions, part in parts])
+        return await self._submit(event)
+
+    async def _submit(self, event: events.Event) -> asyncio.Future:
+        await self._slots.acquire()
+        future = asyncio.get_running_loop().create_future()
+        key = self._key(event)
+        shard = self._shards.get(key)
+        if shard is None:
+            shard = self._shards[key] = deque()
+            self._ready.put_nowait(key)
+        shard.append((event, future))
+        self._pending += 1
+        self._idle.clear()
+        return future
+
+    async def handle(self, event: events.Event):
+        return await (await self.submit(event))
+
+    async def drain(self) -> None:
+        await self._idle.wait()
+
+    async def shutdown(self) -> None:
+        self._closed = True
+        await self.drain()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _work(self) -> None:
+        while True:
+            key = await self._ready.get()
+            shard = self._shards[key]
+            event, future = shard.popleft()
+            try:
+                result = await handle(event, self._uow_factory(), self._retry_policy)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+            finally:
+                if shard:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._shards[key]
+                self._pending -= 1
+                if self._pending == 0:
+                    self._idle.set()
+                self._slots.release()
+
+
+class AllocationBatcher:
+    # Allocation requests for one SKU arriving within `window` seconds of the
+    # first are handled together as a single AllocationsRequired event, so they
+    # share one unit of work; every caller still gets its own batch ref.
+
+    def __init__(
+            self,
+            uow_factory: Callable[[], unit_of_work.AbstractUnitOfWork],
+            window: float = 0.002,
+            max_batch: int = 100,
+            retry_policy: retry.RetryPolicy = retry.DEFAULT_POLICY,
+    ) -> None:
+        self._uow_factory = uow_factory
+        self.window = window
+        self.max_batch = max_batch
+        self._retry_policy = retry_policy
+        self._pending: Dict[str, Tuple[List[Tuple[events.AllocationRequired, asyncio.Future]], asyncio.TimerHandle]] = {}
+        self._running: Set[asyncio.Task] = set()
+
+    async def allocate(self, event: events.AllocationRequired) -> Optional[str]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.get(event.sku)
+        if pending is None:
+            pending = self._pending[event.sku] = ([], loop.call_later(self.window, self._flush, event.sku))
+        requests = pending[0]
+        requests.append((event, future))
+        if len(requests) >= self.max_batch:
+            self._flush(event.sku)
+        return await future
+
+    def _flush(self, sku: str) -> None:
+        requests, timer = self._pending.pop(sku)
+        timer.cancel()
+        task = asyncio.create_task(self._handle(requests))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _handle(self, requests: List[Tuple[events.AllocationRequired, asyncio.Future]]) -> None:
+        metrics.get().increment("allocation_batches")
+        metrics.get().increment("allocation_batched_requests", len(requests))
+        try:
+            results = await handle(
+                events.AllocationsRequired([event for event, _ in requests]), self._uow_factory(), self._retry_policy)
+        except Exception as e:
+            for _, future in requests:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (_, future), batch_ref in zip(requests, results[0]):
+                if not future.done():
+                    future.set_result(batch_ref)
+
+    async def drain(self) -> None:
+        for sku in list(self._pending):
+            self._flush(sku)
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+
+
 HANDLERS = {
     events.OutOfStock: [handlers.send_out_of_stock_notification, ],
     events.BatchCreated: [handlers.add_batch, ],
     events.BatchQuantityChanged: [handlers.change_batch_quantity],
-    events.AllocationRequired: [handlers.allocate, ]
+    events.AllocationRequired: [handlers.allocate, ],
+    events.AllocationsRequired: [handlers.allocate_many, ],
+    events.StockChanged: [handlers.update_read_model, ],
 }
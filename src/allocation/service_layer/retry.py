@@ -0,0 +1,53 @@
+import asyncio
+import random
+from typing import Awaitable, Callable, Tuple, Type, TypeVar
+
+from allocation import metrics
+from allocation.adapters import repository
+
+T = TypeVar("T")
+
+
+class RetryPolicy:
+
+    def __init__(
+            self,
+            max_attempts: int = 3,
+            base_delay: float = 0.005,
+            max_delay: float = 0.2,
+            retry_on: Tuple[Type[Exception], ...] = (repository.ConcurrencyConflict,),
+    ) -> None:
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_on = retry_on
+
+        self.conflicts = 0
+        self.retries = 0
+        self.exhausted = 0
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    async def run(self, operation: Callable[[], Awaitable[T]]) -> T:
+        attempt = 1
+        while True:
+            try:
+                return await operation()
+            except self.retry_on:
+                self.conflicts += 1
+                metrics.get().increment("concurrency_conflicts")
+                if attempt >= self.max_attempts:
+                    self.exhausted += 1
+                    raise
+            self.retries += 1
+            metrics.get().increment("retries")
+            await asyncio.sleep(self.delay(attempt))
+            attempt += 1
+
+    @property
+    def stats(self) -> dict:
+        return {"conflicts": self.conflicts, "retries": self.retries, "exhausted": self.exhausted}
+
+
+DEFAULT_POLICY = RetryPolicy()
@@ -1,26 +1,59 @@
+import asyncio
 from abc import ABC, abstractmethod
+from typing import List, Optional, Set
 
+import asyncpg
 from asyncpg import Pool, Connection
 from asyncpg.transaction import Transaction, TransactionState
-from allocation.adapters import repository
+from allocation import metrics
+from allocation.adapters import cache, database, memory, outbox, read_model, repository
+from allocation.domain import events, model
 
 
 class AbstractUnitOfWork(ABC):
+    # Committed products may be handed to other units of work through a
+    # shared cache, so their events are moved to the unit of work when it
+    # commits instead of waiting on the products to be collected.
     products: repository.AbstractProductRepository
+    views: read_model.AbstractReadModel
+
+    def __init__(self) -> None:
+        self._new_events: List[events.Event] = []
+        self._committed_products: Set[model.Product] = set()
 
     async def __aenter__(self) -> "AbstractUnitOfWork":
+        self._committed_products = set()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
         await self.rollback()
 
+    def cached_batch_refs(self, lines: List[model.OrderLine]) -> List[Optional[str]]:
+        # Answers duplicate allocation requests without entering the unit of
+        # work; None for every line this unit of work cannot vouch for.
+        return [None] * len(lines)
+
     def collect_new_events(self):
-        for product in self.products.seen:
-            while product.events:
-                yield product.events.pop(0)
+        while self._new_events:
+            yield self._new_events.pop(0)
+        # A unit of work that answered from a cache may never have been entered.
+        seen = self.products.seen if hasattr(self, "products") else ()
+        for product in seen:
+            if product not in self._committed_products:
+                while product.events:
+                    yield product.events.pop(0)
 
     async def commit(self):
+        # Read model updates are raised once the changes are committed and,
+        # unlike the events the model raised, are not written to the outbox.
+        changes = [(product, product.stock_changed()) for product in self.products.seen]
         await self._commit()
+        for product, stock_changed in changes:
+            self._new_events.extend(product.events)
+            product.events.clear()
+            if stock_changed is not None:
+                self._new_events.append(stock_changed)
+            self._committed_products.add(product)
 
     @abstractmethod
     async def _commit(self) -> None:
@@ -34,24 +67,136 @@ class AbstractUnitOfWork(ABC):
 class PostgresUnitOfWork(AbstractUnitOfWork):
     products: repository.PostgresProductRepository
 
-    def __init__(self, pool: Pool) -> None:
+    def __init__(
+            self,
+            pool: Pool,
+            products_cache: Optional[cache.LRUCache] = None,
+            lazy: bool = False,
+            loader: Optional[repository.ProductLoader] = None,
+    ) -> None:
+        super().__init__()
         self._pool = pool
+        self._products_cache = products_cache
+        self._lazy = lazy
+        self._loader = loader
+
+    def cached_batch_refs(self, lines: List[model.OrderLine]) -> List[Optional[str]]:
+        return repository.cached_batch_refs(lines)
 
     async def __aenter__(self) -> "PostgresUnitOfWork":
-        self.connection: Connection = await self._pool.acquire()
-        self.transaction: Transaction = self.connection.transaction()
-        self.products = repository.PostgresProductRepository(self.connection)
-        await self.transaction.start()
+        with metrics.get().timer("uow_enter"):
+            self.connection: Connection = await database.acquire(self._pool)
+            self.transaction: Transaction = self.connection.transaction()
+            self.products = repository.PostgresProductRepository(
+                self.connection, self._products_cache, self._lazy, self._loader)
+            self.views = read_model.PostgresReadModel(self.connection)
+            await self.transaction.start()
         return await super().__aenter__()
 
     async def __aexit__(self, *args) -> None:
         await super().__aexit__(*args)
         await self._pool.release(self.connection)
+        # Only once nothing here touches them any more. A cached product that
+        # was committed without changes was never checked against the
+        # database, so it is dropped and the next unit of work reloads it.
+        if self._products_cache is not None:
+            for product in self._committed_products & self.products.confirmed:
+                self._products_cache.put(product.sku, product)
 
     async def _commit(self) -> None:
-        await self.products.save_changes()
-        await self.transaction.commit()
+        with metrics.get().timer("uow_commit"):
+            await self.products.save_changes()
+            await outbox.add(self.connection, (event for product in self.products.seen for event in product.events))
+            await self.transaction.commit()
+        self.products.remember_allocations()
 
     async def rollback(self) -> None:
         if self.transaction._state is not TransactionState.COMMITTED:
+            with metrics.get().timer("uow_rollback"):
+                await self.transaction.rollback()
+
+
+class ReadOnlyUnitOfWork:
+    # Query-side unit of work: a READ ONLY, repeatable-read transaction on
+    # the replica pool, or on the primary when there is no replica or it
+    # cannot hand out a connection. It is always rolled back and has no
+    # commit, and its repository cannot save changes.
+    replica_unavailable = (
+        OSError,
+        asyncio.TimeoutError,
+        asyncpg.PostgresConnectionError,
+        asyncpg.CannotConnectNowError,
+        asyncpg.TooManyConnectionsError,
+    )
+
+    def __init__(
+            self,
+            pool: Pool,
+            replica_pool: Optional[Pool] = None,
+            lazy: bool = False,
+            replica_timeout: float = 1.0,
+    ) -> None:
+        self._primary_pool = pool
+        self._replica_pool = replica_pool
+        self._lazy = lazy
+        self._replica_timeout = replica_timeout
+        self.on_replica = False
+
+    async def _acquire(self) -> Connection:
+        if self._replica_pool is not None:
+            try:
+                connection = await database.acquire(self._replica_pool, self._replica_timeout)
+            except self.replica_unavailable:
+                metrics.get().increment("replica_fallbacks")
+            else:
+                self._pool, self.on_replica = self._replica_pool, True
+                return connection
+        self._pool, self.on_replica = self._primary_pool, False
+        return await database.acquire(self._primary_pool)
+
+    async def __aenter__(self) -> "ReadOnlyUnitOfWork":
+        with metrics.get().timer("read_uow_enter"):
+            self.connection: Connection = await self._acquire()
+            try:
+                self.transaction: Transaction = self.connection.transaction(isolation="repeatable_read", readonly=True)
+                await self.transaction.start()
+            except BaseException:
+                await self._pool.release(self.connection)
+                raise
+            self.products = repository.ReadOnlyProductRepository(self.connection, self._lazy)
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        try:
             await self.transaction.rollback()
+        finally:
+            await self._pool.release(self.connection)
+
+
+class InMemoryUnitOfWork(AbstractUnitOfWork):
+    products: memory.InMemoryProductRepository
+
+    def __init__(self, store: Optional[memory.ProductStore] = None) -> None:
+        super().__init__()
+        self.store = store if store is not None else memory.ProductStore()
+        self.products = memory.InMemoryProductRepository(self.store)
+        self.views = self.store.read_model
+        self._committed = False
+
+    async def __aenter__(self) -> "InMemoryUnitOfWork":
+        self.products = memory.InMemoryProductRepository(self.store)
+        self._committed = False
+        return await super().__aenter__()
+
+    async def _commit(self) -> None:
+        await self.products.save_changes()
+        self._committed = True
+        for product in self.products.seen:
+            self.store.checkin(product)
+
+    async def rollback(self) -> None:
+        if self._committed:
+            return
+        for product in self.products.seen:
+            if not product.has_changes and product.version_number == product.persisted_version_number:
+                self.store.checkin(product)
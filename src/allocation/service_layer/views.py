@@ -0,0 +1,18 @@
+from typing import Any, Dict, List, Optional
+
+from allocation.adapters import read_model
+from allocation.service_layer import unit_of_work
+
+
+async def allocations(order_ref: str, uow: unit_of_work.ReadOnlyUnitOfWork) -> List[Dict[str, str]]:
+    async with uow:
+        rows = await uow.connection.fetch(read_model.ALLOCATIONS, order_ref)
+    return [{"sku": row["sku"], "batch_ref": row["batch_ref"]} for row in rows]
+
+
+async def availability(sku: str, uow: unit_of_work.ReadOnlyUnitOfWork) -> Optional[Dict[str, Any]]:
+    async with uow:
+        row = await uow.connection.fetchrow(read_model.AVAILABILITY, sku)
+    if row is None:
+        return None
+    return {"sku": sku, "purchased": row["purchased"], "allocated": row["allocated"], "available": row["available"]}
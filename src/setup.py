@@ -4,4 +4,5 @@ setup(
     name="allocation",
     version="0.1",
     packages=["allocation"],
+    python_requires=">=3.10",
 )
\ No newline at end of file
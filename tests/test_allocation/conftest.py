@@ -1,9 +1,8 @@
 import asyncio
 
-import asyncpg
 import pytest_asyncio
 
-from allocation import config
+from allocation.adapters import database, repository
 
 
 @pytest_asyncio.fixture(scope="session")
@@ -13,7 +12,7 @@ def event_loop():
 
 @pytest_asyncio.fixture()
 async def pg_pool():
-    poll = await asyncpg.create_pool(dsn=config.get_postgres_uri())
+    poll = await database.create_pool(min_size=2)
     yield poll
     async with poll.acquire() as connection:
         async with connection.transaction():
@@ -21,6 +20,10 @@ async def pg_pool():
             await connection.execute('TRUNCATE TABLE batches CASCADE ')
             await connection.execute('TRUNCATE TABLE order_lines CASCADE ')
             await connection.execute('TRUNCATE TABLE allocations')
+            await connection.execute('TRUNCATE TABLE outbox')
+            await connection.execute('TRUNCATE TABLE allocations_view, sku_availability')
+    repository.allocations_cache.clear()
+    await poll.close()
 
 
 @pytest_asyncio.fixture
@@ -0,0 +1,130 @@
+import asyncio
+import json
+import uuid
+
+import pytest
+import pytest_asyncio
+
+from allocation import metrics
+from allocation.entrypoints import api
+
+
+def random_suffix():
+    return uuid.uuid4().hex[:6]
+
+
+def random_sku(name=""):
+    return f"sku-{name}-{random_suffix()}"
+
+
+class Client:
+    # Sends every request over one keep-alive connection.
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+
+    async def request(self, method, path, payload=None):
+        body = json.dumps(payload).encode() if payload is not None else b""
+        self._writer.write(
+            f"{method} {path} HTTP/1.1\r\nHost: test\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+        await self._writer.drain()
+
+        status = int((await self._reader.readline()).split()[1])
+        headers = {}
+        while (line := await self._reader.readline()) != b"\r\n":
+            name, _, value = line.decode().partition(":")
+            headers[name.lower()] = value.strip()
+        return status, json.loads(await self._reader.readexactly(int(headers["content-length"])))
+
+    async def close(self):
+        self._writer.close()
+        await self._writer.wait_closed()
+
+
+@pytest_asyncio.fixture
+async def app(pg_pool):
+    application = api.Application(pg_pool, batch_window=0.01)
+    server = await application.serve("127.0.0.1", 0)
+    application.port = server.sockets[0].getsockname()[1]
+    yield application
+    server.close()
+    await server.wait_closed()
+    await application.close()
+
+
+async def connect(app):
+    return Client(*await asyncio.open_connection("127.0.0.1", app.port))
+
+
+@pytest.mark.asyncio
+async def test_allocate_and_query_allocations_over_one_connection(app):
+    sku, other_sku = random_sku(), random_sku("other")
+    client = await connect(app)
+    try:
+        assert (await client.request("POST", "/add_batch", {"ref": "batch-early", "sku": sku, "qty": 100, "eta": "2030-01-01"}))[0] == 201
+        assert (await client.request("POST", "/add_batch", {"ref": "batch-late", "sku": sku, "qty": 100, "eta": "2030-01-02"}))[0] == 201
+        assert (await client.request("POST", "/add_batch", {"ref": "batch-other", "sku": other_sku, "qty": 100, "eta": None}))[0] == 201
+
+        assert await client.request("POST", "/allocate", {"order_ref": "order1", "sku": sku, "qty": 3}) == (201, {"batch_ref": "batch-early"})
+        assert await client.request("POST", "/allocate", {"order_ref": "order1", "sku": other_sku, "qty": 3}) == (201, {"batch_ref": "batch-other"})
+        assert await client.request("GET", "/allocations/order1") == (200, [
+            {"sku": sku, "batch_ref": "batch-early"},
+            {"sku": other_sku, "batch_ref": "batch-other"},
+        ] if sku < other_sku else [
+            {"sku": other_sku, "batch_ref": "batch-other"},
+            {"sku": sku, "batch_ref": "batch-early"},
+        ])
+
+        assert await client.request("POST", "/change_quantity", {"ref": "batch-early", "qty": 1}) == (200, {"ref": "batch-early", "qty": 1})
+        status, allocations = await client.request("GET", "/allocations/order1")
+        assert {"sku": sku, "batch_ref": "batch-late"} in allocations
+        assert await client.request("GET", f"/availability/{sku}") == (200, {
+            "sku": sku, "purchased": 101, "allocated": 3, "available": 98})
+    finally:
+        await client.close()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_allocations_for_one_sku_share_a_transaction(app):
+    sku = random_sku()
+    client = await connect(app)
+    await client.request("POST", "/add_batch", {"ref": "batch1", "sku": sku, "qty": 25, "eta": None})
+    await client.close()
+
+    clients = [await connect(app) for _ in range(8)]
+    try:
+        with metrics.recording() as registry:
+            responses = await asyncio.gather(*(
+                client.request("POST", "/allocate", {"order_ref": f"order{i}", "sku": sku, "qty": 5})
+                for i, client in enumerate(clients)
+            ))
+    finally:
+        for client in clients:
+            await client.close()
+
+    assert sorted(status for status, _ in responses) == [201] * 5 + [400] * 3
+    assert registry.count("allocation_batches") == 1
+    assert registry.count("allocation_batched_requests") == 8
+
+
+@pytest.mark.asyncio
+async def test_unhappy_paths_return_error_messages(app):
+    client = await connect(app)
+    try:
+        assert await client.request("POST", "/allocate", {"order_ref": "order1", "sku": "UNKNOWN-SKU", "qty": 1}) == (
+            400, {"message": "Invalid sku UNKNOWN-SKU"})
+        assert (await client.request("POST", "/allocate", {"order_ref": "order1", "qty": 1}))[0] == 400
+        for qty in (0, -50):
+            assert await client.request("POST", "/allocate", {"order_ref": "order1", "sku": "UNKNOWN-SKU", "qty": qty}) == (
+                400, {"message": "Field qty must be at least 1"})
+        assert await client.request("POST", "/add_batch", {"ref": "batch1", "sku": "UNKNOWN-SKU", "qty": -1}) == (
+            400, {"message": "Field qty must be at least 0"})
+        assert await client.request("POST", "/change_quantity", {"ref": "unknown-batch", "qty": -50}) == (
+            400, {"message": "Field qty must be at least 0"})
+        assert (await client.request("POST", "/change_quantity", {"ref": "unknown-batch", "qty": 1}))[0] == 404
+        assert (await client.request("GET", "/allocations/unknown-order"))[0] == 404
+        assert (await client.request("GET", "/availability/UNKNOWN-SKU"))[0] == 404
+        assert (await client.request("DELETE", "/allocate"))[0] == 404
+    finally:
+        await client.close()
@@ -0,0 +1,30 @@
+import pytest
+
+from allocation.domain import events
+from allocation.entrypoints import batch_import
+
+
+@pytest.mark.asyncio
+async def test_imports_batches_in_chunks_and_counts_rejected_rows(pg_pool):
+    items = [
+        events.BatchCreated("batch1", "HIPSTER-WORKBENCH", 100),
+        events.BatchCreated("batch2", "HIPSTER-WORKBENCH", 100),
+        {"ref": "batch3", "sku": "MEDIUM-PLINTH", "qty": "-5"},
+        events.BatchCreated("batch1", "HIPSTER-WORKBENCH", 50),
+        {"ref": "batch4", "sku": "MEDIUM-PLINTH", "qty": "10", "eta": "2030-01-01"},
+    ]
+
+    stats = await batch_import.import_batches(pg_pool, items, chunk_size=2)
+
+    assert [chunk.received for chunk in stats.chunks] == [2, 2, 1]
+    assert stats.inserted == 3
+    assert stats.rejected == 2
+
+    async with pg_pool.acquire() as connection:
+        refs = await connection.fetch("SELECT batch_ref FROM batches ORDER BY batch_ref")
+        skus = await connection.fetch("SELECT sku FROM products ORDER BY sku")
+        availability = await connection.fetch("SELECT sku, purchased FROM sku_availability ORDER BY sku")
+
+    assert [r["batch_ref"] for r in refs] == ["batch1", "batch2", "batch4"]
+    assert [r["sku"] for r in skus] == ["HIPSTER-WORKBENCH", "MEDIUM-PLINTH"]
+    assert [tuple(r) for r in availability] == [("HIPSTER-WORKBENCH", 200), ("MEDIUM-PLINTH", 10)]
@@ -0,0 +1,45 @@
+import asyncio
+
+import asyncpg
+import pytest
+
+from allocation import metrics
+from allocation.adapters import database, repository
+
+
+def test_statement_names_cannot_be_reused_for_another_query():
+    assert database.statement("get", repository.GET) == repository.GET
+
+    with pytest.raises(ValueError):
+        database.statement("get", "SELECT 1")
+
+
+@pytest.mark.asyncio
+async def test_pool_checks_registered_statements_when_connections_open(monkeypatch):
+    pool = await database.create_pool(min_size=1, max_size=1)
+    await pool.close()
+
+    monkeypatch.setitem(database.STATEMENTS, "broken", "SELECT no_such_column FROM batches")
+    with pytest.raises(asyncpg.UndefinedColumnError):
+        await database.create_pool(min_size=1, max_size=1)
+
+
+@pytest.mark.asyncio
+async def test_acquire_reports_waits_and_saturation():
+    pool = await database.create_pool(min_size=1, max_size=1)
+    try:
+        with metrics.recording() as registry:
+            connection = await database.acquire(pool)
+            waiter = asyncio.ensure_future(database.acquire(pool))
+            await asyncio.sleep(0.05)
+            busy = database.stats(pool)
+            await pool.release(connection)
+            await pool.release(await waiter)
+        idle = database.stats(pool)
+    finally:
+        await pool.close()
+
+    assert (busy.in_use, busy.waiting, busy.saturation) == (1, 1, 1.0)
+    assert (idle.in_use, idle.waiting) == (0, 0)
+    assert registry.count("pool_acquire") == 2
+    assert max(registry.series("pool_acquire").samples) >= 0.05
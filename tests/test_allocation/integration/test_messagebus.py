@@ -0,0 +1,145 @@
+import asyncio
+import datetime
+
+import pytest
+
+from allocation import metrics
+from allocation.adapters import cache, repository
+from allocation.domain import events, model
+from allocation.service_layer import messagebus, retry, unit_of_work
+
+
+@pytest.mark.asyncio
+async def test_retries_handler_when_cached_product_is_stale(pg_pool):
+    products_cache = cache.LRUCache()
+    uow = unit_of_work.PostgresUnitOfWork(pg_pool, products_cache)
+    await messagebus.handle(events.BatchCreated("batch1", "HIPSTER-WORKBENCH", 100), uow)
+
+    async with pg_pool.acquire() as connection:
+        await connection.execute("UPDATE products SET version_number = version_number + 1")
+
+    [batch_ref] = await messagebus.handle(events.AllocationRequired("o1", "HIPSTER-WORKBENCH", 10), uow)
+
+    assert batch_ref == "batch1"
+
+
+@pytest.mark.asyncio
+async def test_concurrent_allocations_do_not_oversell(pg_pool):
+    uow = unit_of_work.PostgresUnitOfWork(pg_pool)
+    await messagebus.handle(events.BatchCreated("batch1", "HIPSTER-WORKBENCH", 10), uow)
+    policy = retry.RetryPolicy(max_attempts=10, base_delay=0.001)
+
+    results = await asyncio.gather(*[
+        messagebus.handle(
+            events.AllocationRequired(f"o{i}", "HIPSTER-WORKBENCH", 5),
+            unit_of_work.PostgresUnitOfWork(pg_pool),
+            policy,
+        )
+        for i in range(4)
+    ], return_exceptions=True)
+
+    allocated = [r for r in results if isinstance(r, list)]
+    out_of_stock = [r for r in results if isinstance(r, model.OutOfStock)]
+    assert len(allocated) == 2
+    assert len(out_of_stock) == 2
+    assert policy.conflicts > 0
+
+    async with pg_pool.acquire() as connection:
+        total = await connection.fetchval("SELECT sum(qty) FROM order_lines")
+
+    assert total == 10
+
+
+@pytest.mark.asyncio
+async def test_lazy_uow_loads_allocations_to_evict_from_reduced_batch(pg_pool):
+    uow = unit_of_work.PostgresUnitOfWork(pg_pool, cache.LRUCache(), lazy=True)
+    await messagebus.handle(events.BatchCreated("batch1", "HIPSTER-WORKBENCH", 20), uow)
+    await messagebus.handle(events.AllocationRequired("o1", "HIPSTER-WORKBENCH", 10), uow)
+    await messagebus.handle(events.AllocationRequired("o2", "HIPSTER-WORKBENCH", 5), uow)
+    await messagebus.handle(events.BatchCreated("batch2", "HIPSTER-WORKBENCH", 20), uow)
+
+    await messagebus.handle(events.BatchQuantityChanged("batch1", 6), uow)
+
+    async with pg_pool.acquire() as connection:
+        rows = await connection.fetch(
+            "SELECT ol.order_ref, b.batch_ref FROM allocations a"
+            " JOIN order_lines ol ON ol.id = a.order_line_id JOIN batches b ON b.id = a.batch_id")
+    assert dict(rows) == {"o1": "batch2", "o2": "batch1"}
+
+
+@pytest.mark.asyncio
+async def test_adds_batch_with_date_eta_to_product_loaded_from_database(pg_pool):
+    uow = unit_of_work.PostgresUnitOfWork(pg_pool)
+    await messagebus.handle(events.BatchCreated("batch1", "HIPSTER-WORKBENCH", 10, datetime.date(2030, 1, 2)), uow)
+    await messagebus.handle(events.BatchCreated("batch2", "HIPSTER-WORKBENCH", 10, datetime.date(2030, 1, 1)), uow)
+
+    [batch_ref] = await messagebus.handle(events.AllocationRequired("o1", "HIPSTER-WORKBENCH", 10), uow)
+
+    assert batch_ref == "batch2"
+
+
+@pytest.mark.asyncio
+async def test_duplicate_allocation_returns_batch_ref_without_loading_product(pg_pool):
+    uow = unit_of_work.PostgresUnitOfWork(pg_pool)
+    await messagebus.handle(events.BatchCreated("batch1", "HIPSTER-WORKBENCH", 100), uow)
+    await messagebus.handle(events.AllocationRequired("o1", "HIPSTER-WORKBENCH", 10), uow)
+
+    with metrics.recording() as registry:
+        [from_cache] = await messagebus.handle(events.AllocationRequired("o1", "HIPSTER-WORKBENCH", 10), uow)
+        repository.allocations_cache.clear()
+        [from_database] = await messagebus.handle(events.AllocationRequired("o1", "HIPSTER-WORKBENCH", 10), uow)
+
+    assert from_cache == from_database == "batch1"
+    assert registry.count("allocation_idempotency", result="cache") == 1
+    assert registry.count("allocation_idempotency", result="database") == 1
+    assert registry.count("repository_query", query="get") == 0
+    assert registry.count("uow_enter") == 1
+    assert registry.count("uow_commit") == 0
+    async with pg_pool.acquire() as connection:
+        assert await connection.fetchval("SELECT count(*) FROM allocations") == 1
+
+
+@pytest.mark.asyncio
+async def test_cached_duplicate_allocations_do_not_enter_a_unit_of_work(pg_pool):
+    uow = unit_of_work.PostgresUnitOfWork(pg_pool)
+    bulk = events.AllocationsRequired([
+        events.AllocationRequired("o1", "HIPSTER-WORKBENCH", 10),
+        events.AllocationRequired("o2", "HIPSTER-WORKBENCH", 10),
+    ])
+    await messagebus.handle(events.BatchCreated("batch1", "HIPSTER-WORKBENCH", 100), uow)
+    await messagebus.handle(bulk, uow)
+
+    with metrics.recording() as registry:
+        [single] = await messagebus.handle(
+            events.AllocationRequired("o1", "HIPSTER-WORKBENCH", 10), unit_of_work.PostgresUnitOfWork(pg_pool))
+        [many] = await messagebus.handle(bulk, unit_of_work.PostgresUnitOfWork(pg_pool))
+
+    assert single == "batch1"
+    assert many == ["batch1", "batch1"]
+    assert registry.count("allocation_idempotency", result="cache") == 3
+    assert registry.count("uow_enter") == 0
+
+
+@pytest.mark.asyncio
+async def test_duplicate_allocation_follows_line_reallocated_after_eviction(pg_pool):
+    uow = unit_of_work.PostgresUnitOfWork(pg_pool)
+    await messagebus.handle(events.BatchCreated("batch1", "HIPSTER-WORKBENCH", 20), uow)
+    await messagebus.handle(events.AllocationRequired("o1", "HIPSTER-WORKBENCH", 10), uow)
+    await messagebus.handle(events.BatchCreated("batch2", "HIPSTER-WORKBENCH", 20), uow)
+    await messagebus.handle(events.BatchQuantityChanged("batch1", 5), uow)
+
+    [batch_ref] = await messagebus.handle(events.AllocationRequired("o1", "HIPSTER-WORKBENCH", 10), uow)
+
+    assert batch_ref == "batch2"
+
+
+@pytest.mark.asyncio
+async def test_batch_skus_resolves_batch_refs_through_the_database(pg_pool):
+    uow = unit_of_work.PostgresUnitOfWork(pg_pool)
+    await messagebus.handle(events.BatchCreated("batch1", "HIPSTER-WORKBENCH", 100), uow)
+    repository.batch_sku_cache.clear()
+    batch_skus = repository.BatchSkus(pg_pool)
+
+    assert await batch_skus("batch1") == "HIPSTER-WORKBENCH"
+    assert repository.batch_sku_cache.get("batch1") == "HIPSTER-WORKBENCH"
+    assert await batch_skus("unknown-batch") is None
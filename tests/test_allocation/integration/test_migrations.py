@@ -0,0 +1,35 @@
+import pytest
+
+from allocation import migrations
+
+
+def test_discover_returns_migrations_in_version_order():
+    versions = [migration.version for migration in migrations.discover()]
+
+    assert versions == sorted(versions)
+    assert versions[:5] == [1, 2, 3, 4, 5]
+
+
+@pytest.mark.asyncio
+async def test_migrate_does_nothing_when_schema_is_up_to_date(pg_pool):
+    async with pg_pool.acquire() as connection:
+        assert await migrations.migrate(connection) == []
+
+
+@pytest.mark.asyncio
+async def test_migrated_schema_has_required_indexes(pg_pool):
+    async with pg_pool.acquire() as connection:
+        assert await migrations.missing_indexes(connection) == []
+    await migrations.check_indexes(pg_pool)
+
+
+@pytest.mark.asyncio
+async def test_missing_index_is_reported(pg_pool):
+    async with pg_pool.acquire() as connection:
+        transaction = connection.transaction()
+        await transaction.start()
+        try:
+            await connection.execute("DROP INDEX ix_allocations_batch_id")
+            assert await migrations.missing_indexes(connection) == [("allocations", ("batch_id",))]
+        finally:
+            await transaction.rollback()
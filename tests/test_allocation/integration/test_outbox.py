@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+from allocation.adapters import outbox
+from allocation.domain import events, model
+from allocation.service_layer import messagebus, unit_of_work
+
+
+@pytest.mark.asyncio
+async def test_uow_writes_raised_events_to_outbox_on_commit(pg_pool):
+    uow = unit_of_work.PostgresUnitOfWork(pg_pool)
+    await messagebus.handle(events.BatchCreated("batch1", "GRUMPY-ARMCHAIR", 10, None), uow)
+
+    async with uow:
+        product = await uow.products.get("GRUMPY-ARMCHAIR")
+        product.deallocate(model.OrderLine("o1", "GRUMPY-ARMCHAIR", 10))
+        await uow.commit()
+
+    async with pg_pool.acquire() as connection:
+        rows = await connection.fetch("SELECT event_type, payload, published_at FROM outbox")
+
+    assert [(row["event_type"], row["payload"], row["published_at"]) for row in rows] == [
+        ("OutOfStock", '{"sku": "GRUMPY-ARMCHAIR"}', None),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_uow_does_not_write_events_to_outbox_on_rollback(pg_pool):
+    uow = unit_of_work.PostgresUnitOfWork(pg_pool)
+    await messagebus.handle(events.BatchCreated("batch1", "GRUMPY-ARMCHAIR", 10, None), uow)
+
+    async with uow:
+        product = await uow.products.get("GRUMPY-ARMCHAIR")
+        product.deallocate(model.OrderLine("o1", "GRUMPY-ARMCHAIR", 10))
+
+    async with pg_pool.acquire() as connection:
+        assert await connection.fetchval("SELECT count(*) FROM outbox") == 0
+
+
+@pytest.mark.asyncio
+async def test_publisher_publishes_pending_messages_once_in_commit_order(pg_pool):
+    async with pg_pool.acquire() as connection:
+        await outbox.add(connection, [events.OutOfStock(f"SKU-{i}") for i in range(5)])
+
+    transport = outbox.InMemoryTransport()
+    publisher = outbox.Publisher(pg_pool, transport, batch_size=3)
+
+    assert await publisher.publish_pending() == 3
+    assert await publisher.publish_pending() == 2
+    assert await publisher.publish_pending() == 0
+    assert [message.payload["sku"] for message in transport.published] == [f"SKU-{i}" for i in range(5)]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_publishers_do_not_claim_the_same_messages(pg_pool):
+    async with pg_pool.acquire() as connection:
+        await outbox.add(connection, [events.OutOfStock(f"SKU-{i}") for i in range(40)])
+
+    transport = outbox.InMemoryTransport()
+    publishers = [outbox.Publisher(pg_pool, transport, batch_size=5) for _ in range(4)]
+
+    while sum(await asyncio.gather(*(publisher.publish_pending() for publisher in publishers))):
+        pass
+
+    assert sorted(message.id for message in transport.published) == sorted({m.id for m in transport.published})
+    assert len(transport.published) == 40
+
+
+class FailingTransport(outbox.AbstractTransport):
+    async def publish(self, messages):
+        raise ConnectionError("broker is down")
+
+
+@pytest.mark.asyncio
+async def test_failed_publish_leaves_messages_pending(pg_pool):
+    async with pg_pool.acquire() as connection:
+        await outbox.add(connection, [events.OutOfStock("SKU-1")])
+
+    with pytest.raises(ConnectionError):
+        await outbox.Publisher(pg_pool, FailingTransport()).publish_pending()
+
+    transport = outbox.InMemoryTransport()
+    assert await outbox.Publisher(pg_pool, transport).publish_pending() == 1
+    assert [message.event_type for message in transport.published] == ["OutOfStock"]
+
+
+@pytest.mark.asyncio
+async def test_background_publisher_picks_up_new_messages(pg_pool):
+    transport = outbox.InMemoryTransport()
+
+    async with outbox.Publisher(pg_pool, transport, poll_interval=10) as publisher:
+        async with pg_pool.acquire() as connection:
+            await outbox.add(connection, [events.OutOfStock("SKU-1")])
+        publisher.wake()
+        for _ in range(100):
+            if transport.published:
+                break
+            await asyncio.sleep(0.01)
+
+    assert [message.payload for message in transport.published] == [{"sku": "SKU-1"}]
+
+
+@pytest.mark.asyncio
+async def test_console_transport_prints_each_message(pg_pool, capsys):
+    async with pg_pool.acquire() as connection:
+        await outbox.add(connection, [events.OutOfStock("SKU-1"), events.OutOfStock("SKU-2")])
+
+    assert await outbox.Publisher(pg_pool, outbox.ConsoleTransport()).publish_pending() == 2
+
+    assert capsys.readouterr().out.splitlines() == [
+        'PUBLISHING EVENT: OutOfStock {"sku": "SKU-1"}',
+        'PUBLISHING EVENT: OutOfStock {"sku": "SKU-2"}',
+    ]
+
+
+def test_transport_is_looked_up_by_configured_name():
+    assert isinstance(outbox.transport("console"), outbox.ConsoleTransport)
+    with pytest.raises(ValueError, match="Unknown outbox transport kafka"):
+        outbox.transport("kafka")
@@ -0,0 +1,79 @@
+import pytest
+
+from allocation import metrics
+from allocation.adapters import read_model
+from allocation.domain import events
+from allocation.service_layer import messagebus, unit_of_work, views
+
+
+async def read_model_rows(pg_pool):
+    async with pg_pool.acquire() as connection:
+        allocations = await connection.fetch(
+            "SELECT order_ref, sku, qty, batch_ref FROM allocations_view ORDER BY order_ref, sku")
+        availability = await connection.fetch("SELECT * FROM sku_availability ORDER BY sku")
+    return [dict(row) for row in allocations], [dict(row) for row in availability]
+
+
+@pytest.mark.asyncio
+async def test_read_model_is_updated_from_domain_events(pg_pool):
+    uow = unit_of_work.PostgresUnitOfWork(pg_pool)
+    await messagebus.handle(events.BatchCreated("batch1", "HIPSTER-WORKBENCH", 20), uow)
+    await messagebus.handle(events.BatchCreated("batch2", "HIPSTER-WORKBENCH", 20), uow)
+    with metrics.recording() as registry:
+        await messagebus.handle(events.AllocationsRequired([
+            events.AllocationRequired("o1", "HIPSTER-WORKBENCH", 10),
+            events.AllocationRequired("o2", "HIPSTER-WORKBENCH", 5),
+            events.AllocationRequired("o3", "HIPSTER-WORKBENCH", 4),
+        ]), uow)
+    assert registry.count("read_model_apply") == 1
+
+    await messagebus.handle(events.BatchQuantityChanged("batch1", 12), uow)
+
+    read_uow = lambda: unit_of_work.ReadOnlyUnitOfWork(pg_pool)
+    assert await views.allocations("o1", read_uow()) == [{"sku": "HIPSTER-WORKBENCH", "batch_ref": "batch2"}]
+    assert await views.allocations("o2", read_uow()) == [{"sku": "HIPSTER-WORKBENCH", "batch_ref": "batch1"}]
+    assert await views.availability("HIPSTER-WORKBENCH", read_uow()) == {
+        "sku": "HIPSTER-WORKBENCH", "purchased": 32, "allocated": 19, "available": 13}
+    assert await views.availability("UNKNOWN-SKU", read_uow()) is None
+
+
+@pytest.mark.asyncio
+async def test_rebuild_regenerates_the_read_model_from_the_write_tables(pg_pool):
+    uow = unit_of_work.PostgresUnitOfWork(pg_pool)
+    await messagebus.handle(events.BatchCreated("batch1", "HIPSTER-WORKBENCH", 20), uow)
+    await messagebus.handle(events.BatchCreated("batch2", "SHABBY-SOFA", 10), uow)
+    await messagebus.handle(events.AllocationRequired("o1", "HIPSTER-WORKBENCH", 10), uow)
+    await messagebus.handle(events.AllocationRequired("o1", "SHABBY-SOFA", 3), uow)
+    maintained = await read_model_rows(pg_pool)
+
+    async with pg_pool.acquire() as connection:
+        await connection.execute("DELETE FROM allocations_view")
+        await connection.execute("UPDATE sku_availability SET allocated = 0")
+        assert await read_model.rebuild(connection) == (2, 2)
+
+    assert await read_model_rows(pg_pool) == maintained
+
+
+@pytest.mark.asyncio
+async def test_read_model_ignores_changes_older_than_the_row(pg_pool):
+    allocated = events.StockChanged(
+        "HIPSTER-WORKBENCH", 1, 0, [events.Allocated("o1", "HIPSTER-WORKBENCH", 10, "batch1")], [])
+    replaced = events.StockChanged(
+        "HIPSTER-WORKBENCH", 2, 0,
+        [events.Allocated("o1", "HIPSTER-WORKBENCH", 10, "batch2")],
+        [events.Deallocated("o1", "HIPSTER-WORKBENCH", 10, "batch1")])
+    deallocated = events.StockChanged(
+        "HIPSTER-WORKBENCH", 3, 0, [], [events.Deallocated("o2", "HIPSTER-WORKBENCH", 5, "batch1")])
+    allocated_earlier = events.StockChanged(
+        "HIPSTER-WORKBENCH", 1, 0, [events.Allocated("o2", "HIPSTER-WORKBENCH", 5, "batch1")], [])
+
+    async with pg_pool.acquire() as connection:
+        views_model = read_model.PostgresReadModel(connection)
+        for event in [replaced, allocated, deallocated, allocated_earlier]:
+            await views_model.apply(event)
+
+    read_uow = lambda: unit_of_work.ReadOnlyUnitOfWork(pg_pool)
+    assert await views.allocations("o1", read_uow()) == [{"sku": "HIPSTER-WORKBENCH", "batch_ref": "batch2"}]
+    assert await views.allocations("o2", read_uow()) == []
+    assert await views.availability("HIPSTER-WORKBENCH", read_uow()) == {
+        "sku": "HIPSTER-WORKBENCH", "purchased": 0, "allocated": 10, "available": -10}
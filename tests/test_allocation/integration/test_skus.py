@@ -0,0 +1,35 @@
+import pytest
+
+from allocation.adapters import skus
+from allocation.domain import events
+from allocation.service_layer import messagebus, unit_of_work
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("bloom_capacity", [None, 1000])
+async def test_known_skus_are_loaded_from_products(pg_pool, bloom_capacity):
+    uow = unit_of_work.PostgresUnitOfWork(pg_pool)
+    await messagebus.handle(events.BatchCreated("batch1", "LOADED-LAMP", 10), uow)
+    known = skus.KnownSkus(pg_pool, bloom_capacity=bloom_capacity, prefetch=1)
+
+    assert await known.refresh() == 1
+    assert known.might_exist("LOADED-LAMP")
+    assert not known.might_exist("TYPO-LAMP")
+
+
+@pytest.mark.asyncio
+async def test_refresh_drops_retired_skus_and_keeps_added_ones(pg_pool):
+    uow = unit_of_work.PostgresUnitOfWork(pg_pool)
+    await messagebus.handle(events.BatchCreated("batch1", "RETIRED-LAMP", 10), uow)
+    async with skus.KnownSkus(pg_pool, refresh_interval=3600) as known:
+        assert known.might_exist("RETIRED-LAMP")
+        async with pg_pool.acquire() as connection:
+            await connection.execute("DELETE FROM batches WHERE sku = 'RETIRED-LAMP'")
+            await connection.execute("DELETE FROM products WHERE sku = 'RETIRED-LAMP'")
+        await messagebus.handle(events.BatchCreated("batch2", "FRESH-LAMP", 10), uow)
+        known.add("FRESH-LAMP")
+
+        await known.refresh()
+
+        assert not known.might_exist("RETIRED-LAMP")
+        assert known.might_exist("FRESH-LAMP")
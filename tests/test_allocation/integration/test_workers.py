@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+from allocation.domain import events
+from allocation.entrypoints import workers
+
+
+async def wait_for_restart(pool, worker_id, restarts):
+    for _ in range(200):
+        stats = pool.stats[worker_id]
+        if stats.restarts == restarts and worker_id in pool._ring.nodes:
+            return stats
+        await asyncio.sleep(0.05)
+    raise AssertionError(f"worker {worker_id} was not restarted")
+
+
+@pytest.mark.asyncio
+async def test_worker_pool_handles_events_per_sku_across_processes(pg_pool):
+    skus = [f"SPLIT-TABLE-{i}" for i in range(6)]
+
+    async with workers.WorkerPool(workers=2, concurrency=2, health_interval=0.05) as pool:
+        for sku in skus:
+            await pool.handle(events.BatchCreated(f"batch-{sku}", sku, 10, None))
+        results = await asyncio.gather(*(
+            pool.handle(events.AllocationRequired(f"order-{i}", sku, 3)) for sku in skus for i in range(3)
+        ))
+        await pool.handle(events.BatchQuantityChanged(f"batch-{skus[0]}", 9))
+        stats = pool.stats
+
+    assert sorted({result[0] for result in results}) == sorted(f"batch-{sku}" for sku in skus)
+    assert len({pool.worker_for(events.OutOfStock(sku)) for sku in skus}) == 2
+    assert sum(s.handled for s in stats) == len(skus) * 4 + 1
+    assert all(s.events_per_second > 0 for s in stats)
+
+    async with pg_pool.acquire() as connection:
+        allocated = await connection.fetchval("SELECT count(*) FROM allocations")
+    assert allocated == len(skus) * 3
+
+
+@pytest.mark.asyncio
+async def test_crashed_worker_is_replaced_and_takes_its_skus_back(pg_pool):
+    async with workers.WorkerPool(workers=2, concurrency=2, health_interval=0.05) as pool:
+        sku = next(f"LOST-TABLE-{i}" for i in range(100) if pool.worker_for(events.OutOfStock(f"LOST-TABLE-{i}")) == 0)
+        await pool.handle(events.BatchCreated("batch1", sku, 10, None))
+
+        pool._workers[0].process.kill()
+        stats = await wait_for_restart(pool, 0, restarts=1)
+
+        assert await pool.handle(events.AllocationRequired("order1", sku, 3)) == ["batch1"]
+        assert stats.handled == 2
+
+        await pool.restart(1)
+        assert pool.stats[1].restarts == 1
+        assert pool._ring.nodes == [0, 1]
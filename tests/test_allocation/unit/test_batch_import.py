@@ -0,0 +1,35 @@
+import datetime
+
+import pytest
+
+from allocation.domain import events
+from allocation.entrypoints import batch_import
+
+
+def test_converts_batch_created_events_and_mappings_to_records():
+    event = events.BatchCreated("b1", "SMOOTH-BENCH", 10, datetime.date(2030, 1, 2))
+    mapping = {"ref": "b2", "sku": "SMOOTH-BENCH", "qty": "5", "eta": ""}
+
+    assert batch_import.to_record(event) == ("b1", "SMOOTH-BENCH", 10, datetime.datetime(2030, 1, 2))
+    assert batch_import.to_record(mapping) == ("b2", "SMOOTH-BENCH", 5, None)
+
+
+@pytest.mark.parametrize("item", [
+    {},
+    {"ref": "b1", "sku": "SMOOTH-BENCH", "qty": "many"},
+    {"ref": "b1", "sku": "SMOOTH-BENCH", "qty": -1},
+    {"ref": "b1", "sku": "SMOOTH-BENCH", "qty": 1, "eta": "someday"},
+])
+def test_rejects_invalid_records(item):
+    with pytest.raises(batch_import.InvalidRecord):
+        batch_import.to_record(item)
+
+
+@pytest.mark.asyncio
+async def test_reads_jsonl_and_yields_empty_mapping_for_broken_lines(tmp_path):
+    path = tmp_path / "batches.jsonl"
+    path.write_text('{"ref": "b1", "sku": "SMOOTH-BENCH", "qty": 1}\n\nnot json\n')
+
+    rows = [row async for row in batch_import.read_jsonl(str(path))]
+
+    assert rows == [{"ref": "b1", "sku": "SMOOTH-BENCH", "qty": 1}, {}]
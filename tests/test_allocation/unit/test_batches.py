@@ -1,4 +1,7 @@
 from datetime import date
+
+import pytest
+
 from allocation.domain import model
 
 
@@ -46,4 +49,131 @@ def test_allocation_is_idempotent():
     batch.allocate(line)
     batch.allocate(line)
 
-    assert batch.available_quantity == 18
\ No newline at end of file
+    assert batch.available_quantity == 18
+
+
+def test_deallocation_restores_the_available_quantity():
+    batch = model.Batch("batch-001", "SMALL-TABLE", 20, date.today())
+    line = model.OrderLine("order-ref", "SMALL-TABLE", 2)
+    batch.allocate(line)
+
+    batch.deallocate(line)
+    batch.deallocate(line)
+
+    assert batch.available_quantity == 20
+
+
+def test_tracks_allocations_added_and_removed_since_last_clear():
+    batch = model.Batch("batch-001", "SMALL-TABLE", 20, date.today())
+    kept = model.OrderLine("order-1", "SMALL-TABLE", 2)
+    removed = model.OrderLine("order-2", "SMALL-TABLE", 2)
+    batch.allocate(kept)
+    batch.allocate(removed)
+    batch.clear_changes()
+
+    added = model.OrderLine("order-3", "SMALL-TABLE", 2)
+    batch.allocate(added)
+    batch.deallocate(removed)
+    transient = model.OrderLine("order-4", "SMALL-TABLE", 2)
+    batch.allocate(transient)
+    batch.deallocate(transient)
+
+    assert batch.added_allocations == {added}
+    assert batch.removed_allocations == {removed}
+    assert batch.is_modified is False
+
+
+def test_changing_purchased_quantity_marks_batch_as_modified():
+    batch = model.Batch("batch-001", "SMALL-TABLE", 20, date.today())
+
+    batch.change_purchased_quantity(10)
+
+    assert batch.is_modified
+    batch.clear_changes()
+    assert batch.is_modified is False
+
+
+def test_compact_allocations_behave_like_a_set():
+    batch = model.Batch("batch-001", "SMALL-TABLE", 20, date.today(), compact_allocations=True)
+    line = model.OrderLine("order-ref", "SMALL-TABLE", 2)
+    same_order_other_qty = model.OrderLine("order-ref", "SMALL-TABLE", 3)
+
+    batch.allocate(line)
+    batch.allocate(line)
+    batch.allocate(same_order_other_qty)
+
+    assert batch.allocations == {line, same_order_other_qty}
+    assert batch.available_quantity == 15
+
+    batch.deallocate(line)
+
+    assert line not in batch.allocations
+    assert batch.allocations == {same_order_other_qty}
+    batch.change_purchased_quantity(2)
+    assert batch.evict() == [same_order_other_qty]
+    assert batch.available_quantity == 2
+
+
+def test_domain_objects_have_no_instance_dict():
+    line = model.OrderLine("order-ref", "SMALL-TABLE", 2)
+    batch = model.Batch("batch-001", "SMALL-TABLE", 20, None)
+    product = model.Product("SMALL-TABLE", [batch])
+
+    for obj in (line, batch, product):
+        assert not hasattr(obj, "__dict__")
+
+
+def test_evicts_largest_lines_until_batch_is_not_overallocated():
+    batch = model.Batch("batch-001", "SMALL-TABLE", 20, None)
+    small, medium, large = (model.OrderLine(f"order-{qty}", "SMALL-TABLE", qty) for qty in (2, 5, 10))
+    for line in (small, medium, large):
+        batch.allocate(line)
+
+    batch.change_purchased_quantity(10)
+
+    assert batch.evict() == [large]
+    assert batch.allocations == {small, medium}
+
+
+def test_evicts_smallest_lines_first_if_asked():
+    batch = model.Batch("batch-001", "SMALL-TABLE", 20, None)
+    small, medium, large = (model.OrderLine(f"order-{qty}", "SMALL-TABLE", qty) for qty in (2, 5, 10))
+    for line in (small, medium, large):
+        batch.allocate(line)
+
+    batch.change_purchased_quantity(14)
+
+    assert batch.evict(model.smallest_first) == [small, medium]
+    assert batch.allocations == {large}
+
+
+def test_lazy_batch_allocates_from_its_allocated_quantity():
+    batch = model.Batch("batch-001", "SMALL-TABLE", 20, None, allocated_quantity=15)
+
+    batch.allocate(model.OrderLine("order-ref", "SMALL-TABLE", 5))
+
+    assert batch.available_quantity == 0
+    assert batch.can_allocate(model.OrderLine("order-ref-2", "SMALL-TABLE", 1)) is False
+
+
+def test_lazy_batch_requires_loaded_allocations_to_deallocate():
+    batch = model.Batch("batch-001", "SMALL-TABLE", 20, None, allocated_quantity=2)
+
+    with pytest.raises(model.AllocationsNotLoaded):
+        batch.deallocate(model.OrderLine("order-ref", "SMALL-TABLE", 2))
+
+
+def test_loaded_allocations_are_merged_with_lines_allocated_since():
+    batch = model.Batch("batch-001", "SMALL-TABLE", 20, None, allocated_quantity=2)
+    persisted = model.OrderLine("order-ref", "SMALL-TABLE", 2)
+    new = model.OrderLine("order-ref-2", "SMALL-TABLE", 3)
+    batch.allocate(new)
+
+    batch.load_allocations([persisted])
+    batch.deallocate(persisted)
+
+    assert batch.is_loaded
+    assert set(batch.allocations) == {new}
+    assert batch.available_quantity == 17
+    assert batch.added_allocations == {new}
+    assert batch.removed_allocations == {persisted}
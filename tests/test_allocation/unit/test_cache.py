@@ -0,0 +1,54 @@
+from allocation.adapters import cache
+
+
+def test_evicts_least_recently_used_entry():
+    lru = cache.LRUCache(maxsize=2)
+    lru.put("a", 1)
+    lru.put("b", 2)
+    lru.get("a")
+
+    lru.put("c", 3)
+
+    assert "a" in lru
+    assert "b" not in lru
+    assert "c" in lru
+
+
+def test_counts_hits_and_misses():
+    lru = cache.LRUCache(maxsize=2)
+    lru.put("a", 1)
+
+    assert lru.get("a") == 1
+    assert lru.get("b") is None
+    assert (lru.hits, lru.misses) == (1, 1)
+
+
+def test_invalidated_entry_is_gone():
+    lru = cache.LRUCache(maxsize=2)
+    lru.put("a", 1)
+
+    lru.invalidate("a")
+    lru.invalidate("a")
+
+    assert lru.get("a") is None
+
+
+def test_pop_removes_entry():
+    lru = cache.LRUCache(maxsize=2)
+    lru.put("a", 1)
+
+    assert lru.pop("a") == 1
+    assert lru.pop("a") is None
+
+
+def test_expired_entries_are_misses(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    lru = cache.LRUCache(maxsize=2, ttl=5)
+    lru.put("a", 1)
+
+    now[0] += 4
+    assert lru.get("a") == 1
+    now[0] += 2
+    assert lru.get("a") is None
+    assert len(lru) == 0
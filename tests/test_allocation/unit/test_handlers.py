@@ -1,8 +1,10 @@
+import asyncio
 from datetime import date
 
 import pytest
 
-from allocation.adapters import repository
+from allocation import metrics
+from allocation.adapters import memory, notifications, repository, skus
 from allocation.domain import events
 from allocation.service_layer import handlers, unit_of_work, messagebus
 
@@ -24,19 +26,38 @@ class FakeRepository(repository.AbstractProductRepository):
             if b.ref == batch_ref
         ), None)
 
+    async def _load_allocations(self, batches):
+        for batch in batches:
+            batch.load_allocations([])
+
 
 class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
     def __init__(self):
+        super().__init__()
         self.products = FakeRepository([])
+        self.views = memory.InMemoryReadModel()
         self.committed = False
 
     async def _commit(self):
+        for product in self.products.seen:
+            product.clear_changes()
         self.committed = True
 
     async def rollback(self):
         pass
 
 
+def shared_fake_uow_factory():
+    products = set()
+
+    def factory():
+        uow = FakeUnitOfWork()
+        uow.products._products = products
+        return uow
+
+    return factory
+
+
 @pytest.mark.asyncio
 async def test_allocate_returns_allocation():
     uow = FakeUnitOfWork()
@@ -76,6 +97,23 @@ async def test_add_batch_for_existing_product():
     assert "b2" in [b.ref for b in (await uow.products.get("GARISH-RUG")).batches]
 
 
+@pytest.mark.asyncio
+async def test_allocate_many_allocates_burst_in_one_commit():
+    uow = FakeUnitOfWork()
+    await messagebus.handle(events.BatchCreated("b1", "WOBBLY-SHELF", 20, None), uow)
+    await messagebus.handle(events.BatchCreated("b2", "NARROW-SHELF", 5, None), uow)
+    uow.committed = False
+
+    [results] = await messagebus.handle(events.AllocationsRequired([
+        events.AllocationRequired("o1", "WOBBLY-SHELF", 10),
+        events.AllocationRequired("o2", "NARROW-SHELF", 10),
+        events.AllocationRequired("o3", "WOBBLY-SHELF", 10),
+    ]), uow)
+
+    assert results == ["b1", None, "b1"]
+    assert uow.committed
+
+
 @pytest.mark.asyncio
 async def test_allocate_errors_for_invalid_sku():
     uow = FakeUnitOfWork()
@@ -117,3 +155,201 @@ async def test_reallocates_if_necessary():
     await messagebus.handle(events.BatchQuantityChanged("batch1", 25), uow)
     assert batch1.available_quantity == 5
     assert batch2.available_quantity == 30
+
+
+@pytest.mark.asyncio
+async def test_read_model_follows_allocations_and_reallocations():
+    uow = FakeUnitOfWork()
+    for event in [
+        events.BatchCreated("batch1", "SQUEAKY-BENCH", 20, None),
+        events.BatchCreated("batch2", "SQUEAKY-BENCH", 20, date.today()),
+        events.AllocationsRequired([
+            events.AllocationRequired("order1", "SQUEAKY-BENCH", 10),
+            events.AllocationRequired("order2", "SQUEAKY-BENCH", 5),
+        ]),
+        events.BatchQuantityChanged("batch1", 12),
+    ]:
+        await messagebus.handle(event, uow)
+
+    assert uow.views.allocations == {
+        ("order1", "SQUEAKY-BENCH"): (10, "batch2"),
+        ("order2", "SQUEAKY-BENCH"): (5, "batch1"),
+    }
+    assert uow.views.availability == {"SQUEAKY-BENCH": (32, 15)}
+
+
+@pytest.mark.asyncio
+async def test_in_memory_read_model_ignores_changes_older_than_the_line():
+    views = memory.InMemoryReadModel()
+    await views.apply(events.StockChanged(
+        "SQUEAKY-BENCH", 2, 0,
+        [events.Allocated("order1", "SQUEAKY-BENCH", 10, "batch2")],
+        [events.Deallocated("order1", "SQUEAKY-BENCH", 10, "batch1")]))
+    await views.apply(events.StockChanged(
+        "SQUEAKY-BENCH", 1, 0, [events.Allocated("order1", "SQUEAKY-BENCH", 10, "batch1")], []))
+
+    assert views.allocations == {("order1", "SQUEAKY-BENCH"): (10, "batch2")}
+    assert views.availability == {"SQUEAKY-BENCH": (0, 10)}
+
+
+@pytest.mark.asyncio
+async def test_scheduler_keeps_per_sku_order():
+    async with messagebus.Scheduler(shared_fake_uow_factory(), workers=4) as scheduler:
+        futures = [
+            await scheduler.submit(events.BatchCreated("b1", "SHY-OTTOMAN", 20, None)),
+            await scheduler.submit(events.BatchCreated("b2", "BOLD-OTTOMAN", 20, None)),
+        ]
+        for i in range(4):
+            futures.append(await scheduler.submit(events.AllocationRequired(f"o{i}", "SHY-OTTOMAN", 5)))
+            futures.append(await scheduler.submit(events.AllocationRequired(f"o{i}", "BOLD-OTTOMAN", 5)))
+        await scheduler.drain()
+
+    results = [future.result() for future in futures]
+    assert results[2:] == [["b1"], ["b2"]] * 4
+
+
+@pytest.mark.asyncio
+async def test_scheduler_splits_bulk_allocations_by_sku():
+    async with messagebus.Scheduler(shared_fake_uow_factory(), workers=4) as scheduler:
+        await scheduler.handle(events.BatchCreated("b1", "SHY-OTTOMAN", 20, None))
+        await scheduler.handle(events.BatchCreated("b2", "BOLD-OTTOMAN", 20, None))
+        result = await scheduler.handle(events.AllocationsRequired([
+            events.AllocationRequired("o1", "SHY-OTTOMAN", 5),
+            events.AllocationRequired("o1", "BOLD-OTTOMAN", 5),
+            events.AllocationRequired("o2", "SHY-OTTOMAN", 50),
+        ]))
+
+    assert result == [["b1", "b2", None]]
+
+
+@pytest.mark.asyncio
+async def test_split_bulk_allocation_reports_failures_per_sku():
+    async with messagebus.Scheduler(shared_fake_uow_factory(), workers=4) as scheduler:
+        await scheduler.handle(events.BatchCreated("b1", "SHY-OTTOMAN", 20, None))
+        [result] = await scheduler.handle(events.AllocationsRequired([
+            events.AllocationRequired("o1", "SHY-OTTOMAN", 5),
+            events.AllocationRequired("o1", "NONEXISTENT-SKU", 5),
+        ]))
+        with pytest.raises(handlers.InvalidSku):
+            await scheduler.handle(events.AllocationsRequired([
+                events.AllocationRequired("o2", "NONEXISTENT-SKU", 5),
+                events.AllocationRequired("o2", "MISSING-SKU", 5),
+            ]))
+
+    assert result[0] == "b1"
+    assert isinstance(result[1], handlers.InvalidSku)
+
+
+@pytest.mark.asyncio
+async def test_quantity_changes_and_bulk_allocations_are_keyed_by_sku():
+    async def batch_skus(ref):
+        return {"b1": "SHY-OTTOMAN"}.get(ref)
+
+    changed = await messagebus.with_batch_sku(events.BatchQuantityChanged("b1", 5), batch_skus)
+    unknown = await messagebus.with_batch_sku(events.BatchQuantityChanged("b9", 5), batch_skus)
+
+    assert changed == events.BatchQuantityChanged("b1", 5, sku="SHY-OTTOMAN")
+    assert messagebus.shard_key(changed) == "SHY-OTTOMAN"
+    assert messagebus.shard_key(unknown) == "b9"
+    assert messagebus.shard_key(events.AllocationsRequired([
+        events.AllocationRequired("o1", "SHY-OTTOMAN", 5),
+        events.AllocationRequired("o2", "SHY-OTTOMAN", 5),
+    ])) == "SHY-OTTOMAN"
+
+
+@pytest.mark.asyncio
+async def test_scheduler_propagates_handler_errors_to_submitter():
+    async with messagebus.Scheduler(shared_fake_uow_factory(), workers=2) as scheduler:
+        with pytest.raises(handlers.InvalidSku):
+            await scheduler.handle(events.AllocationRequired("o1", "MISSING-OTTOMAN", 5))
+
+
+@pytest.mark.asyncio
+async def test_scheduler_applies_backpressure():
+    scheduler = messagebus.Scheduler(shared_fake_uow_factory(), workers=1, max_pending=1)
+    await scheduler.submit(events.BatchCreated("b1", "HEAVY-OTTOMAN", 20, None))
+
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(scheduler.submit(events.BatchCreated("b2", "HEAVY-OTTOMAN", 20, None)), 0.01)
+
+    async with scheduler:
+        await scheduler.drain()
+    assert scheduler.pending == 0
+
+
+@pytest.mark.asyncio
+async def test_messagebus_records_handler_metrics():
+    uow = FakeUnitOfWork()
+    with metrics.recording() as registry:
+        await messagebus.handle(events.BatchCreated("b1", "TIMED-TABLE", 100, None), uow)
+        with pytest.raises(handlers.InvalidSku):
+            await messagebus.handle(events.AllocationRequired("o1", "UNTIMED-TABLE", 10), uow)
+
+    assert registry.count("messagebus_handle", event="BatchCreated") == 1
+    assert registry.count("handler", event="BatchCreated", handler="add_batch") == 1
+    assert registry.errors("handler", event="AllocationRequired", handler="allocate") == 1
+
+
+@pytest.mark.asyncio
+async def test_out_of_stock_notification_is_queued_on_configured_dispatcher():
+    sent = []
+
+    async def send(*args):
+        sent.append(args)
+
+    previous = notifications.get()
+    notifications.configure(notifications.NotificationDispatcher(send))
+    try:
+        await messagebus.handle(events.OutOfStock("LONELY-CHAIR"), FakeUnitOfWork())
+        assert sent == []
+        assert notifications.get().depth == 1
+    finally:
+        notifications.configure(previous)
+
+
+class SetSkuFilter(skus.SkuFilter):
+    def __init__(self, known):
+        self.known = set(known)
+
+    def might_exist(self, sku):
+        return sku in self.known
+
+    def add(self, sku):
+        self.known.add(sku)
+
+
+class UnenterableUnitOfWork(FakeUnitOfWork):
+    async def __aenter__(self):
+        raise AssertionError("unit of work must not be entered")
+
+
+@pytest.mark.asyncio
+async def test_unknown_sku_is_rejected_before_unit_of_work_is_entered():
+    previous = skus.get()
+    skus.configure(SetSkuFilter(["KNOWN-LAMP"]))
+    try:
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku TYPO-LAMP"):
+            await messagebus.handle(events.AllocationRequired("o1", "TYPO-LAMP", 1), UnenterableUnitOfWork())
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku TYPO-LAMP"):
+            await messagebus.handle(events.AllocationsRequired([
+                events.AllocationRequired("o1", "KNOWN-LAMP", 1),
+                events.AllocationRequired("o2", "TYPO-LAMP", 1),
+            ]), UnenterableUnitOfWork())
+    finally:
+        skus.configure(previous)
+
+
+@pytest.mark.asyncio
+async def test_created_batch_registers_its_sku():
+    previous = skus.get()
+    sku_filter = SetSkuFilter([])
+    skus.configure(sku_filter)
+    try:
+        uow = FakeUnitOfWork()
+        await messagebus.handle(events.BatchCreated("b1", "FRESH-LAMP", 10, None), uow)
+        [batch_ref] = await messagebus.handle(events.AllocationRequired("o1", "FRESH-LAMP", 1), uow)
+    finally:
+        skus.configure(previous)
+
+    assert sku_filter.known == {"FRESH-LAMP"}
+    assert batch_ref == "b1"
@@ -0,0 +1,183 @@
+import asyncio
+import os
+from datetime import date
+
+import pytest
+
+from allocation.adapters import journal, memory, repository
+from allocation.domain import events, model
+from allocation.service_layer import messagebus, unit_of_work
+
+
+@pytest.mark.asyncio
+async def test_allocates_and_reallocates_in_memory():
+    uow = unit_of_work.InMemoryUnitOfWork()
+    for event in [
+        events.BatchCreated("batch1", "INDIFFERENT-TABLE", 50, None),
+        events.BatchCreated("batch2", "INDIFFERENT-TABLE", 50, date.today()),
+        events.AllocationRequired("order1", "INDIFFERENT-TABLE", 20),
+        events.AllocationRequired("order2", "INDIFFERENT-TABLE", 20),
+        events.BatchQuantityChanged("batch1", 25),
+    ]:
+        await messagebus.handle(event, uow)
+
+    async with uow:
+        product = await uow.products.get_by_batch_ref("batch2")
+        available = {b.ref: b.available_quantity for b in product.batches}
+
+    assert available == {"batch1": 5, "batch2": 30}
+
+
+@pytest.mark.asyncio
+async def test_rolls_back_uncommitted_work():
+    uow = unit_of_work.InMemoryUnitOfWork()
+    await messagebus.handle(events.BatchCreated("batch1", "MEDIUM-PLINTH", 100, None), uow)
+
+    async with uow:
+        product = await uow.products.get("MEDIUM-PLINTH")
+        product.allocate(model.OrderLine("order1", "MEDIUM-PLINTH", 10))
+
+    async with uow:
+        [batch] = (await uow.products.get("MEDIUM-PLINTH")).batches
+
+    assert batch.available_quantity == 100
+
+
+@pytest.mark.asyncio
+async def test_loads_allocations_of_lazy_batches_from_the_store():
+    uow = unit_of_work.InMemoryUnitOfWork()
+    await messagebus.handle(events.BatchCreated("batch1", "MEDIUM-PLINTH", 100, None), uow)
+    await messagebus.handle(events.AllocationRequired("order1", "MEDIUM-PLINTH", 10), uow)
+
+    batch = model.Batch("batch1", "MEDIUM-PLINTH", 100, None, allocated_quantity=10)
+    async with uow:
+        await uow.products.load_allocations(model.Product("MEDIUM-PLINTH", [batch]))
+
+    assert batch.is_loaded
+    assert set(batch.allocations) == {model.OrderLine("order1", "MEDIUM-PLINTH", 10)}
+
+
+@pytest.mark.asyncio
+async def test_reuses_committed_aggregate():
+    uow = unit_of_work.InMemoryUnitOfWork()
+    await messagebus.handle(events.BatchCreated("batch1", "MEDIUM-PLINTH", 100, None), uow)
+
+    async with uow:
+        product = await uow.products.get("MEDIUM-PLINTH")
+        await uow.commit()
+
+    async with uow:
+        assert await uow.products.get("MEDIUM-PLINTH") is product
+
+
+@pytest.mark.asyncio
+async def test_concurrent_change_of_same_product_conflicts():
+    store = memory.ProductStore()
+    await messagebus.handle(events.BatchCreated("batch1", "LARGE-FORK", 100, None), unit_of_work.InMemoryUnitOfWork(store))
+    first, second = unit_of_work.InMemoryUnitOfWork(store), unit_of_work.InMemoryUnitOfWork(store)
+
+    async with first:
+        async with second:
+            (await first.products.get("LARGE-FORK")).allocate(model.OrderLine("order1", "LARGE-FORK", 10))
+            (await second.products.get("LARGE-FORK")).allocate(model.OrderLine("order2", "LARGE-FORK", 10))
+            await first.commit()
+            with pytest.raises(repository.ConcurrencyConflict):
+                await second.commit()
+
+
+@pytest.mark.asyncio
+async def test_failed_journal_write_leaves_committed_state_unchanged(tmp_path):
+    log = journal.Journal(str(tmp_path), flush_interval=0)
+    store = memory.ProductStore(log)
+    await messagebus.handle(events.BatchCreated("batch1", "RETRO-CLOCK", 100, None), unit_of_work.InMemoryUnitOfWork(store))
+
+    def fail(file, lines):
+        raise OSError("No space left on device")
+
+    log._write = fail
+    uow = unit_of_work.InMemoryUnitOfWork(store)
+    with pytest.raises(OSError):
+        async with uow:
+            product = await uow.products.get("RETRO-CLOCK")
+            product.allocate(model.OrderLine("order1", "RETRO-CLOCK", 10))
+            await uow.commit()
+
+    assert product.has_changes
+    async with unit_of_work.InMemoryUnitOfWork(store) as other:
+        [batch] = (await other.products.get("RETRO-CLOCK")).batches
+        assert batch.available_quantity == 100
+    await store.close()
+
+
+@pytest.mark.asyncio
+async def test_recovers_committed_state_from_journal(tmp_path):
+    store = memory.ProductStore(journal.Journal(str(tmp_path), flush_interval=0))
+    uow = unit_of_work.InMemoryUnitOfWork(store)
+    await messagebus.handle(events.BatchCreated("batch1", "RETRO-CLOCK", 100, date(2030, 1, 1)), uow)
+    await messagebus.handle(events.AllocationRequired("order1", "RETRO-CLOCK", 10), uow)
+    await store.close()
+
+    recovered = memory.ProductStore.recover(journal.Journal(str(tmp_path)))
+
+    [batch] = recovered.checkout("RETRO-CLOCK").batches
+    assert batch.eta == date(2030, 1, 1)
+    assert batch.allocations == {model.OrderLine("order1", "RETRO-CLOCK", 10)}
+    assert recovered.find_sku("batch1") == "RETRO-CLOCK"
+    assert recovered.read_model.allocations == store.read_model.allocations == {("order1", "RETRO-CLOCK"): (10, "batch1")}
+    assert recovered.read_model.availability == store.read_model.availability == {"RETRO-CLOCK": (100, 10)}
+    await recovered.close()
+
+
+@pytest.mark.asyncio
+async def test_stores_batches_a_new_product_was_constructed_with(tmp_path):
+    store = memory.ProductStore(journal.Journal(str(tmp_path), flush_interval=0))
+    uow = unit_of_work.InMemoryUnitOfWork(store)
+    batch = model.Batch("batch1", "RETRO-CLOCK", 100, None)
+    batch.allocate(model.OrderLine("order1", "RETRO-CLOCK", 10))
+    async with uow:
+        await uow.products.add(model.Product("RETRO-CLOCK", [batch]))
+        await uow.commit()
+    await store.close()
+
+    recovered = memory.ProductStore.recover(journal.Journal(str(tmp_path)))
+
+    [batch] = recovered.checkout("RETRO-CLOCK").batches
+    assert batch.ref == "batch1"
+    assert batch.allocations == {model.OrderLine("order1", "RETRO-CLOCK", 10)}
+    assert recovered.find_sku("batch1") == "RETRO-CLOCK"
+    await recovered.close()
+
+
+@pytest.mark.asyncio
+async def test_snapshot_compacts_journal_and_recovery_uses_it(tmp_path):
+    store = memory.ProductStore(journal.Journal(str(tmp_path), flush_interval=0, snapshot_every=2))
+    uow = unit_of_work.InMemoryUnitOfWork(store)
+    await messagebus.handle(events.BatchCreated("batch1", "RETRO-CLOCK", 100), uow)
+    for i in range(5):
+        await messagebus.handle(events.AllocationRequired(f"order{i}", "RETRO-CLOCK", 10), uow)
+        await asyncio.sleep(0)
+    await store.close()
+
+    assert os.path.exists(tmp_path / "snapshot.json")
+    assert len(list(tmp_path.glob("journal.*.log"))) == 1
+
+    recovered = memory.ProductStore.recover(journal.Journal(str(tmp_path)))
+    [batch] = recovered.checkout("RETRO-CLOCK").batches
+    assert batch.available_quantity == 50
+    await recovered.close()
+
+
+@pytest.mark.asyncio
+async def test_recovery_ignores_torn_last_entry(tmp_path):
+    store = memory.ProductStore(journal.Journal(str(tmp_path), flush_interval=0))
+    await messagebus.handle(events.BatchCreated("batch1", "RETRO-CLOCK", 100), unit_of_work.InMemoryUnitOfWork(store))
+    await store.close()
+    [segment] = tmp_path.glob("journal.*.log")
+    with open(segment, "ab") as file:
+        file.write(b'{"sku": "RETRO-CL')
+
+    recovered = memory.ProductStore.recover(journal.Journal(str(tmp_path)))
+
+    assert recovered.find_sku("batch1") == "RETRO-CLOCK"
+    assert segment.read_bytes().endswith(b"}\n")
+    await recovered.close()
@@ -0,0 +1,60 @@
+import pytest
+
+from allocation import metrics
+
+
+def test_default_instrumentation_records_nothing():
+    instrumentation = metrics.Instrumentation()
+
+    with instrumentation.timer("handler", event="BatchCreated"):
+        pass
+    instrumentation.increment("retries")
+
+
+def test_registry_counts_timings_and_errors():
+    registry = metrics.Registry()
+
+    with registry.timer("handler", event="BatchCreated"):
+        pass
+    with pytest.raises(ValueError):
+        with registry.timer("handler", event="BatchCreated"):
+            raise ValueError()
+
+    assert registry.count("handler", event="BatchCreated") == 2
+    assert registry.errors("handler", event="BatchCreated") == 1
+    assert registry.count("handler", event="OutOfStock") == 0
+
+
+def test_series_quantiles():
+    series = metrics.Series(reservoir_size=100)
+    for i in range(1, 101):
+        series.observe(i / 1000)
+
+    assert series.quantile(0.5) == 0.051
+    assert series.quantile(0.99) == 0.1
+
+
+def test_renders_prometheus_text_format():
+    registry = metrics.Registry()
+    with registry.timer("repository_query", query="get"):
+        pass
+    registry.increment("retries", 2)
+    registry.set_gauge("queue_depth", 3, queue="notifications")
+
+    text = registry.render()
+
+    assert "# TYPE allocation_repository_query_seconds summary" in text
+    assert 'allocation_repository_query_seconds{query="get",quantile="0.95"}' in text
+    assert 'allocation_repository_query_seconds_count{query="get"} 1' in text
+    assert 'allocation_repository_query_errors_total{query="get"} 0' in text
+    assert "allocation_retries_total 2" in text
+    assert 'allocation_queue_depth{queue="notifications"} 3' in text
+
+
+def test_recording_installs_registry_temporarily():
+    default = metrics.get()
+
+    with metrics.recording() as registry:
+        assert metrics.get() is registry
+
+    assert metrics.get() is default
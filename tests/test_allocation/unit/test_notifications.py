@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+
+from allocation import metrics
+from allocation.adapters import notifications
+
+
+class FakeEmail:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, address, message):
+        self.sent.append((address, message))
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.mark.asyncio
+async def test_dispatcher_sends_queued_skus_as_one_digest():
+    email = FakeEmail()
+    dispatcher = notifications.NotificationDispatcher(email.send)
+
+    for sku in ("RED-CHAIR", "BLUE-CHAIR", "RED-CHAIR"):
+        dispatcher.notify(sku)
+    assert dispatcher.depth == 2
+
+    assert await dispatcher.flush() == 2
+    assert email.sent == [("stock@made.com", "Артикулов RED-CHAIR, BLUE-CHAIR нет в наличии")]
+
+
+@pytest.mark.asyncio
+async def test_dispatcher_merges_repeated_sku_within_window():
+    email, clock = FakeEmail(), FakeClock()
+    dispatcher = notifications.NotificationDispatcher(email.send, window=60, clock=clock)
+
+    with metrics.recording() as registry:
+        assert dispatcher.notify("RED-CHAIR")
+        await dispatcher.flush()
+        clock.now = 59
+        assert not dispatcher.notify("RED-CHAIR")
+        clock.now = 61
+        assert dispatcher.notify("RED-CHAIR")
+        await dispatcher.flush()
+
+    assert [message for _, message in email.sent] == ["Артикула RED-CHAIR нет в наличии"] * 2
+    assert registry.count("notifications_merged") == 1
+    assert registry.count("notifications_sent") == 2
+
+
+@pytest.mark.asyncio
+async def test_dispatcher_drops_notifications_when_queue_is_full():
+    dispatcher = notifications.NotificationDispatcher(FakeEmail().send, max_queue=2)
+
+    with metrics.recording() as registry:
+        results = [dispatcher.notify(f"CHAIR-{i}") for i in range(3)]
+
+    assert results == [True, True, False]
+    assert registry.count("notifications_dropped") == 1
+    assert registry.gauges["notification_queue_depth"][()] == 2
+
+
+@pytest.mark.asyncio
+async def test_dispatcher_flushes_in_background_and_on_stop():
+    email = FakeEmail()
+    async with notifications.NotificationDispatcher(email.send, batch_size=2, flush_interval=10) as dispatcher:
+        for i in range(3):
+            dispatcher.notify(f"CHAIR-{i}")
+        for _ in range(100):
+            if email.sent:
+                break
+            await asyncio.sleep(0.001)
+        assert [message for _, message in email.sent] == ["Артикулов CHAIR-0, CHAIR-1 нет в наличии"]
+
+    assert [message for _, message in email.sent][1:] == ["Артикула CHAIR-2 нет в наличии"]
+
+
+
+@pytest.mark.asyncio
+async def test_dispatcher_stop_finishes_the_digest_being_sent():
+    email, sending, release = FakeEmail(), asyncio.Event(), asyncio.Event()
+
+    async def slow_send(address, message):
+        sending.set()
+        await release.wait()
+        await email.send(address, message)
+
+    dispatcher = notifications.NotificationDispatcher(slow_send, flush_interval=0)
+    dispatcher.start()
+    dispatcher.notify("CHAIR-0")
+    await sending.wait()
+    dispatcher.notify("CHAIR-1")
+    stopping = asyncio.create_task(dispatcher.stop())
+    await asyncio.sleep(0.01)
+    release.set()
+    await stopping
+
+    assert [message for _, message in email.sent] == [
+        "Артикула CHAIR-0 нет в наличии",
+        "Артикула CHAIR-1 нет в наличии",
+    ]
@@ -2,7 +2,7 @@ import datetime
 
 import pytest
 
-from allocation.domain import model
+from allocation.domain import events, model
 
 today = datetime.date.today()
 tomorrow = today + datetime.timedelta(days=1)
@@ -35,6 +35,14 @@ def test_prefers_earlier_batches():
     assert latest.available_quantity == 100
 
 
+def test_orders_batches_with_date_and_datetime_etas_together():
+    loaded = model.Batch("loaded-batch", "MINIMALIST-SPOON", 100, datetime.datetime.combine(tomorrow, datetime.time()))
+    product = model.Product("MINIMALIST-SPOON", [loaded])
+    product.add_batch(model.Batch("new-batch", "MINIMALIST-SPOON", 100, today))
+
+    assert product.allocate(model.OrderLine("order1", "MINIMALIST-SPOON", 10)) == "new-batch"
+
+
 def test_returns_allocated_batch_ref():
     in_stock_batch = model.Batch("in-stock-batch-ref", "HIGHBROW-POSTER", 100, None)
     shipment_batch = model.Batch("shipment-batch-ref", "HIGHBROW-POSTER", 100, tomorrow)
@@ -53,3 +61,154 @@ def test_raises_out_of_stock_exception_if_cannot_allocate():
 
     with pytest.raises(model.OutOfStock, match="SMALL-FORK"):
         product.allocate(model.OrderLine("order2", "SMALL-FORK", 1))
+
+
+def test_allocates_to_next_batch_once_preferred_one_is_exhausted():
+    in_stock_batch = model.Batch("in-stock-batch", "LOUD-STOOL", 10, None)
+    shipment_batch = model.Batch("shipment-batch", "LOUD-STOOL", 100, tomorrow)
+    product = model.Product("LOUD-STOOL", [shipment_batch, in_stock_batch])
+
+    assert product.allocate(model.OrderLine("order1", "LOUD-STOOL", 10)) == "in-stock-batch"
+    assert product.allocate(model.OrderLine("order2", "LOUD-STOOL", 10)) == "shipment-batch"
+
+
+def test_deallocation_makes_batch_preferred_again():
+    in_stock_batch = model.Batch("in-stock-batch", "QUIET-STOOL", 10, None)
+    shipment_batch = model.Batch("shipment-batch", "QUIET-STOOL", 100, tomorrow)
+    product = model.Product("QUIET-STOOL", [in_stock_batch, shipment_batch])
+    line = model.OrderLine("order1", "QUIET-STOOL", 10)
+    product.allocate(line)
+
+    product.deallocate(line)
+
+    assert product.allocate(model.OrderLine("order2", "QUIET-STOOL", 5)) == "in-stock-batch"
+
+
+def test_added_batch_takes_part_in_allocation():
+    shipment_batch = model.Batch("shipment-batch", "TALL-LAMP", 100, tomorrow)
+    product = model.Product("TALL-LAMP", [shipment_batch])
+
+    product.add_batch(model.Batch("in-stock-batch", "TALL-LAMP", 100, None))
+
+    assert product.allocate(model.OrderLine("order1", "TALL-LAMP", 10)) == "in-stock-batch"
+
+
+def test_increasing_batch_quantity_makes_it_available_again():
+    batch = model.Batch("batch1", "SHORT-LAMP", 10, today)
+    product = model.Product("SHORT-LAMP", [batch])
+    product.allocate(model.OrderLine("order1", "SHORT-LAMP", 10))
+
+    product.change_batch_quantity("batch1", 20)
+
+    assert product.allocate(model.OrderLine("order2", "SHORT-LAMP", 10)) == "batch1"
+
+
+def test_reduced_batch_reallocates_evicted_lines_within_product():
+    in_stock_batch = model.Batch("in-stock-batch", "RICKETY-CHAIR", 30, None)
+    shipment_batch = model.Batch("shipment-batch", "RICKETY-CHAIR", 25, tomorrow)
+    product = model.Product("RICKETY-CHAIR", [in_stock_batch, shipment_batch])
+    small, large = model.OrderLine("order1", "RICKETY-CHAIR", 5), model.OrderLine("order2", "RICKETY-CHAIR", 20)
+    product.allocate(small)
+    product.allocate(large)
+
+    product.change_batch_quantity("in-stock-batch", 15)
+
+    assert product.events == []
+    assert in_stock_batch.allocations == {small}
+    assert shipment_batch.allocations == {large}
+
+
+def test_reduced_batch_requires_allocation_only_for_lines_that_do_not_fit():
+    in_stock_batch = model.Batch("in-stock-batch", "RICKETY-CHAIR", 30, None)
+    shipment_batch = model.Batch("shipment-batch", "RICKETY-CHAIR", 10, tomorrow)
+    product = model.Product("RICKETY-CHAIR", [in_stock_batch, shipment_batch])
+    lines = [model.OrderLine(f"order{qty}", "RICKETY-CHAIR", qty) for qty in (4, 8, 12)]
+    for line in lines:
+        product.allocate(line)
+
+    product.change_batch_quantity("in-stock-batch", 5, eviction_order=model.smallest_first)
+
+    assert product.events == [events.AllocationRequired("order12", "RICKETY-CHAIR", 12)]
+    assert in_stock_batch.allocations == {lines[0]}
+    assert shipment_batch.allocations == {lines[1]}
+
+
+def test_allocate_many_returns_batch_ref_or_none_per_line():
+    in_stock_batch = model.Batch("in-stock-batch", "BULKY-SOFA", 10, None)
+    shipment_batch = model.Batch("shipment-batch", "BULKY-SOFA", 15, tomorrow)
+    product = model.Product("BULKY-SOFA", [in_stock_batch, shipment_batch])
+    lines = [
+        model.OrderLine("order1", "BULKY-SOFA", 8),
+        model.OrderLine("order2", "BULKY-SOFA", 8),
+        model.OrderLine("order3", "BULKY-SOFA", 8),
+        model.OrderLine("order4", "BULKY-SOFA", 2),
+    ]
+
+    results = product.allocate_many(lines)
+
+    assert results == ["in-stock-batch", "shipment-batch", None, "in-stock-batch"]
+    assert in_stock_batch.available_quantity == 0
+    assert shipment_batch.available_quantity == 7
+
+
+def test_tracks_new_batches_until_changes_are_cleared():
+    existing = model.Batch("existing-batch", "DUSTY-CABINET", 10, None)
+    product = model.Product("DUSTY-CABINET", [existing])
+    new = model.Batch("new-batch", "DUSTY-CABINET", 10, None)
+
+    product.add_batch(new)
+
+    assert product.new_batches == [new]
+    product.clear_changes()
+    assert product.new_batches == []
+
+
+def test_every_mutation_bumps_version_number():
+    batch = model.Batch("batch1", "CREAKY-DESK", 20, None)
+    product = model.Product("CREAKY-DESK", [batch], version_number=7)
+    line = model.OrderLine("order1", "CREAKY-DESK", 10)
+
+    product.allocate(line)
+    product.deallocate(line)
+    product.change_batch_quantity("batch1", 10)
+    product.add_batch(model.Batch("batch2", "CREAKY-DESK", 20, None))
+
+    assert product.version_number == 11
+    assert product.persisted_version_number == 7
+
+
+def test_reducing_lazy_batch_below_its_allocations_requires_loading_them():
+    batch = model.Batch("batch1", "CREAKY-DESK", 20, None, allocated_quantity=10)
+    product = model.Product("CREAKY-DESK", [batch])
+
+    assert product.requires_allocations("batch1", 15) is False
+    assert product.requires_allocations("batch1", 5) is True
+    with pytest.raises(model.AllocationsNotLoaded):
+        product.change_batch_quantity("batch1", 5)
+    assert batch.purchased_quantity == 20
+
+    batch.load_allocations([model.OrderLine("order1", "CREAKY-DESK", 10)])
+    product.change_batch_quantity("batch1", 5)
+
+    assert product.events == [events.AllocationRequired("order1", "CREAKY-DESK", 10)]
+
+
+def test_stock_changed_summarises_changes_since_last_commit():
+    in_stock_batch = model.Batch("in-stock-batch", "WOBBLY-STOOL", 10, None)
+    product = model.Product("WOBBLY-STOOL", [in_stock_batch])
+    small, large = model.OrderLine("order1", "WOBBLY-STOOL", 2), model.OrderLine("order2", "WOBBLY-STOOL", 6)
+    product.allocate(small)
+    product.allocate(large)
+    product.clear_changes()
+    assert product.stock_changed() is None
+
+    product.add_batch(model.Batch("shipment-batch", "WOBBLY-STOOL", 20, tomorrow))
+    product.change_batch_quantity("in-stock-batch", 4)
+
+    assert product.stock_changed() == events.StockChanged(
+        "WOBBLY-STOOL",
+        version=5,
+        purchased=14,
+        allocated=[events.Allocated("order2", "WOBBLY-STOOL", 6, "shipment-batch")],
+        deallocated=[events.Deallocated("order2", "WOBBLY-STOOL", 6, "in-stock-batch")],
+    )
@@ -0,0 +1,53 @@
+import pytest
+
+from allocation.adapters import repository
+from allocation.service_layer import retry
+
+
+def failing(times):
+    calls = []
+
+    async def operation():
+        calls.append(1)
+        if len(calls) <= times:
+            raise repository.ConcurrencyConflict()
+        return len(calls)
+
+    return operation
+
+
+@pytest.mark.asyncio
+async def test_retries_concurrency_conflicts_until_success():
+    policy = retry.RetryPolicy(max_attempts=3, base_delay=0)
+
+    assert await policy.run(failing(2)) == 3
+    assert policy.stats == {"conflicts": 2, "retries": 2, "exhausted": 0}
+
+
+@pytest.mark.asyncio
+async def test_gives_up_after_max_attempts():
+    policy = retry.RetryPolicy(max_attempts=2, base_delay=0)
+
+    with pytest.raises(repository.ConcurrencyConflict):
+        await policy.run(failing(5))
+
+    assert policy.stats == {"conflicts": 2, "retries": 1, "exhausted": 1}
+
+
+@pytest.mark.asyncio
+async def test_does_not_retry_other_errors():
+    policy = retry.RetryPolicy(base_delay=0)
+
+    async def operation():
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        await policy.run(operation)
+
+    assert policy.conflicts == 0
+
+
+def test_delay_is_jittered_and_capped():
+    policy = retry.RetryPolicy(base_delay=0.01, max_delay=0.05)
+
+    assert all(0 <= policy.delay(attempt) <= 0.05 for attempt in range(1, 10))
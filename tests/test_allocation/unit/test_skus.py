@@ -0,0 +1,28 @@
+from allocation.adapters import skus
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = skus.BloomFilter(capacity=1000)
+    items = [f"SKU-{i}" for i in range(1000)]
+    for item in items:
+        bloom.add(item)
+
+    assert all(item in bloom for item in items)
+
+
+def test_bloom_filter_false_positive_rate_stays_near_target():
+    bloom = skus.BloomFilter(capacity=1000, error_rate=0.01)
+    for i in range(1000):
+        bloom.add(f"SKU-{i}")
+
+    false_positives = sum(f"OTHER-{i}" in bloom for i in range(10_000))
+
+    assert false_positives < 300
+
+
+def test_known_skus_accept_every_sku_until_loaded():
+    known = skus.KnownSkus(pool=None)
+    known.add("NEW-LAMP")
+
+    assert known.loaded is False
+    assert known.might_exist("ANY-LAMP")
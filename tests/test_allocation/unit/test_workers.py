@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from allocation.domain import events
+from allocation.entrypoints import workers
+
+
+def test_hash_ring_spreads_keys_over_all_nodes():
+    ring = workers.HashRing(range(4))
+
+    owners = [ring.node_for(f"SKU-{i}") for i in range(4000)]
+
+    assert all(700 < owners.count(node) < 1300 for node in range(4))
+
+
+def test_removing_a_node_only_moves_its_keys():
+    ring = workers.HashRing(range(4))
+    keys = [f"SKU-{i}" for i in range(1000)]
+    before = {key: ring.node_for(key) for key in keys}
+
+    ring.remove(2)
+    after = {key: ring.node_for(key) for key in keys}
+    ring.add(2)
+
+    assert all(after[key] == before[key] for key in keys if before[key] != 2)
+    assert all(after[key] != 2 for key in keys)
+    assert {key: ring.node_for(key) for key in keys} == before
+
+
+@pytest.mark.asyncio
+async def test_worker_pool_routes_quantity_changes_and_bulk_allocations_by_sku():
+    async def batch_skus(ref):
+        return {"batch1": "ROUND-TABLE"}.get(ref)
+
+    pool = workers.WorkerPool(workers=0, batch_skus=batch_skus)
+    keys = []
+
+    async def submit(event):
+        keys.append(pool.key(event))
+        future = asyncio.get_running_loop().create_future()
+        lines = event.lines if isinstance(event, events.AllocationsRequired) else []
+        future.set_result([[f"batch-{line.sku}" for line in lines]])
+        return future
+
+    pool._submit = submit
+    await pool.submit(events.BatchQuantityChanged("batch1", 10))
+    await pool.submit(events.BatchQuantityChanged("unknown", 10))
+    result = await (await pool.submit(events.AllocationsRequired([
+        events.AllocationRequired("o1", "ROUND-TABLE", 10),
+        events.AllocationRequired("o1", "SQUARE-TABLE", 10),
+        events.AllocationRequired("o2", "ROUND-TABLE", 10),
+    ])))
+
+    assert keys == ["ROUND-TABLE", "unknown", "ROUND-TABLE", "SQUARE-TABLE"]
+    assert result == [["batch-ROUND-TABLE", "batch-SQUARE-TABLE", "batch-ROUND-TABLE"]]